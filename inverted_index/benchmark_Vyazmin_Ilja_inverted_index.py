@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Benchmark of building, dumping, loading and querying inverted index"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from itertools import accumulate
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from task_Vyazmin_Ilja_inverted_index import (
+    InvertedIndex, build_inverted_index, load_documents, open_index, DEFAULT_POSTING_CODEC,
+    POSTING_CODECS,
+)
+
+DEFAULT_DOCUMENT_COUNT = 10000
+DEFAULT_VOCABULARY_SIZE = 50000
+DEFAULT_DOCUMENT_LENGTH = 100
+DEFAULT_ZIPF_EXPONENT = 1.0
+DEFAULT_QUERY_COUNT = 1000
+DEFAULT_QUERY_LENGTH = 2
+DEFAULT_SEED = 42
+DEFAULT_BENCHMARK_OUTPUT_PATH = "benchmark.json"
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def zipf_vocabulary(vocabulary_size: int, zipf_exponent: float):
+    """Return words and cumulative weights of Zipf distribution over them"""
+    words = ["w%d" % rank for rank in range(vocabulary_size)]
+    weights = [1 / (rank + 1) ** zipf_exponent for rank in range(vocabulary_size)]
+    return words, list(accumulate(weights))
+
+
+def generate_corpus(filepath: str, document_count: int, vocabulary_size=DEFAULT_VOCABULARY_SIZE,
+                    document_length=DEFAULT_DOCUMENT_LENGTH, zipf_exponent=DEFAULT_ZIPF_EXPONENT,
+                    seed=DEFAULT_SEED):
+    """Write synthetic dataset with Zipf-distributed words in load_documents format"""
+    generator = random.Random(seed)
+    words, cumulative_weights = zipf_vocabulary(vocabulary_size, zipf_exponent)
+    with open(filepath, 'w') as dataset_file:
+        for idx in range(document_count):
+            length = max(1, int(generator.expovariate(1 / document_length)))
+            document = generator.choices(words, cum_weights=cumulative_weights, k=length)
+            dataset_file.write("%d\t%s\n" % (idx, " ".join(document)))
+
+
+def generate_queries(query_count: int, vocabulary_size=DEFAULT_VOCABULARY_SIZE,
+                     query_length=DEFAULT_QUERY_LENGTH, zipf_exponent=DEFAULT_ZIPF_EXPONENT,
+                     seed=DEFAULT_SEED):
+    """Return queries of words drawn from the same Zipf distribution as the corpus"""
+    generator = random.Random(seed + 1)
+    words, cumulative_weights = zipf_vocabulary(vocabulary_size, zipf_exponent)
+    return [
+        generator.choices(words, cum_weights=cumulative_weights, k=query_length)
+        for _ in range(query_count)
+    ]
+
+
+def max_rss_so_far_bytes() -> int:
+    """Peak resident set size of the whole process up to now, it never decreases between phases"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def percentiles(values: list) -> dict:
+    """Return selected percentiles of values"""
+    values = sorted(values)
+    return {
+        "p%d" % percent: values[min(len(values) - 1, len(values) * percent // 100)]
+        for percent in LATENCY_PERCENTILES
+    } if values else {}
+
+
+def timed(function, *args):
+    """Call function and return its result with elapsed seconds"""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def traced(function, *args):
+    """Call function and return its result with peak bytes allocated by Python during the call
+
+    Runs apart from timing because tracemalloc slows every allocation down.
+    """
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def memory_stats(peak_traced_bytes=None) -> dict:
+    """Memory measurements of a phase"""
+    stats = {"max_rss_so_far_bytes": max_rss_so_far_bytes()}
+    if peak_traced_bytes is not None:
+        stats["peak_traced_bytes"] = peak_traced_bytes
+    return stats
+
+
+def query_latencies(inverted_index, queries: list) -> list:
+    """Return elapsed seconds of every query"""
+    return [timed(inverted_index.query, list(query))[1] for query in queries]
+
+
+def benchmark_queries(inverted_index, queries: list, trace_memory=False) -> dict:
+    """Measure latency of every query and the overall throughput"""
+    latencies = query_latencies(inverted_index, queries)
+    peak_traced = traced(query_latencies, inverted_index, queries)[1] if trace_memory else None
+    total = sum(latencies)
+    return {
+        "queries": len(queries),
+        "seconds": total,
+        "queries_per_second": len(queries) / total if total else None,
+        "latency_seconds": percentiles(latencies),
+        **memory_stats(peak_traced),
+    }
+
+
+def measured(function, *args, trace_memory=False):
+    """Call function and return its result, elapsed seconds and, if asked, peak traced bytes
+
+    The traced call runs separately first and its result is dropped, so timings stay clean.
+    """
+    peak_traced = traced(function, *args)[1] if trace_memory else None
+    result, elapsed = timed(function, *args)
+    return result, elapsed, peak_traced
+
+
+def run_benchmark(dataset_path: str, queries: list, workdir: str, codec=DEFAULT_POSTING_CODEC,
+                  trace_memory=False) -> dict:
+    """Run every phase over the dataset and return measurements"""
+    results = {"codec": codec, "dataset_bytes": os.path.getsize(dataset_path)}
+    documents, elapsed, peak_traced = measured(load_documents, dataset_path, trace_memory=trace_memory)
+    results["load_documents"] = {
+        "documents": len(documents), "seconds": elapsed, **memory_stats(peak_traced),
+    }
+
+    inverted_index, elapsed, peak_traced = measured(
+        build_inverted_index, documents, set(), trace_memory=trace_memory,
+    )
+    posting_count = sum(len(postings) for postings in inverted_index.dict_index.values())
+    results["build"] = {
+        "terms": len(inverted_index.dict_index),
+        "postings": posting_count,
+        "seconds": elapsed,
+        "documents_per_second": len(documents) / elapsed if elapsed else None,
+        **memory_stats(peak_traced),
+    }
+
+    index_path = os.path.join(workdir, "benchmark.index")
+    _, elapsed, peak_traced = measured(inverted_index.dump, index_path, codec, trace_memory=trace_memory)
+    index_size = os.path.getsize(index_path)
+    results["dump"] = {
+        "seconds": elapsed,
+        "index_bytes": index_size,
+        "bytes_per_posting": index_size / posting_count if posting_count else None,
+        **memory_stats(peak_traced),
+    }
+
+    loaded_index, elapsed, peak_traced = measured(InvertedIndex.load, index_path, trace_memory=trace_memory)
+    results["load"] = {"seconds": elapsed, **memory_stats(peak_traced)}
+    results["query_loaded"] = benchmark_queries(loaded_index, queries, trace_memory)
+    del loaded_index
+
+    mapped_index, elapsed, peak_traced = measured(open_index, index_path, trace_memory=trace_memory)
+    results["open_mapped"] = {"seconds": elapsed, **memory_stats(peak_traced)}
+    results["query_mapped"] = benchmark_queries(mapped_index, queries, trace_memory)
+    if hasattr(mapped_index, "close"):
+        mapped_index.close()
+    return results
+
+
+def main():
+    """Generate synthetic corpus, run benchmark and save results as JSON"""
+    parser = ArgumentParser(
+        prog="inverted-index-benchmark",
+        description="benchmark build, dump, load and query of inverted index",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--documents", type=int, default=DEFAULT_DOCUMENT_COUNT,
+                        help="number of synthetic documents")
+    parser.add_argument("--vocabulary", type=int, default=DEFAULT_VOCABULARY_SIZE,
+                        help="number of distinct words in the corpus")
+    parser.add_argument("--document-length", dest="document_length", type=int,
+                        default=DEFAULT_DOCUMENT_LENGTH, help="mean number of words in a document")
+    parser.add_argument("--zipf-exponent", dest="zipf_exponent", type=float,
+                        default=DEFAULT_ZIPF_EXPONENT, help="exponent of Zipf word distribution")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERY_COUNT,
+                        help="number of queries to run")
+    parser.add_argument("--query-length", dest="query_length", type=int,
+                        default=DEFAULT_QUERY_LENGTH, help="number of words in a query")
+    parser.add_argument("--codec", choices=sorted(POSTING_CODECS), default=DEFAULT_POSTING_CODEC,
+                        help="posting list encoding")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="random seed")
+    parser.add_argument("--trace-memory", dest="trace_memory", action="store_true",
+                        help="run every phase once more under tracemalloc to report its own peak "
+                             "allocations; max_rss_so_far_bytes only grows over the run")
+    parser.add_argument("-o", "--output", default=DEFAULT_BENCHMARK_OUTPUT_PATH,
+                        help="path to save results in JSON")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="inverted_index_benchmark_") as workdir:
+        dataset_path = os.path.join(workdir, "dataset.txt")
+        generate_corpus(
+            dataset_path, arguments.documents, arguments.vocabulary,
+            arguments.document_length, arguments.zipf_exponent, arguments.seed,
+        )
+        queries = generate_queries(
+            arguments.queries, arguments.vocabulary, arguments.query_length,
+            arguments.zipf_exponent, arguments.seed,
+        )
+        results = run_benchmark(
+            dataset_path, queries, workdir, arguments.codec, arguments.trace_memory,
+        )
+    results["parameters"] = vars(arguments)
+    with open(arguments.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
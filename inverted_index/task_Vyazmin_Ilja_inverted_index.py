@@ -2,8 +2,31 @@
 """Module for work with inverted index"""
 import sys
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType, ArgumentTypeError
-from collections import defaultdict
-from io import TextIOWrapper
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BufferedReader, RawIOBase, TextIOWrapper
+from itertools import accumulate, chain, groupby, repeat
+from multiprocessing import Pool
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import signal
+import tempfile
+import threading
+import zlib
+from urllib.parse import parse_qs, urlparse
+import bz2
+import gzip
+import lzma
+import queue
 import struct
 import logging
 import logging.config
@@ -15,6 +38,98 @@ DEFAULT_DATASET_PATH = "./wikipedia_sample"
 DEFAULT_INVERTED_INDEX_STORE_PATH = "inverted.index"
 DEFAULT_STOP_WORDS_PATH = "./stop_words_en.txt"
 DEFAULT_LOGGING_CONFIG_FILE_PATH = "logging.conf.yml"
+DEFAULT_BUILD_WORKERS = 1
+SHARDS_PER_WORKER = 4
+SEGMENTS_MANIFEST_SUFFIX = ".segments"
+DEFAULT_SHARD_COUNT = 1
+SHARD_PARTITION_HASH = "hash"
+SHARD_PARTITION_MODULO = "modulo"
+SHARD_HASH_MULTIPLIER = 2654435761
+DEFAULT_TIER_FACTOR = 4
+DEFAULT_SERVER_HOST = "127.0.0.1"
+DEFAULT_SERVER_PORT = 8000
+DEFAULT_QUERY_CACHE_SIZE = 0
+DOC_STORE_SUFFIX = ".docs"
+DOC_STORE_BLOCK_SIZE = 2 ** 14
+DEFAULT_SNIPPET_LENGTH = 200
+STDIN_DATASET_PATH = "-"
+DATASET_CHUNK_SIZE = 2 ** 20
+DATASET_QUEUE_CHUNKS = 8
+DEFAULT_STATS_TOP_TERMS = 10
+# rough memory footprint of Python objects held by the streaming builder
+TERM_MEMORY_COST = 160
+POSTING_MEMORY_COST = 36
+MEMORY_SIZE_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+
+INDEX_MAGIC = b"INVX"
+INDEX_FORMAT_VERSION = 4
+# magic, format version, posting codec (reserved before version 3)
+INDEX_HEADER = struct.Struct("<4sHH")
+# section directory offset, section count, magic
+INDEX_FOOTER = struct.Struct("<QI4s")
+# section name, offset, length
+INDEX_SECTION_ENTRY = struct.Struct("<8sQQ")
+# term offset, term length, postings offset, postings length, document frequency
+INDEX_TERM_ENTRY = struct.Struct("<QIQQI")
+
+CODEC_RAW = 0
+CODEC_VBYTE = 1
+# every posting list starts with the byte of codec chosen for it
+CODEC_AUTO = 2
+CODEC_ROARING = 3
+POSTING_CODECS = {"raw": CODEC_RAW, "vbyte": CODEC_VBYTE, "auto": CODEC_AUTO}
+#: optional features of the index file and sections they are stored in
+INDEX_FEATURE_SECTIONS = (
+    ("ranked", "freqtab"), ("positions", "postab"), ("bloom", "bloom"),
+    ("ngram_index", "ngramtab"), ("reordered", "docmap"),
+)
+CODEC_NAMES = {CODEC_RAW: "raw", CODEC_VBYTE: "vbyte", CODEC_AUTO: "auto", CODEC_ROARING: "roaring"}
+DEFAULT_POSTING_CODEC = "auto"
+ROARING_MIN_POSTINGS = 255
+ROARING_ARRAY_MAX_CARDINALITY = 4096
+ROARING_BITMAP_BYTES = 2 ** 16 // 8
+# high 16 bits of document ids, container kind, cardinality minus one
+ROARING_CONTAINER = struct.Struct("<HBH")
+ROARING_ARRAY = 0
+ROARING_BITMAP = 1
+BOOLEAN_QUERY_TOKEN = re.compile(r'\(|\)|"[^"]*"|[^\s()"]+')
+BOOLEAN_OPERATORS = ("AND", "OR", "NOT")
+FUZZY_TERM = re.compile(r"^(.+)~(\d*)$")
+WILDCARD_CHARACTERS = re.compile(r"[*?\[]")
+DEFAULT_FUZZY_DISTANCE = 1
+MAX_TERM_EXPANSIONS = 10000
+NGRAM_SIZE = 3
+NGRAM_PADDING = "$"
+REORDER_SIGNATURE_LENGTH = 4
+DOC_STORE_MAGIC = b"INVD"
+#: document id, number of block, offset and length of text in the uncompressed block
+DOC_STORE_ENTRY = struct.Struct("<IIII")
+#: offset and length of compressed block
+DOC_STORE_BLOCK = struct.Struct("<QI")
+#: offsets and sizes of block table and document table
+DOC_STORE_FOOTER = struct.Struct("<QIQI4s")
+#: magic bytes of compressed dataset and the reader decompressing it
+DATASET_COMPRESSIONS = (
+    (b"\x1f\x8b", lambda dataset_file: gzip.GzipFile(fileobj=dataset_file)),
+    (b"BZh", bz2.BZ2File),
+    (b"\xfd7zXZ\x00", lzma.LZMAFile),
+)
+BLOOM_BITS_PER_TERM = 10
+BLOOM_HASH_COUNT = 7
+#: number of hash functions and number of bits of the filter
+BLOOM_HEADER = struct.Struct("<HQ")
+BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+MAX_DOC_ID = 2 ** 32 - 1
+# offset and length of term frequencies of the term
+INDEX_FREQ_ENTRY = struct.Struct("<QI")
+# offset and length of token positions of the term in every document
+INDEX_POSITIONS_ENTRY = INDEX_FREQ_ENTRY
+# k1, b, document count, average document length
+BM25_STATS = struct.Struct("<ddQd")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# keeps upper bounds above any score despite float rounding of the sums
+MAXSCORE_SLACK = 1 + 1e-9
 
 
 logger = logging.getLogger(APPLICATION_NAME)
@@ -42,11 +157,529 @@ class EncodedFileType(FileType):
             raise ArgumentTypeError(message % (string, exception)) from exception
 
 
+def galloping_search(postings, target: int, low: int = 0) -> int:
+    """Return position of the first posting not less than target starting from low"""
+    size = len(postings)
+    if low >= size or postings[low] >= target:
+        return low
+    bound = 1
+    while low + bound < size and postings[low + bound] < target:
+        bound *= 2
+    return bisect_left(postings, target, low + bound // 2 + 1, min(low + bound, size))
+
+
+def intersect_sorted(shorter, longer) -> list:
+    """Intersect two sorted posting lists galloping through the longer one"""
+    response = []
+    position = 0
+    longer_len = len(longer)
+    for doc_id in shorter:
+        position = galloping_search(longer, doc_id, position)
+        if position == longer_len:
+            break
+        if longer[position] == doc_id:
+            response.append(doc_id)
+            position += 1
+    return response
+
+
+def intersect_postings(posting_lists: list) -> list:
+    """Intersect sorted posting lists starting from the rarest one"""
+    if not posting_lists:
+        return []
+    posting_lists = sorted(posting_lists, key=len)
+    response = list(posting_lists[0])
+    for postings in posting_lists[1:]:
+        if not response:
+            break
+        response = intersect_sorted(response, postings)
+    return response
+
+
+def sort_postings(dict_index, *payloads):
+    """Sort posting lists by document id keeping aligned payloads in step"""
+    sorted_index = dict()
+    sorted_payloads = [dict() if payload is not None else None for payload in payloads]
+    for key, values in dict_index.items():
+        if all(values[number - 1] < values[number] for number in range(1, len(values))):
+            sorted_index[key] = list(values)
+            for payload, sorted_payload in zip(payloads, sorted_payloads):
+                if payload is not None:
+                    sorted_payload[key] = list(payload[key])
+            continue
+        order = sorted(range(len(values)), key=values.__getitem__)
+        sorted_index[key] = [values[number] for number in order]
+        for payload, sorted_payload in zip(payloads, sorted_payloads):
+            if payload is not None:
+                sorted_payload[key] = [payload[key][number] for number in order]
+    return (sorted_index, *sorted_payloads)
+
+
+def difference_sorted(postings, excluded) -> list:
+    """Return sorted postings which are not in sorted excluded list"""
+    response = []
+    position = 0
+    excluded_len = len(excluded)
+    for doc_id in postings:
+        position = galloping_search(excluded, doc_id, position)
+        if position == excluded_len or excluded[position] != doc_id:
+            response.append(doc_id)
+    return response
+
+
+def union_sorted(posting_lists) -> list:
+    """Merge sorted posting lists into one without duplicates"""
+    response = []
+    for doc_id in heapq.merge(*posting_lists):
+        if not response or response[-1] != doc_id:
+            response.append(doc_id)
+    return response
+
+
+def parse_boolean_query(text: str):
+    """Parse query with AND, OR, NOT, parentheses and quoted phrases
+
+    Words without operator between them are joined with AND. The result is
+    a tree of tuples: ("term", word), ("phrase", words), ("not", node),
+    ("and", nodes) and ("or", nodes).
+    """
+    tokens = BOOLEAN_QUERY_TOKEN.findall(text)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def parse_or():
+        nonlocal position
+        nodes = [parse_and()]
+        while peek() == "OR":
+            position += 1
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and():
+        nonlocal position
+        nodes = [parse_unary()]
+        while peek() is not None and peek() not in ("OR", ")"):
+            if peek() == "AND":
+                position += 1
+            nodes.append(parse_unary())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_unary():
+        nonlocal position
+        token = peek()
+        if token == "NOT":
+            position += 1
+            return ("not", parse_unary())
+        if token is None or token in BOOLEAN_OPERATORS or token == ")":
+            raise ValueError("unexpected %s in query %r" % (token or "end", text))
+        position += 1
+        if token == "(":
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError("missing closing parenthesis in query %r" % text)
+            position += 1
+            return node
+        if token.startswith('"'):
+            return ("phrase", token.strip('"').split())
+        return ("term", token)
+
+    node = parse_or()
+    if position != len(tokens):
+        raise ValueError("unexpected %s in query %r" % (tokens[position], text))
+    return node
+
+
+def estimate_query_cost(index, node) -> int:
+    """Estimate number of documents matching the query node"""
+    kind = node[0]
+    if kind == "term" and is_term_pattern(node[1]):
+        return sum(index.doc_freq(term) for term in expand_term(index, node[1]))
+    if kind == "term":
+        return index.doc_freq(node[1])
+    if kind == "phrase":
+        return min((index.doc_freq(word) for word in node[1] if word not in index.stop_words), default=0)
+    if kind == "and":
+        return min(
+            (estimate_query_cost(index, child) for child in node[1] if child[0] != "not"), default=0
+        )
+    if kind == "or":
+        return sum(estimate_query_cost(index, child) for child in node[1])
+    return estimate_query_cost(index, node[1])
+
+
+def evaluate_query_node(index, node, candidates=None) -> list:
+    """Return sorted documents matching the query node, only from candidates if given
+
+    Positive clauses of AND are evaluated from the cheapest one and every
+    next clause, including negated ones, only checks the documents left.
+    """
+    kind = node[0]
+    if kind == "term":
+        postings = term_postings(index, node[1])
+        if candidates is None:
+            return list(postings)
+        if len(candidates) <= len(postings):
+            return intersect_sorted(candidates, postings)
+        return intersect_sorted(postings, candidates)
+    if kind == "phrase":
+        return evaluate_phrase(index, node[1], candidates)
+    if kind == "or":
+        return union_sorted([evaluate_query_node(index, child, candidates) for child in node[1]])
+    if kind == "not":
+        raise ValueError("negation should be joined with AND to a positive clause")
+    positives = [child for child in node[1] if child[0] != "not"]
+    negatives = [child[1] for child in node[1] if child[0] == "not"]
+    if not positives:
+        raise ValueError("negation should be joined with AND to a positive clause")
+    response = candidates
+    for child in sorted(positives, key=lambda child: estimate_query_cost(index, child)):
+        response = evaluate_query_node(index, child, response)
+        if not response:
+            return []
+    for child in sorted(negatives, key=lambda child: estimate_query_cost(index, child)):
+        response = difference_sorted(response, evaluate_query_node(index, child, response))
+        if not response:
+            return []
+    return response
+
+
+def missing_feature_error(index, query_kind: str, feature: str, build_option: str) -> ValueError:
+    """Return error explaining why the index can not answer query needing the feature"""
+    if feature in getattr(index, "unloaded_features", ()):
+        return ValueError(
+            "%s query is not supported by index loaded with --compact, query it without --compact"
+            % query_kind
+        )
+    return ValueError("%s query needs index built with %s" % (query_kind, build_option))
+
+
+def evaluate_phrase(index, words: list, candidates=None) -> list:
+    """Return sorted documents containing the words one after another
+
+    Stop words of the phrase are skipped but keep their places.
+    """
+    phrase_terms = [(offset, word) for offset, word in enumerate(words) if word not in index.stop_words]
+    if not phrase_terms:
+        return []
+    if len(phrase_terms) == 1:
+        return evaluate_query_node(index, ("term", phrase_terms[0][1]), candidates)
+    if not index.positional:
+        raise missing_feature_error(index, "phrase", "positional", "--positions")
+    terms = [(offset, *index.term_positions(word)) for offset, word in phrase_terms]
+    terms.sort(key=lambda term: len(term[1]))
+    response = intersect_postings([postings for _, postings, _ in terms])
+    if candidates is not None:
+        response = intersect_sorted(response, candidates)
+    matched = []
+    cursors = [0] * len(terms)
+    for doc_id in response:
+        starts = None
+        for number, (offset, postings, positions) in enumerate(terms):
+            cursors[number] = galloping_search(postings, doc_id, cursors[number])
+            term_starts = {position - offset for position in positions[cursors[number]]}
+            starts = term_starts if starts is None else starts & term_starts
+            if not starts:
+                break
+        if starts:
+            matched.append(doc_id)
+    return matched
+
+
+def is_term_pattern(word: str) -> bool:
+    """Check whether the word is a wildcard pattern like pyth* or fuzzy term like pithon~"""
+    return WILDCARD_CHARACTERS.search(word) is not None or FUZZY_TERM.match(word) is not None
+
+
+def term_ngrams(term: str) -> set:
+    """Return character n-grams of the term padded on both sides"""
+    padding = NGRAM_PADDING * (NGRAM_SIZE - 1)
+    padded = padding + term + padding
+    return {padded[start:start + NGRAM_SIZE] for start in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+def edit_distance(word: str, another: str, limit: int) -> int:
+    """Return Levenshtein distance of words, or limit + 1 as soon as it exceeds the limit"""
+    if abs(len(word) - len(another)) > limit:
+        return limit + 1
+    previous = list(range(len(another) + 1))
+    for row, char in enumerate(word, start=1):
+        current = [row]
+        for column, another_char in enumerate(another, start=1):
+            current.append(min(
+                previous[column] + 1, current[column - 1] + 1,
+                previous[column - 1] + (char != another_char),
+            ))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class TermDictionary:
+    """Sorted terms of in-memory index with n-grams built on first fuzzy lookup"""
+    def __init__(self, terms):
+        self.terms = sorted(terms)
+        self._ngrams = None
+
+    def expand_prefix(self, prefix: str):
+        """Iterate over terms starting with the prefix in sorted order"""
+        for number in range(bisect_left(self.terms, prefix), len(self.terms)):
+            if not self.terms[number].startswith(prefix):
+                break
+            yield self.terms[number]
+
+    def term_by_number(self, number: int) -> str:
+        """Return term by its number in sorted order"""
+        return self.terms[number]
+
+    def ngram_term_numbers(self, gram: str) -> list:
+        """Return numbers of terms containing the n-gram"""
+        if self._ngrams is None:
+            self._ngrams = defaultdict(list)
+            for number, term in enumerate(self.terms):
+                for term_gram in term_ngrams(term):
+                    self._ngrams[term_gram].append(number)
+        return self._ngrams.get(gram, [])
+
+
+def fuzzy_terms(index, word: str, distance: int) -> list:
+    """Return terms of the index within edit distance from the word
+
+    Candidates share enough n-grams with the word, since every edit
+    destroys at most NGRAM_SIZE of them, and are verified exactly. A word
+    too short to keep a shared n-gram after the edits would need a scan
+    of the whole vocabulary and is rejected.
+    """
+    grams = term_ngrams(word)
+    min_shared = len(grams) - NGRAM_SIZE * distance
+    if min_shared <= 0:
+        raise ValueError("%r is too short for edit distance %d" % (word, distance))
+    shared = Counter()
+    for gram in grams:
+        shared.update(index.ngram_term_numbers(gram))
+    candidates = [
+        index.term_by_number(number) for number, count in shared.items() if count >= min_shared
+    ]
+    return sorted(term for term in candidates if edit_distance(word, term, distance) <= distance)
+
+
+def expand_term(index, word: str) -> list:
+    """Return terms of the index matching wildcard pattern or fuzzy term"""
+    fuzzy_match = FUZZY_TERM.match(word)
+    if fuzzy_match is not None:
+        distance = int(fuzzy_match.group(2) or DEFAULT_FUZZY_DISTANCE)
+        terms = fuzzy_terms(index, fuzzy_match.group(1), distance)
+    else:
+        prefix = WILDCARD_CHARACTERS.split(word, maxsplit=1)[0]
+        terms = index.expand_prefix(prefix)
+        if word != prefix + "*":
+            terms = (term for term in terms if fnmatchcase(term, word))
+        terms = list(terms)
+    if len(terms) > MAX_TERM_EXPANSIONS:
+        raise ValueError("%r matches more than %d terms" % (word, MAX_TERM_EXPANSIONS))
+    return terms
+
+
+def term_postings(index, word: str):
+    """Return posting list of the term, or union of posting lists of terms matching pattern"""
+    if not is_term_pattern(word):
+        return index.postings(word)
+    return union_sorted([index.postings(term) for term in expand_term(index, word)])
+
+
+def query_patterns(index, words: list) -> list:
+    """Return documents containing all words, where a word may be a pattern of terms"""
+    posting_lists = []
+    for word in set(words):
+        postings = term_postings(index, word)
+        if not postings:
+            return []
+        posting_lists.append(postings)
+    return intersect_postings(posting_lists)
+
+
+def minhash_signature(terms: list, signature_length: int = REORDER_SIGNATURE_LENGTH) -> tuple:
+    """Return minimums of differently seeded hashes over terms given in bytes"""
+    if not terms:
+        return ()
+    return tuple(
+        min(zlib.crc32(term_bin, seed) for term_bin in terms) for seed in range(signature_length)
+    )
+
+
+def reorder_documents(documents: dict, stop_words) -> list:
+    """Return ids of documents ordered so that documents sharing terms are close
+
+    Documents are sorted by MinHash signatures of their terms, documents
+    with similar sets of terms likely have equal leading minimums.
+    """
+    logger.info("reorder %d documents", len(documents))
+    signatures = {
+        idx: minhash_signature([word.encode() for word in set(documents[idx].split()) - stop_words])
+        for idx in documents
+    }
+    return sorted(documents, key=lambda idx: (signatures[idx], idx))
+
+
+def restore_doc_ids(docmap, doc_ids) -> list:
+    """Translate renumbered ids of documents back to the original sorted ids"""
+    if docmap is None:
+        return doc_ids
+    return sorted(docmap[doc_id] for doc_id in doc_ids)
+
+
+class Bm25:
+    """Okapi BM25 scoring with statistics of the whole index"""
+    def __init__(self, doc_count: int, avg_doc_length: float, k1: float = BM25_K1, b: float = BM25_B):
+        self.doc_count = doc_count
+        self.avg_doc_length = avg_doc_length or 1.0
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def from_doc_lengths(cls, doc_lengths: dict):
+        """Collect statistics from lengths of all documents"""
+        return cls.from_collection_stats(len(doc_lengths), sum(doc_lengths.values()))
+
+    @classmethod
+    def from_collection_stats(cls, doc_count: int, total_doc_length: int):
+        """Create scorer from number and total length of documents"""
+        return cls(doc_count, total_doc_length / doc_count if doc_count else 0.0)
+
+    def idf(self, doc_freq: int) -> float:
+        """Inverse document frequency of a term"""
+        return math.log(1 + (self.doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def score(self, freq: int, doc_length: int, idf: float) -> float:
+        """Score of a term occurring freq times in the document"""
+        norm = self.k1 * (1 - self.b + self.b * doc_length / self.avg_doc_length)
+        return idf * freq * (self.k1 + 1) / (freq + norm)
+
+    def upper_bound(self, postings, freqs, doc_lengths) -> float:
+        """Maximal score of the term over all documents containing it"""
+        idf = self.idf(len(postings))
+        max_score = max(
+            (self.score(freq, doc_lengths[doc_id], idf) for doc_id, freq in zip(postings, freqs)),
+            default=0.0,
+        )
+        return max_score * MAXSCORE_SLACK
+
+    def max_score(self, idf: float) -> float:
+        """Score bound of a term in any document whatever its frequency and length"""
+        return idf * (self.k1 + 1)
+
+
+def ranked_term(postings, freqs, doc_freq: int, scorer: Bm25, upper_bound=None, skip=None, docmap=None):
+    """Return tuple of postings, frequencies, idf and score bound of a term for top_k_maxscore
+
+    Without upper bound computed by the same scorer the bound for any
+    document is used. Postings of documents whose original ids are
+    rejected by skip are left out.
+    """
+    if skip is not None:
+        kept = [
+            number for number, doc_id in enumerate(postings)
+            if not skip(docmap[doc_id] if docmap is not None else doc_id)
+        ]
+        if len(kept) < len(postings):
+            postings = [postings[number] for number in kept]
+            freqs = [freqs[number] for number in kept]
+    idf = scorer.idf(doc_freq)
+    return postings, freqs, idf, upper_bound if upper_bound is not None else scorer.max_score(idf)
+
+
+def top_k_maxscore(terms: list, top_k: int, scorer: Bm25, doc_length) -> list:
+    """Return top_k pairs of document id and score using MaxScore pruning
+
+    Every term is a tuple of sorted postings, term frequencies, idf and
+    score upper bound. Terms whose upper bounds together can not beat the
+    current top_k threshold are only probed for candidates found in the
+    other terms.
+    """
+    if top_k <= 0:
+        return []
+    terms = sorted(terms, key=lambda term: term[3])
+    bound_sums = list(accumulate(term[3] for term in terms))
+    positions = [0] * len(terms)
+    top = []
+    threshold = 0.0
+    first_essential = 0
+    while True:
+        candidate = None
+        for number in range(first_essential, len(terms)):
+            postings = terms[number][0]
+            position = positions[number]
+            if position < len(postings) and (candidate is None or postings[position] < candidate):
+                candidate = postings[position]
+        if candidate is None:
+            break
+        length = doc_length(candidate)
+        score = 0.0
+        for number in range(first_essential, len(terms)):
+            postings, freqs, idf, _ = terms[number]
+            position = positions[number]
+            if position < len(postings) and postings[position] == candidate:
+                score += scorer.score(freqs[position], length, idf)
+                positions[number] = position + 1
+        for number in range(first_essential - 1, -1, -1):
+            if score + bound_sums[number] <= threshold:
+                break
+            postings, freqs, idf, _ = terms[number]
+            position = galloping_search(postings, candidate, positions[number])
+            positions[number] = position
+            if position < len(postings) and postings[position] == candidate:
+                score += scorer.score(freqs[position], length, idf)
+        if len(top) < top_k:
+            heapq.heappush(top, (score, -candidate))
+        elif score > top[0][0]:
+            heapq.heapreplace(top, (score, -candidate))
+        else:
+            continue
+        if len(top) == top_k:
+            threshold = top[0][0]
+            while first_essential < len(terms) and bound_sums[first_essential] <= threshold:
+                first_essential += 1
+    return [(-negative_id, score) for score, negative_id in sorted(top, reverse=True)]
+
 
 class InvertedIndex:
     """Class for work with inverted index"""
-    def __init__(self, dict_index=None):
+    def __init__(self, dict_index=None, term_freqs=None, doc_lengths=None,
+                 positions=None, stop_words=None, docmap=None):
+        if dict_index is not None:
+            dict_index, term_freqs, positions = sort_postings(dict_index, term_freqs, positions)
         self.dict_index = dict_index
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.positions = positions
+        self.stop_words = stop_words if stop_words is not None else set()
+        self._upper_bounds = dict()
+        self._term_dictionary = None
+        self.docmap = docmap
+
+    @property
+    def ranked(self) -> bool:
+        """Whether term frequencies and document lengths are stored"""
+        return self.term_freqs is not None
+
+    @property
+    def positional(self) -> bool:
+        """Whether positions of terms in documents are stored"""
+        return self.positions is not None
+
+    def postings(self, term: str) -> list:
+        """Return posting list of the term, empty if there is no such term"""
+        return self.dict_index.get(term, [])
+
+    def doc_freq(self, term: str) -> int:
+        """Return number of documents containing the term"""
+        return len(self.dict_index.get(term, []))
+
+    def term_positions(self, term: str):
+        """Return posting list of the term and positions of the term in every document"""
+        return self.dict_index.get(term, []), self.positions.get(term, [])
 
     def __eq__(self, another):
         for key in self.dict_index:
@@ -64,67 +697,112 @@ class InvertedIndex:
             "query should be provided with a list of words"
         )
         logger.debug("query inverted index with request %s", repr(words))
-        response = set(self.dict_index.get(words[0], set()))
-        words.pop(0)
-        for word in words:
-            next_doc = set(self.dict_index.get(word, set()))
-            response = response & next_doc
-        return list(response)
+        if any(is_term_pattern(word) for word in words):
+            return restore_doc_ids(self.docmap, query_patterns(self, words))
+        posting_lists = []
+        for word in set(words):
+            postings = self.dict_index.get(word)
+            if not postings:
+                return []
+            posting_lists.append(postings)
+        return restore_doc_ids(self.docmap, intersect_postings(posting_lists))
+
+    def expand_prefix(self, prefix: str):
+        """Iterate over terms starting with the prefix in sorted order"""
+        return self._dictionary().expand_prefix(prefix)
+
+    def term_by_number(self, number: int) -> str:
+        """Return term by its number in sorted order"""
+        return self._dictionary().term_by_number(number)
+
+    def ngram_term_numbers(self, gram: str) -> list:
+        """Return numbers of terms containing the n-gram"""
+        return self._dictionary().ngram_term_numbers(gram)
+
+    def _dictionary(self) -> TermDictionary:
+        if self._term_dictionary is None:
+            self._term_dictionary = TermDictionary(self.dict_index)
+        return self._term_dictionary
+
+    def collection_stats(self):
+        """Return number and total length of documents for BM25"""
+        return len(self.doc_lengths), sum(self.doc_lengths.values())
 
+    def query_ranked(self, words: list, top_k: int, scorer=None, doc_freqs=None, skip=None) -> list:
+        """Return top_k pairs of document id and BM25 score for the given words
 
-    def dump(self, filepath: str):
+        Index being a part of a larger collection is scored with the scorer
+        and document frequencies of the collection, documents whose ids are
+        rejected by skip are left out.
+        """
+        logger.debug("ranked query inverted index with request %s", repr(words))
+        own_scorer = Bm25.from_doc_lengths(self.doc_lengths)
+        terms = []
+        for word in set(words):
+            postings = self.dict_index.get(word)
+            if not postings:
+                continue
+            freqs = self.term_freqs[word]
+            upper_bound = None
+            if scorer is None:
+                if word not in self._upper_bounds:
+                    self._upper_bounds[word] = own_scorer.upper_bound(postings, freqs, self.doc_lengths)
+                upper_bound = self._upper_bounds[word]
+            doc_freq = doc_freqs[word] if doc_freqs is not None else len(postings)
+            terms.append(ranked_term(
+                postings, freqs, doc_freq, scorer or own_scorer, upper_bound, skip, self.docmap
+            ))
+        top = top_k_maxscore(terms, top_k, scorer or own_scorer, self.doc_lengths.__getitem__)
+        if self.docmap is not None:
+            top = [(self.docmap[doc_id], score) for doc_id, score in top]
+        return top
+
+    def query_boolean(self, text: str) -> list:
+        """Return the list of documents matching boolean query with phrases"""
+        logger.debug("boolean query inverted index with request %s", repr(text))
+        return restore_doc_ids(self.docmap, evaluate_query_node(self, parse_boolean_query(text)))
+
+    def items(self):
+        """Iterate over pairs of term and its posting list in sorted order"""
+        for key in sorted(self.dict_index):
+            yield key, self.dict_index[key]
+
+    def dump(self, filepath: str, codec: str = DEFAULT_POSTING_CODEC, ngram_index=False):
         """Save inverted index in binary format into hard drive"""
-        dict_index_small = dict()
-        dict_index_large = dict()
-        for key in self.dict_index:
-            if len(self.dict_index[key]) < 255:
-                dict_index_small[key] = self.dict_index[key]
-            else:
-                dict_index_large[key] = self.dict_index[key]
-        with open(filepath, 'wb') as dump_file:
-            dict_len = len(dict_index_small)
-            dict_len_pack = struct.pack('>i', dict_len)
-            dump_file.write(dict_len_pack)
-
-            for key in dict_index_small:
-                key_bin = key.encode()
-                key_len = len(key_bin)
-                key_len_pack = struct.pack('>B', key_len)
-                dump_file.write(key_len_pack)
-                key_pack = struct.pack('>' + str(key_len) + 's', key_bin)
-                dump_file.write(key_pack)
-
-                values = dict_index_small[key]
-                list_len = len(values)
-                list_len_pack = struct.pack('>B', list_len)
-                dump_file.write(list_len_pack)
-                values_pack = struct.pack('>' + str(list_len) + 'H', *values)
-                dump_file.write(values_pack)
-
-            dict_len = len(dict_index_large)
-            dict_len_pack = struct.pack('>i', dict_len)
-            dump_file.write(dict_len_pack)
-
-            for key in dict_index_large:
-                key_bin = key.encode()
-                key_len = len(key_bin)
-                key_len_pack = struct.pack('>B', key_len)
-                dump_file.write(key_len_pack)
-                key_pack = struct.pack('>' + str(key_len) + 's', key_bin)
-                dump_file.write(key_pack)
-
-                values = dict_index_large[key]
-                list_len = len(values)
-                list_len_pack = struct.pack('>H', list_len)
-                dump_file.write(list_len_pack)
-                values_pack = struct.pack('>' + str(list_len) + 'H', *values)
-                dump_file.write(values_pack)
+        with IndexWriter(filepath, codec, doc_lengths=self.doc_lengths,
+                         positional=self.positional, stop_words=self.stop_words,
+                         ngram_index=ngram_index, docmap=self.docmap) as writer:
+            for key, values in self.items():
+                writer.add(
+                    key, values,
+                    freqs=self.term_freqs[key] if self.ranked else None,
+                    positions=self.positions[key] if self.positional else None,
+                )
 
 
     @classmethod
     def load(cls, filepath: str):
         """Load inverted from binary file"""
         logger.info("load inverted index %s", filepath)
+        if not is_mapped_index(filepath):
+            return cls._load_legacy(filepath)
+        with MappedInvertedIndex(filepath) as mapped_index:
+            dict_index = dict(mapped_index.items())
+            term_freqs = None
+            doc_lengths = None
+            positions = None
+            if mapped_index.ranked:
+                term_freqs = dict(mapped_index.freq_items())
+                doc_lengths = mapped_index.doc_lengths()
+            if mapped_index.positional:
+                positions = dict(mapped_index.position_items())
+            stop_words = mapped_index.stop_words
+            docmap = mapped_index.docmap
+        return cls(dict_index, term_freqs, doc_lengths, positions, stop_words, docmap)
+
+    @classmethod
+    def _load_legacy(cls, filepath: str):
+        """Load inverted index stored in the format without header"""
         with open(filepath, 'rb') as load_file:
             dict_len = load_file.read(4)
             dict_len = struct.unpack('>i', dict_len)[0]
@@ -137,45 +815,1632 @@ class InvertedIndex:
                 key = struct.unpack(pack_format, key)[0]
                 key = key.decode()
 
-                list_len = load_file.read(1)
-                list_len = struct.unpack('>B', list_len)[0]
-                values = load_file.read(list_len * 2)
-                pack_format = '>' + str(list_len) + 'H'
-                values = struct.unpack(pack_format, values)
-                values = list(values)
-                dict_index[key] = values
+                list_len = load_file.read(1)
+                list_len = struct.unpack('>B', list_len)[0]
+                values = load_file.read(list_len * 2)
+                pack_format = '>' + str(list_len) + 'H'
+                values = struct.unpack(pack_format, values)
+                values = list(values)
+                dict_index[key] = values
+
+            dict_len = load_file.read(4)
+            dict_len = struct.unpack('>i', dict_len)[0]
+            for _ in range(dict_len):
+                key_len = load_file.read(1)
+                key_len = struct.unpack('>B', key_len)[0]
+                pack_format = '>' + str(key_len) + 's'
+                key = load_file.read(key_len)
+                key = struct.unpack(pack_format, key)[0]
+                key = key.decode()
+
+                list_len = load_file.read(2)
+                list_len = struct.unpack('>H', list_len)[0]
+                values = load_file.read(list_len * 2)
+                pack_format = '>' + str(list_len) + 'H'
+                values = struct.unpack(pack_format, values)
+                values = list(values)
+                dict_index[key] = values
+            inverted_index = cls(dict_index)
+        return inverted_index
+
+
+
+def encode_varints(numbers) -> bytearray:
+    """Encode non-negative integers with variable-byte encoding"""
+    encoded = bytearray()
+    for number in numbers:
+        while number >= 0x80:
+            encoded.append(number & 0x7F | 0x80)
+            number >>= 7
+        encoded.append(number)
+    return encoded
+
+
+def decode_varints(data) -> list:
+    """Decode integers stored with variable-byte encoding"""
+    numbers = []
+    number = 0
+    shift = 0
+    for byte in data:
+        number |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(number)
+            number = 0
+            shift = 0
+    return numbers
+
+
+def encode_positions(position_lists) -> bytes:
+    """Encode sorted token positions of a term in every document of its posting list"""
+    encoded = bytearray()
+    for positions in position_lists:
+        encoded += encode_varints([len(positions)])
+        encoded += encode_varints(
+            position - previous for previous, position in zip([0] + positions, positions)
+        )
+    return bytes(encoded)
+
+
+def decode_positions(data) -> list:
+    """Decode token positions stored with encode_positions"""
+    numbers = decode_varints(data)
+    position_lists = []
+    number = 0
+    while number < len(numbers):
+        count = numbers[number]
+        positions = numbers[number + 1:number + 1 + count]
+        for position_number in range(1, count):
+            positions[position_number] += positions[position_number - 1]
+        position_lists.append(positions)
+        number += count + 1
+    return position_lists
+
+
+def encode_postings(postings: list, codec: int) -> bytes:
+    """Encode sorted posting list with the given codec"""
+    if postings and (postings[0] < 0 or postings[-1] > MAX_DOC_ID):
+        raise ValueError("document ids should fit into 32 bits")
+    if codec == CODEC_RAW:
+        return struct.pack('<' + str(len(postings)) + 'I', *postings)
+    if codec == CODEC_ROARING:
+        return RoaringBitmap.from_sorted(postings).to_bytes()
+    if codec == CODEC_AUTO:
+        values_pack = bytes([CODEC_VBYTE]) + encode_postings(postings, CODEC_VBYTE)
+        if len(postings) >= ROARING_MIN_POSTINGS:
+            roaring_pack = bytes([CODEC_ROARING]) + encode_postings(postings, CODEC_ROARING)
+            if len(roaring_pack) < len(values_pack):
+                return roaring_pack
+        return values_pack
+    gaps = [postings[0]] if postings else []
+    gaps.extend(postings[number] - postings[number - 1] for number in range(1, len(postings)))
+    if gaps and min(gaps) < 0:
+        raise ValueError("posting list should be sorted")
+    return bytes(encode_varints(gaps))
+
+
+def decode_postings(buffer, offset: int, length: int, list_len: int, codec: int) -> list:
+    """Decode posting list stored with the given codec"""
+    if codec == CODEC_RAW:
+        return list(struct.unpack_from('<' + str(list_len) + 'I', buffer, offset))
+    if codec == CODEC_ROARING:
+        return RoaringBitmap.from_buffer(buffer, offset).to_list()
+    if codec == CODEC_AUTO:
+        return decode_postings(buffer, offset + 1, length - 1, list_len, buffer[offset])
+    postings = decode_varints(buffer[offset:offset + length])
+    for number in range(1, len(postings)):
+        postings[number] += postings[number - 1]
+    return postings
+
+
+class RoaringBitmap:
+    """Compressed bitmap of document ids split by high 16 bits into containers
+
+    Sparse containers are sorted arrays of low 16 bits, dense ones are
+    plain bitmaps of 8 KiB.
+    """
+    def __init__(self, containers=None):
+        self.containers = containers if containers is not None else dict()
+
+    @classmethod
+    def from_sorted(cls, postings):
+        """Build bitmap from sorted document ids"""
+        containers = dict()
+        for key, group in groupby(postings, key=lambda doc_id: doc_id >> 16):
+            low_bits = array('H', (doc_id & 0xFFFF for doc_id in group))
+            if len(low_bits) <= ROARING_ARRAY_MAX_CARDINALITY:
+                containers[key] = low_bits
+            else:
+                bitmap = bytearray(ROARING_BITMAP_BYTES)
+                for low in low_bits:
+                    bitmap[low >> 3] |= 1 << (low & 7)
+                containers[key] = bytes(bitmap)
+        return cls(containers)
+
+    @classmethod
+    def from_buffer(cls, buffer, offset: int):
+        """Read bitmap serialized with to_bytes"""
+        container_count, offset = read_varint(buffer, offset)
+        containers = dict()
+        for _ in range(container_count):
+            key, kind, cardinality = ROARING_CONTAINER.unpack_from(buffer, offset)
+            offset += ROARING_CONTAINER.size
+            if kind == ROARING_BITMAP:
+                containers[key] = bytes(buffer[offset:offset + ROARING_BITMAP_BYTES])
+                offset += ROARING_BITMAP_BYTES
+            else:
+                low_bits = array('H', buffer[offset:offset + (cardinality + 1) * 2])
+                if sys.byteorder == "big":
+                    low_bits.byteswap()
+                containers[key] = low_bits
+                offset += (cardinality + 1) * 2
+        return cls(containers)
+
+    def to_bytes(self) -> bytes:
+        """Serialize bitmap, containers are written in order of their keys"""
+        encoded = encode_varints([len(self.containers)])
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            if isinstance(container, bytes):
+                encoded += ROARING_CONTAINER.pack(key, ROARING_BITMAP, _cardinality(container) - 1)
+                encoded += container
+            else:
+                encoded += ROARING_CONTAINER.pack(key, ROARING_ARRAY, len(container) - 1)
+                low_bits = array('H', container)
+                if sys.byteorder == "big":
+                    low_bits.byteswap()
+                encoded += low_bits.tobytes()
+        return bytes(encoded)
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def __contains__(self, doc_id):
+        container = self.containers.get(doc_id >> 16)
+        if container is None:
+            return False
+        low = doc_id & 0xFFFF
+        if isinstance(container, bytes):
+            return bool(container[low >> 3] >> (low & 7) & 1)
+        position = bisect_left(container, low)
+        return position < len(container) and container[position] == low
+
+    def __and__(self, another):
+        containers = dict()
+        for key in self.containers.keys() & another.containers.keys():
+            container = _intersect_containers(self.containers[key], another.containers[key])
+            if container:
+                containers[key] = container
+        return RoaringBitmap(containers)
+
+    def filter(self, postings) -> list:
+        """Return sorted document ids from postings which are in the bitmap"""
+        return [doc_id for doc_id in postings if doc_id in self]
+
+    def to_list(self) -> list:
+        """Return sorted document ids stored in the bitmap"""
+        postings = []
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            base = key << 16
+            if isinstance(container, bytes):
+                for byte_number, byte in enumerate(container):
+                    if byte:
+                        byte_base = base | byte_number << 3
+                        postings.extend(byte_base | bit for bit in BYTE_BITS[byte])
+            else:
+                postings.extend(base | low for low in container)
+        return postings
+
+
+def _cardinality(container) -> int:
+    """Return number of postings in a bitmap or array container"""
+    if isinstance(container, bytes):
+        return bin(int.from_bytes(container, "little")).count("1")
+    return len(container)
+
+
+def _intersect_containers(container, another):
+    """Intersect two roaring containers of the same key"""
+    if isinstance(container, bytes) and isinstance(another, bytes):
+        bitmap = int.from_bytes(container, "little") & int.from_bytes(another, "little")
+        return bitmap.to_bytes(ROARING_BITMAP_BYTES, "little") if bitmap else b""
+    if isinstance(container, bytes):
+        container, another = another, container
+    if isinstance(another, bytes):
+        return array('H', (
+            low for low in container if another[low >> 3] >> (low & 7) & 1
+        ))
+    return array('H', intersect_sorted(container, another))
+
+
+class BloomFilter:
+    """Bloom filter over terms stored in a bit array
+
+    Bit positions are derived by double hashing of a single blake2b digest.
+    The bits may be a slice of the memory mapped index file.
+    """
+    def __init__(self, bits, bit_count: int, hash_count: int = BLOOM_HASH_COUNT, offset: int = 0):
+        self.bits = bits
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.offset = offset
+
+    @classmethod
+    def from_terms(cls, terms: list, bits_per_term: int = BLOOM_BITS_PER_TERM):
+        """Build filter of terms given in bytes"""
+        bit_count = max(len(terms) * bits_per_term, 8)
+        bloom = cls(bytearray(-(-bit_count // 8)), bit_count)
+        for term_bin in terms:
+            for bit in bloom._bit_positions(term_bin):
+                bloom.bits[bit >> 3] |= 1 << (bit & 7)
+        return bloom
+
+    @classmethod
+    def from_buffer(cls, buffer, offset: int):
+        """Read filter header and refer to its bits inside the buffer"""
+        hash_count, bit_count = BLOOM_HEADER.unpack_from(buffer, offset)
+        return cls(buffer, bit_count, hash_count, offset + BLOOM_HEADER.size)
+
+    def to_bytes(self) -> bytes:
+        """Serialize filter header followed by its bits"""
+        return BLOOM_HEADER.pack(self.hash_count, self.bit_count) + bytes(self.bits)
+
+    def _bit_positions(self, term_bin: bytes):
+        digest = hashlib.blake2b(term_bin, digest_size=16).digest()
+        first_hash = int.from_bytes(digest[:8], "little")
+        second_hash = int.from_bytes(digest[8:], "little") | 1
+        for number in range(self.hash_count):
+            yield (first_hash + number * second_hash) % self.bit_count
+
+    def __contains__(self, term):
+        term_bin = term.encode() if isinstance(term, str) else term
+        for bit in self._bit_positions(term_bin):
+            if not self.bits[self.offset + (bit >> 3)] >> (bit & 7) & 1:
+                return False
+        return True
+
+
+class IndexWriter:
+    """Streaming writer of the memory-mapped inverted index format
+
+    Terms should be added in sorted order. The index is written into a
+    temporary file which replaces filepath on close, so processes that
+    have the old index mapped keep reading it. The file layout is a header,
+    the posting area, the sorted term dictionary, the term table with
+    offsets of posting lists, Bloom filter of terms, optional extra
+    sections, the section directory and a footer pointing to the directory.
+    Index of n-grams maps every n-gram to numbers of terms containing it.
+    Renumbered index keeps original id of every document in docmap.
+    """
+    def __init__(self, filepath: str, codec: str = DEFAULT_POSTING_CODEC, doc_lengths=None,
+                 positional=False, stop_words=(), ngram_index=False, docmap=None):
+        self.filepath = filepath
+        self.codec = POSTING_CODECS[codec]
+        self._temp_path = str(filepath) + ".tmp"
+        self._file = open(self._temp_path, 'wb')
+        self._file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_FORMAT_VERSION, self.codec))
+        self._terms = bytearray()
+        self._table = bytearray()
+        self._term_offsets = []
+        self._sections = []
+        self._pending_sections = []
+        self._last_term = None
+        self.doc_lengths = doc_lengths
+        self._scorer = Bm25.from_doc_lengths(doc_lengths) if doc_lengths is not None else None
+        self._freq_table = bytearray()
+        self._upper_bounds = []
+        self.positional = positional
+        self.stop_words = stop_words
+        self._positions_table = bytearray()
+        self.ngram_index = ngram_index
+        self.docmap = docmap
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def abort(self):
+        """Remove the temporary file keeping the index at filepath untouched"""
+        if not self._file.closed:
+            self._file.close()
+            os.remove(self._temp_path)
+
+    def add(self, term: str, postings: list, freqs=None, positions=None):
+        """Write posting list of the term, postings should be sorted
+
+        Ranked index, created with doc_lengths, also needs term frequency
+        for every posting and positional index needs positions of the term
+        in every document.
+        """
+        term_bin = term.encode()
+        if self._last_term is not None and term_bin <= self._last_term:
+            raise ValueError("terms should be added in sorted order, got %r" % term)
+        self._last_term = term_bin
+        values_pack = encode_postings(postings, self.codec)
+        postings_offset = self._file.tell()
+        self._file.write(values_pack)
+        self._table += INDEX_TERM_ENTRY.pack(
+            len(self._terms), len(term_bin), postings_offset, len(values_pack), len(postings)
+        )
+        self._term_offsets.append(len(self._terms))
+        self._terms += term_bin
+        if self.positional:
+            if positions is None or len(positions) != len(postings):
+                raise ValueError("positional index needs positions for every posting of %r" % term)
+            positions_pack = encode_positions(positions)
+            self._positions_table += INDEX_POSITIONS_ENTRY.pack(self._file.tell(), len(positions_pack))
+            self._file.write(positions_pack)
+        if self._scorer is None:
+            return
+        if freqs is None or len(freqs) != len(postings):
+            raise ValueError("ranked index needs term frequency for every posting of %r" % term)
+        freqs_pack = bytes(encode_varints(freqs))
+        self._freq_table += INDEX_FREQ_ENTRY.pack(self._file.tell(), len(freqs_pack))
+        self._file.write(freqs_pack)
+        self._upper_bounds.append(self._scorer.upper_bound(postings, freqs, self.doc_lengths))
+
+    def add_section(self, name: str, data: bytes):
+        """Add named section written after the term dictionary on close"""
+        self._pending_sections.append((name, data))
+
+    def _write_section(self, name: str, data: bytes):
+        self._sections.append((name, self._file.tell(), len(data)))
+        self._file.write(data)
+
+    def _write_ngram_index(self, terms: list):
+        """Write n-grams with their lists of term numbers like terms with posting lists"""
+        ngrams = defaultdict(list)
+        for number, term_bin in enumerate(terms):
+            for gram in term_ngrams(term_bin.decode()):
+                ngrams[gram.encode()].append(number)
+        ngram_lists_offset = self._file.tell()
+        ngram_lists = bytearray()
+        ngram_dictionary = bytearray()
+        ngram_table = bytearray()
+        for gram_bin in sorted(ngrams):
+            numbers_pack = encode_postings(ngrams[gram_bin], CODEC_VBYTE)
+            ngram_table += INDEX_TERM_ENTRY.pack(
+                len(ngram_dictionary), len(gram_bin), ngram_lists_offset + len(ngram_lists),
+                len(numbers_pack), len(ngrams[gram_bin]),
+            )
+            ngram_dictionary += gram_bin
+            ngram_lists += numbers_pack
+        self._write_section("ngrams", bytes(ngram_lists))
+        self._write_section("ngramdic", bytes(ngram_dictionary))
+        self._write_section("ngramtab", bytes(ngram_table))
+
+    def close(self):
+        """Write term dictionary, section directory and footer"""
+        if self._file.closed:
+            return
+        postings_length = self._file.tell() - INDEX_HEADER.size
+        self._sections.append(("postings", INDEX_HEADER.size, postings_length))
+        self._write_section("terms", bytes(self._terms))
+        self._write_section("table", bytes(self._table))
+        term_ends = self._term_offsets[1:] + [len(self._terms)]
+        terms = [bytes(self._terms[start:end]) for start, end in zip(self._term_offsets, term_ends)]
+        self._write_section("bloom", BloomFilter.from_terms(terms).to_bytes())
+        if self.ngram_index:
+            self._write_ngram_index(terms)
+        if self.docmap is not None:
+            self._write_section("docmap", struct.pack('<' + str(len(self.docmap)) + 'I', *self.docmap))
+        if self.positional:
+            self._write_section("postab", bytes(self._positions_table))
+            self._write_section("stopword", "\n".join(sorted(self.stop_words)).encode())
+        if self._scorer is not None:
+            doc_ids = sorted(self.doc_lengths)
+            self._write_section("freqtab", bytes(self._freq_table))
+            self._write_section("maxscore", struct.pack(
+                '<' + str(len(self._upper_bounds)) + 'd', *self._upper_bounds
+            ))
+            self._write_section("bm25", BM25_STATS.pack(
+                self._scorer.k1, self._scorer.b, self._scorer.doc_count, self._scorer.avg_doc_length
+            ))
+            self._write_section("docids", encode_postings(doc_ids, CODEC_VBYTE))
+            self._write_section("doclens", bytes(encode_varints(
+                self.doc_lengths[doc_id] for doc_id in doc_ids
+            )))
+        for name, data in self._pending_sections:
+            self._write_section(name, data)
+        directory_offset = self._file.tell()
+        for name, offset, length in self._sections:
+            self._file.write(INDEX_SECTION_ENTRY.pack(name.encode(), offset, length))
+        self._file.write(INDEX_FOOTER.pack(directory_offset, len(self._sections), INDEX_MAGIC))
+        self._file.close()
+        os.replace(self._temp_path, self.filepath)
+
+
+class MappedInvertedIndex:
+    """Inverted index opened via mmap which decodes only requested posting lists"""
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        with open(filepath, 'rb') as index_file:
+            self._buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, codec = INDEX_HEADER.unpack_from(self._buffer, 0)
+        footer_offset = len(self._buffer) - INDEX_FOOTER.size
+        directory_offset, section_count, footer_magic = INDEX_FOOTER.unpack_from(
+            self._buffer, footer_offset
+        )
+        if magic != INDEX_MAGIC or footer_magic != INDEX_MAGIC:
+            self._buffer.close()
+            raise ValueError("%s is not an inverted index file" % filepath)
+        if self.version > INDEX_FORMAT_VERSION:
+            self._buffer.close()
+            raise ValueError("unsupported inverted index format version %d" % self.version)
+        self.codec = codec if self.version >= 3 else CODEC_RAW
+        self.sections = dict()
+        for number in range(section_count):
+            name, offset, length = INDEX_SECTION_ENTRY.unpack_from(
+                self._buffer, directory_offset + number * INDEX_SECTION_ENTRY.size
+            )
+            self.sections[name.rstrip(b"\0").decode()] = (offset, length)
+        self._terms_offset = self.sections["terms"][0]
+        self._table_offset, table_length = self.sections["table"]
+        self._term_count = table_length // INDEX_TERM_ENTRY.size
+        self._term_dictionary = None
+        self.docmap = None
+        if "docmap" in self.sections:
+            offset, length = self.sections["docmap"]
+            self.docmap = array('I', self._buffer[offset:offset + length])
+            if sys.byteorder != "little":
+                self.docmap.byteswap()
+        self._bloom = None
+        if "bloom" in self.sections:
+            self._bloom = BloomFilter.from_buffer(self._buffer, self.sections["bloom"][0])
+        self._scorer = None
+        self._doc_lengths = None
+        self.stop_words = set()
+        if self.positional:
+            offset, length = self.sections["stopword"]
+            self.stop_words = set(self._buffer[offset:offset + length].decode().split("\n")) - {""}
+        if self.ranked:
+            k1, b, doc_count, avg_doc_length = BM25_STATS.unpack_from(
+                self._buffer, self.sections["bm25"][0]
+            )
+            self._scorer = Bm25(doc_count, avg_doc_length, k1, b)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._term_count
+
+    def __contains__(self, term):
+        return self._find(term) >= 0
+
+    @property
+    def ranked(self) -> bool:
+        """Whether term frequencies and document lengths are stored"""
+        return "freqtab" in self.sections
+
+    @property
+    def positional(self) -> bool:
+        """Whether positions of terms in documents are stored"""
+        return "postab" in self.sections
+
+    def close(self):
+        """Release the memory mapping"""
+        self._buffer.close()
+
+    def _entry(self, number):
+        return INDEX_TERM_ENTRY.unpack_from(
+            self._buffer, self._table_offset + number * INDEX_TERM_ENTRY.size
+        )
+
+    def _term_bytes(self, entry):
+        term_offset = self._terms_offset + entry[0]
+        return self._buffer[term_offset:term_offset + entry[1]]
+
+    def might_contain(self, words) -> bool:
+        """Check all words against Bloom filter without touching the term dictionary
+
+        Patterns of terms are not checked.
+        """
+        if self._bloom is None:
+            return True
+        return all(word in self._bloom or is_term_pattern(word) for word in words)
+
+    def _lower_bound(self, key: bytes, count: int, key_at) -> int:
+        """Binary search of the first number whose key is not less than the given one"""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _term_at(self, number: int) -> bytes:
+        return self._term_bytes(self._entry(number))
+
+    def _find(self, term: str) -> int:
+        """Binary search of the term in the sorted term dictionary"""
+        term_bin = term.encode()
+        if self._bloom is not None and term_bin not in self._bloom:
+            return -1
+        number = self._lower_bound(term_bin, self._term_count, self._term_at)
+        if number < self._term_count and self._term_at(number) == term_bin:
+            return number
+        return -1
+
+    def expand_prefix(self, prefix: str):
+        """Iterate over terms starting with the prefix in sorted order"""
+        prefix_bin = prefix.encode()
+        start = self._lower_bound(prefix_bin, self._term_count, self._term_at)
+        for number in range(start, self._term_count):
+            term_bin = self._term_at(number)
+            if not term_bin.startswith(prefix_bin):
+                break
+            yield term_bin.decode()
+
+    def _ngram_entry(self, number: int):
+        return INDEX_TERM_ENTRY.unpack_from(
+            self._buffer, self.sections["ngramtab"][0] + number * INDEX_TERM_ENTRY.size
+        )
+
+    def _ngram_at(self, number: int) -> bytes:
+        gram_offset, gram_length = self._ngram_entry(number)[:2]
+        gram_offset += self.sections["ngramdic"][0]
+        return self._buffer[gram_offset:gram_offset + gram_length]
+
+    def term_by_number(self, number: int) -> str:
+        """Return term by its number in sorted order"""
+        return self._term_at(number).decode()
+
+    def ngram_term_numbers(self, gram: str) -> list:
+        """Return numbers of terms containing the n-gram
+
+        Without stored index of n-grams it is built in memory on first use.
+        """
+        if "ngramtab" not in self.sections:
+            if self._term_dictionary is None:
+                logger.warning(
+                    "index %s has no stored n-grams, build them in memory, "
+                    "rebuild the index with --ngram-index to avoid it", self.filepath,
+                )
+                self._term_dictionary = TermDictionary(self.terms())
+            return self._term_dictionary.ngram_term_numbers(gram)
+        gram_bin = gram.encode()
+        gram_count = self.sections["ngramtab"][1] // INDEX_TERM_ENTRY.size
+        number = self._lower_bound(gram_bin, gram_count, self._ngram_at)
+        if number >= gram_count or self._ngram_at(number) != gram_bin:
+            return []
+        _, _, numbers_offset, numbers_length, _ = self._ngram_entry(number)
+        return decode_postings(self._buffer, numbers_offset, numbers_length, 0, CODEC_VBYTE)
+
+    def _decode(self, entry) -> list:
+        _, _, postings_offset, postings_length, list_len = entry
+        return decode_postings(self._buffer, postings_offset, postings_length, list_len, self.codec)
+
+    def postings(self, term: str) -> list:
+        """Return posting list of the term, empty if there is no such term"""
+        number = self._find(term)
+        if number < 0:
+            return []
+        return self._decode(self._entry(number))
+
+    def doc_freq(self, term: str) -> int:
+        """Return number of documents containing the term"""
+        number = self._find(term)
+        if number < 0:
+            return 0
+        return self._entry(number)[4]
+
+    def terms(self):
+        """Iterate over terms in sorted order"""
+        for number in range(self._term_count):
+            yield self._term_bytes(self._entry(number)).decode()
+
+    def items(self):
+        """Iterate over pairs of term and its posting list in sorted order"""
+        for number in range(self._term_count):
+            entry = self._entry(number)
+            yield self._term_bytes(entry).decode(), self._decode(entry)
+
+    def _decode_freqs(self, number: int) -> list:
+        freqs_offset, freqs_length = INDEX_FREQ_ENTRY.unpack_from(
+            self._buffer, self.sections["freqtab"][0] + number * INDEX_FREQ_ENTRY.size
+        )
+        return decode_varints(self._buffer[freqs_offset:freqs_offset + freqs_length])
+
+    def _upper_bound(self, number: int) -> float:
+        return struct.unpack_from('<d', self._buffer, self.sections["maxscore"][0] + number * 8)[0]
+
+    def _decode_positions(self, number: int) -> list:
+        positions_offset, positions_length = INDEX_POSITIONS_ENTRY.unpack_from(
+            self._buffer, self.sections["postab"][0] + number * INDEX_POSITIONS_ENTRY.size
+        )
+        return decode_positions(self._buffer[positions_offset:positions_offset + positions_length])
+
+    def term_positions(self, term: str):
+        """Return posting list of the term and positions of the term in every document"""
+        number = self._find(term)
+        if number < 0:
+            return [], []
+        return self._decode(self._entry(number)), self._decode_positions(number)
+
+    def position_items(self):
+        """Iterate over pairs of term and its positions in sorted order"""
+        for number in range(self._term_count):
+            yield self._term_bytes(self._entry(number)).decode(), self._decode_positions(number)
+
+    def freq_items(self):
+        """Iterate over pairs of term and its term frequencies in sorted order"""
+        for number in range(self._term_count):
+            yield self._term_bytes(self._entry(number)).decode(), self._decode_freqs(number)
+
+    def doc_lengths(self) -> dict:
+        """Return lengths of all documents of ranked index by their stored ids"""
+        if self._doc_lengths is None:
+            offset, length = self.sections["doclens"]
+            lengths = decode_varints(self._buffer[offset:offset + length])
+            self._doc_lengths = dict(zip(self._stored_doc_ids(), lengths))
+        return self._doc_lengths
+
+    def extend_postings(self, postings_array: array):
+        """Append all posting lists to the array yielding term, offset and length"""
+        for number in range(self._term_count):
+            entry = self._entry(number)
+            offset = len(postings_array)
+            if self.codec == CODEC_RAW and sys.byteorder == "little":
+                postings_array.frombytes(self._buffer[entry[2]:entry[2] + entry[3]])
+            else:
+                postings_array.extend(self._decode(entry))
+            yield self._term_bytes(entry).decode(), offset, entry[4]
+
+    def _stored_doc_ids(self):
+        offset, length = self.sections["docids"]
+        return decode_postings(self._buffer, offset, length, 0, CODEC_VBYTE)
+
+    def doc_ids(self):
+        """Return sorted original ids of documents stored in the index, None if unknown"""
+        if "docids" not in self.sections:
+            return None
+        return restore_doc_ids(self.docmap, self._stored_doc_ids())
+
+    def query(self, words: list) -> list:
+        """Return the list of relevant documents for the given query"""
+        assert isinstance(words, list), (
+            "query should be provided with a list of words"
+        )
+        logger.debug("query inverted index with request %s", repr(words))
+        if any(is_term_pattern(word) for word in words):
+            return restore_doc_ids(self.docmap, query_patterns(self, words))
+        words = set(words)
+        if not self.might_contain(words):
+            return []
+        entries = []
+        for word in words:
+            number = self._find(word)
+            if number < 0:
+                return []
+            entries.append(self._entry(number))
+        if not entries:
+            return []
+        entries.sort(key=lambda entry: entry[4])
+        bitmap_entries = [entry for entry in entries if self._is_bitmap(entry)]
+        list_entries = [entry for entry in entries if not self._is_bitmap(entry)]
+        if not list_entries:
+            bitmap = self._decode_bitmap(bitmap_entries[0])
+            for entry in bitmap_entries[1:]:
+                bitmap = bitmap & self._decode_bitmap(entry)
+            return restore_doc_ids(self.docmap, bitmap.to_list())
+        response = self._decode(list_entries[0])
+        for entry in list_entries[1:]:
+            if not response:
+                break
+            response = intersect_sorted(response, self._decode(entry))
+        for entry in bitmap_entries:
+            if not response:
+                break
+            response = self._decode_bitmap(entry).filter(response)
+        return restore_doc_ids(self.docmap, response)
+
+    def query_boolean(self, text: str) -> list:
+        """Return the list of documents matching boolean query with phrases"""
+        logger.debug("boolean query inverted index with request %s", repr(text))
+        return restore_doc_ids(self.docmap, evaluate_query_node(self, parse_boolean_query(text)))
+
+    def _is_bitmap(self, entry) -> bool:
+        return self.codec == CODEC_AUTO and self._buffer[entry[2]] == CODEC_ROARING
+
+    def _decode_bitmap(self, entry) -> RoaringBitmap:
+        return RoaringBitmap.from_buffer(self._buffer, entry[2] + 1)
+
+    def collection_stats(self):
+        """Return number and total length of documents for BM25"""
+        doc_lengths = self.doc_lengths()
+        return len(doc_lengths), sum(doc_lengths.values())
+
+    def query_ranked(self, words: list, top_k: int, scorer=None, doc_freqs=None, skip=None) -> list:
+        """Return top_k pairs of document id and BM25 score for the given words
+
+        Index being a part of a larger collection is scored with the scorer
+        and document frequencies of the collection, documents whose ids are
+        rejected by skip are left out.
+        """
+        logger.debug("ranked query inverted index with request %s", repr(words))
+        terms = []
+        for word in set(words):
+            number = self._find(word)
+            if number < 0:
+                continue
+            entry = self._entry(number)
+            terms.append(ranked_term(
+                self._decode(entry), self._decode_freqs(number),
+                doc_freqs[word] if doc_freqs is not None else entry[4], scorer or self._scorer,
+                self._upper_bound(number) if scorer is None else None, skip, self.docmap,
+            ))
+        top = top_k_maxscore(terms, top_k, scorer or self._scorer, self.doc_lengths().__getitem__)
+        if self.docmap is not None:
+            top = [(self.docmap[doc_id], score) for doc_id, score in top]
+        return top
+
+    def stats(self, top_terms: int = DEFAULT_STATS_TOP_TERMS) -> dict:
+        """Describe the index reading only the section directory and the term table
+
+        With auto codec the first byte of every posting list is read to count
+        lists stored as roaring bitmaps.
+        """
+        list_codecs = Counter()
+        length_buckets = Counter()
+        posting_count = 0
+        posting_bytes = 0
+        heaviest = []
+        for number in range(self._term_count):
+            entry = self._entry(number)
+            posting_count += entry[4]
+            posting_bytes += entry[3]
+            length_buckets[entry[4].bit_length()] += 1
+            codec = self._buffer[entry[2]] if self.codec == CODEC_AUTO else self.codec
+            list_codecs[CODEC_NAMES[codec]] += 1
+            if len(heaviest) < top_terms:
+                heapq.heappush(heaviest, (entry[4], -number, entry[3]))
+            elif top_terms > 0 and (entry[4], -number) > heaviest[0][:2]:
+                heapq.heapreplace(heaviest, (entry[4], -number, entry[3]))
+        doc_count = None
+        if "docids" in self.sections:
+            doc_count = len(self._stored_doc_ids())
+        elif self.docmap is not None:
+            doc_count = len(self.docmap)
+        return {
+            "path": str(self.filepath),
+            "file_bytes": len(self._buffer),
+            "format_version": self.version,
+            "codec": CODEC_NAMES[self.codec],
+            "sections": {name: length for name, (_, length) in self.sections.items()},
+            "features": [
+                feature for feature, section in INDEX_FEATURE_SECTIONS if section in self.sections
+            ],
+            "documents": doc_count,
+            "terms": self._term_count,
+            "postings": posting_count,
+            "posting_bytes": posting_bytes,
+            "bytes_per_posting": posting_bytes / posting_count if posting_count else None,
+            "list_codecs": dict(list_codecs),
+            "posting_lengths": {
+                "%d-%d" % (2 ** bucket // 2, 2 ** bucket - 1) if bucket > 1 else str(bucket): count
+                for bucket, count in sorted(length_buckets.items())
+            },
+            "top_terms": [
+                {"term": self._term_at(-negative_number).decode(), "postings": length, "bytes": size}
+                for length, negative_number, size in sorted(heaviest, reverse=True)
+            ],
+        }
+
+
+class CompactInvertedIndex:
+    """In-memory inverted index keeping all postings in one contiguous array
+
+    Interned terms map to offset and length of their posting list in the
+    array, so a posting takes 4 bytes instead of a boxed int in a list.
+    Ranking statistics and positions of the file are not loaded, they are
+    listed in unloaded_features.
+    """
+    def __init__(self, terms: dict, postings_array: array, doc_ids=None, docmap=None,
+                 stop_words=None, unloaded_features=()):
+        self.terms = terms
+        self.postings_array = postings_array
+        self._postings_view = memoryview(postings_array)
+        self._doc_ids = doc_ids
+        self.stop_words = stop_words if stop_words is not None else set()
+        self.unloaded_features = set(unloaded_features)
+        self.positional = False
+        self.ranked = False
+        self._term_dictionary = None
+        self.docmap = docmap
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    @classmethod
+    def from_items(cls, items, doc_ids=None):
+        """Build index from pairs of term and sorted posting list"""
+        terms = dict()
+        postings_array = array('I')
+        for term, postings in items:
+            terms[sys.intern(term)] = (len(postings_array), len(postings))
+            postings_array.extend(postings)
+        return cls(terms, postings_array, doc_ids)
+
+    @classmethod
+    def load(cls, filepath: str):
+        """Load all posting lists of the index file into one array"""
+        if not is_mapped_index(filepath):
+            return cls.from_items(InvertedIndex.load(filepath).items())
+        logger.info("load inverted index %s", filepath)
+        terms = dict()
+        postings_array = array('I')
+        with MappedInvertedIndex(filepath) as mapped_index:
+            for term, offset, length in mapped_index.extend_postings(postings_array):
+                terms[sys.intern(term)] = (offset, length)
+            doc_ids = mapped_index.doc_ids()
+            docmap = mapped_index.docmap
+            stop_words = mapped_index.stop_words
+            unloaded_features = [
+                feature for feature in ("ranked", "positional") if getattr(mapped_index, feature)
+            ]
+        return cls(terms, postings_array, doc_ids, docmap, stop_words, unloaded_features)
+
+    def postings(self, term: str):
+        """Return posting list of the term as a view of the array"""
+        location = self.terms.get(term)
+        if location is None:
+            return []
+        offset, length = location
+        return self._postings_view[offset:offset + length]
+
+    def doc_freq(self, term: str) -> int:
+        """Return number of documents containing the term"""
+        location = self.terms.get(term)
+        return location[1] if location is not None else 0
+
+    def doc_ids(self):
+        """Return sorted ids of documents stored in the index, None if unknown"""
+        return self._doc_ids
+
+    def items(self):
+        """Iterate over pairs of term and its posting list in sorted order"""
+        for term in sorted(self.terms):
+            yield term, list(self.postings(term))
+
+    def query(self, words: list) -> list:
+        """Return the list of relevant documents for the given query"""
+        assert isinstance(words, list), (
+            "query should be provided with a list of words"
+        )
+        logger.debug("query inverted index with request %s", repr(words))
+        if any(is_term_pattern(word) for word in words):
+            return restore_doc_ids(self.docmap, query_patterns(self, words))
+        posting_lists = []
+        for word in set(words):
+            postings = self.postings(word)
+            if not postings:
+                return []
+            posting_lists.append(postings)
+        return restore_doc_ids(self.docmap, intersect_postings(posting_lists))
+
+    def expand_prefix(self, prefix: str):
+        """Iterate over terms starting with the prefix in sorted order"""
+        return self._dictionary().expand_prefix(prefix)
+
+    def term_by_number(self, number: int) -> str:
+        """Return term by its number in sorted order"""
+        return self._dictionary().term_by_number(number)
+
+    def ngram_term_numbers(self, gram: str) -> list:
+        """Return numbers of terms containing the n-gram"""
+        return self._dictionary().ngram_term_numbers(gram)
+
+    def _dictionary(self) -> TermDictionary:
+        if self._term_dictionary is None:
+            self._term_dictionary = TermDictionary(self.terms)
+        return self._term_dictionary
+
+    def query_boolean(self, text: str) -> list:
+        """Return the list of documents matching boolean query"""
+        logger.debug("boolean query inverted index with request %s", repr(text))
+        return restore_doc_ids(self.docmap, evaluate_query_node(self, parse_boolean_query(text)))
+
+
+def is_mapped_index(filepath: str) -> bool:
+    """Check whether the file is stored in the memory-mapped index format"""
+    with open(filepath, 'rb') as index_file:
+        return index_file.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+
+def open_index_file(filepath: str, compact=False):
+    """Open single inverted index file without decoding all posting lists
+
+    Compact index is loaded into memory as one array of postings instead.
+    """
+    if compact:
+        return CompactInvertedIndex.load(filepath)
+    if not is_mapped_index(filepath):
+        return InvertedIndex.load(filepath)
+    logger.info("load inverted index %s", filepath)
+    return MappedInvertedIndex(filepath)
+
+
+def open_index(filepath: str, compact=False):
+    """Open inverted index for queries together with its segments or shards if any"""
+    if is_sharded_index(filepath):
+        return ShardedIndex(filepath, compact)
+    if os.path.exists(segments_manifest_path(filepath)):
+        return SegmentedIndex(filepath, compact)
+    return open_index_file(filepath, compact)
+
+
+def is_sharded_index(filepath: str) -> bool:
+    """Check whether the file is a JSON manifest listing shards of the index"""
+    with open(filepath, 'rb') as index_file:
+        return index_file.read(1) == b"{"
+
+
+def load_shards_manifest(index_path: str) -> dict:
+    """Load manifest of sharded index, indexes saved without partition split ids by remainder"""
+    with open(index_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest.setdefault("partition", SHARD_PARTITION_MODULO)
+    return manifest
+
+
+def shard_paths(index_path: str) -> list:
+    """Return paths of shard files listed in the manifest of sharded index"""
+    index_dir = os.path.dirname(str(index_path))
+    return [os.path.join(index_dir, shard_name) for shard_name in load_shards_manifest(index_path)["shards"]]
+
+
+def save_shards_manifest(index_path: str, shard_names: list, partition=SHARD_PARTITION_HASH):
+    """Atomically replace index file with the manifest listing its shards"""
+    temp_path = str(index_path) + ".tmp"
+    with open(temp_path, 'w') as manifest_file:
+        json.dump({"shards": shard_names, "partition": partition}, manifest_file)
+    os.replace(temp_path, index_path)
+
+
+def shard_number(doc_id: int, shards: int, partition=SHARD_PARTITION_HASH) -> int:
+    """Return number of the shard keeping the document
+
+    Ids are hashed, so ids going with a common step still spread over all
+    shards, the high bits of the hash pick the shard.
+    """
+    if partition == SHARD_PARTITION_MODULO:
+        return doc_id % shards
+    return ((doc_id * SHARD_HASH_MULTIPLIER) & 0xFFFFFFFF) * shards >> 32
+
+
+def segments_manifest_path(index_path: str) -> str:
+    """Return path of the manifest listing segments added to the index"""
+    return str(index_path) + SEGMENTS_MANIFEST_SUFFIX
+
+
+def load_segments_manifest(index_path: str) -> dict:
+    """Load manifest of segments, empty one if there are no segments"""
+    manifest_path = segments_manifest_path(index_path)
+    if not os.path.exists(manifest_path):
+        return {"segments": [], "next_segment": 1}
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_segments_manifest(index_path: str, manifest: dict):
+    """Atomically replace manifest of segments, remove it if there are no segments"""
+    manifest_path = segments_manifest_path(index_path)
+    if not manifest["segments"]:
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        return
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temp_path, manifest_path)
+
+
+def remove_segments(index_path: str):
+    """Remove all segments added to the index"""
+    manifest = load_segments_manifest(index_path)
+    index_dir = os.path.dirname(str(index_path))
+    for segment_name in manifest["segments"]:
+        segment_path = os.path.join(index_dir, segment_name)
+        for path in (segment_path, document_store_path(segment_path)):
+            if os.path.exists(path):
+                os.remove(path)
+    manifest["segments"] = []
+    save_segments_manifest(index_path, manifest)
+
+
+def write_segment(filepath: str, items, doc_ids, codec=DEFAULT_POSTING_CODEC, doc_lengths=None,
+                  positional=False, stop_words=(), ngram_index=False):
+    """Write posting lists with the ids of documents they were built from
+
+    Items are tuples of term, posting list, term frequencies for ranked
+    segment written with doc_lengths and positions for positional one.
+    """
+    with IndexWriter(filepath, codec, doc_lengths=doc_lengths, positional=positional,
+                     stop_words=stop_words, ngram_index=ngram_index) as writer:
+        for word, postings, freqs, positions in items:
+            writer.add(word, postings, freqs, positions)
+        if doc_ids is not None and doc_lengths is None:
+            writer.add_section("docids", encode_postings(sorted(doc_ids), CODEC_VBYTE))
+
+
+def index_file_features(filepath: str) -> dict:
+    """Return which optional sections, kept by segments and merges, the index file has"""
+    features = {"ranked": False, "positional": False, "ngram_index": False}
+    if is_mapped_index(filepath):
+        with MappedInvertedIndex(filepath) as inverted_index:
+            features["ranked"] = inverted_index.ranked
+            features["positional"] = inverted_index.positional
+            features["ngram_index"] = "ngrams" in inverted_index.sections
+    return features
+
+
+class SegmentedIndex:
+    """Inverted index made of the base file and immutable segments added later
+
+    A document added again in a newer segment replaces its older versions.
+    Ranked queries are scored with statistics of documents of all segments,
+    replaced versions are counted in document frequencies until merge.
+    """
+    def __init__(self, index_path: str, compact=False):
+        self.index_path = index_path
+        manifest = load_segments_manifest(index_path)
+        index_dir = os.path.dirname(str(index_path))
+        self.segments = [open_index_file(index_path, compact)]
+        for segment_name in manifest["segments"]:
+            self.segments.append(open_index_file(os.path.join(index_dir, segment_name), compact))
+        self._latest_segment = dict()
+        for number, segment in enumerate(self.segments[1:], start=1):
+            for doc_id in segment.doc_ids():
+                self._latest_segment[doc_id] = number
+        self._collection_stats = None
+
+    @property
+    def ranked(self) -> bool:
+        """Whether every segment keeps statistics for BM25 ranking"""
+        return all(getattr(segment, "ranked", False) for segment in self.segments)
+
+    @property
+    def positional(self) -> bool:
+        """Whether every segment keeps positions of terms"""
+        return all(getattr(segment, "positional", False) for segment in self.segments)
+
+    @property
+    def unloaded_features(self) -> set:
+        """Features of segment files not loaded by compact segments"""
+        return set(chain.from_iterable(
+            getattr(segment, "unloaded_features", ()) for segment in self.segments
+        ))
+
+    def close(self):
+        """Release all segments"""
+        for segment in self.segments:
+            if hasattr(segment, "close"):
+                segment.close()
+
+    def _query_segments(self, method_name: str, query) -> list:
+        response = []
+        for number, segment in enumerate(self.segments):
+            if method_name == "query" and not getattr(segment, "might_contain", bool)(query):
+                continue
+            for doc_id in getattr(segment, method_name)(query):
+                if self._latest_segment.get(doc_id, number) == number:
+                    response.append(doc_id)
+        response.sort()
+        return response
+
+    def query(self, words: list) -> list:
+        """Return the list of relevant documents for the given query"""
+        return self._query_segments("query", words)
+
+    def query_boolean(self, text: str) -> list:
+        """Return the list of documents matching boolean query with phrases"""
+        return self._query_segments("query_boolean", text)
+
+    def doc_freq(self, term: str) -> int:
+        """Return number of documents containing the term in all segments"""
+        return sum(segment.doc_freq(term) for segment in self.segments)
+
+    def collection_stats(self):
+        """Return number and total length of documents not replaced in newer segments"""
+        if self._collection_stats is None:
+            doc_count = total_doc_length = 0
+            for number, segment in enumerate(self.segments):
+                docmap = segment.docmap
+                for doc_id, length in segment.doc_lengths().items():
+                    doc_id = docmap[doc_id] if docmap is not None else doc_id
+                    if self._latest_segment.get(doc_id, number) == number:
+                        doc_count += 1
+                        total_doc_length += length
+            self._collection_stats = doc_count, total_doc_length
+        return self._collection_stats
+
+    def query_ranked(self, words: list, top_k: int, scorer=None, doc_freqs=None, skip=None) -> list:
+        """Return top_k pairs of document id and BM25 score over all segments"""
+        if scorer is None:
+            scorer = Bm25.from_collection_stats(*self.collection_stats())
+            doc_freqs = {word: self.doc_freq(word) for word in set(words)}
+        answers = []
+        for number, segment in enumerate(self.segments):
+            def segment_skip(doc_id, number=number):
+                if self._latest_segment.get(doc_id, number) != number:
+                    return True
+                return skip is not None and skip(doc_id)
+            answers.append(segment.query_ranked(words, top_k, scorer, doc_freqs, segment_skip))
+        return heapq.nlargest(
+            top_k, chain.from_iterable(answers), key=lambda pair: (pair[1], -pair[0]),
+        )
+
+
+class ShardedIndex:
+    """Inverted index partitioned by document id into independent shards
+
+    Queries are sent to every shard in a pool of threads over memory mapped
+    files and the disjoint answers are merged. Every shard scores ranked
+    answers with BM25 statistics of all shards, so the scores are
+    comparable and merged like answers of a single index.
+    """
+    def __init__(self, index_path: str, compact=False):
+        self.index_path = index_path
+        self.shards = [open_index(shard_path, compact) for shard_path in shard_paths(index_path)]
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards))
+        self.stop_words = set(chain.from_iterable(
+            getattr(shard, "stop_words", ()) for shard in self.shards
+        ))
+        self._collection_stats = None
+
+    @property
+    def ranked(self) -> bool:
+        """Whether every shard keeps statistics for BM25 ranking"""
+        return all(getattr(shard, "ranked", False) for shard in self.shards)
+
+    @property
+    def unloaded_features(self) -> set:
+        """Features of shard files not loaded by compact shards"""
+        return set(chain.from_iterable(
+            getattr(shard, "unloaded_features", ()) for shard in self.shards
+        ))
+
+    def close(self):
+        """Stop query threads and release all shards"""
+        self._executor.shutdown()
+        for shard in self.shards:
+            if hasattr(shard, "close"):
+                shard.close()
+
+    def _fan_out(self, method_name: str, *args) -> list:
+        return list(self._executor.map(
+            lambda shard: getattr(shard, method_name)(*args), self.shards
+        ))
+
+    def query(self, words: list) -> list:
+        """Return the list of relevant documents for the given query"""
+        return list(heapq.merge(*self._fan_out("query", words)))
+
+    def query_boolean(self, text: str) -> list:
+        """Return the list of documents matching boolean query with phrases"""
+        return list(heapq.merge(*self._fan_out("query_boolean", text)))
+
+    def query_ranked(self, words: list, top_k: int, scorer=None, doc_freqs=None, skip=None) -> list:
+        """Return top_k pairs of document id and BM25 score over all shards"""
+        if scorer is None:
+            scorer = Bm25.from_collection_stats(*self.collection_stats())
+            doc_freqs = {word: self.doc_freq(word) for word in set(words)}
+        answers = self._fan_out("query_ranked", words, top_k, scorer, doc_freqs, skip)
+        return heapq.nlargest(
+            top_k, chain.from_iterable(answers), key=lambda pair: (pair[1], -pair[0]),
+        )
+
+    def doc_freq(self, term: str) -> int:
+        """Return number of documents containing the term in all shards"""
+        return sum(shard.doc_freq(term) for shard in self.shards)
+
+    def collection_stats(self):
+        """Return number and total length of documents in all shards"""
+        if self._collection_stats is None:
+            shard_stats = [shard.collection_stats() for shard in self.shards]
+            self._collection_stats = (
+                sum(doc_count for doc_count, _ in shard_stats),
+                sum(total_doc_length for _, total_doc_length in shard_stats),
+            )
+        return self._collection_stats
+
+
+def _numbered_items(segment, number: int, ranked=False, positional=False):
+    """Iterate over terms of the segment with postings of original ids, frequencies and positions"""
+    docmap = getattr(segment, "docmap", None)
+    freq_items = segment.freq_items() if ranked else repeat((None, None))
+    position_items = segment.position_items() if positional else repeat((None, None))
+    for (word, postings), (_, freqs), (_, positions) in zip(segment.items(), freq_items, position_items):
+        if docmap is not None:
+            order = sorted(range(len(postings)), key=lambda position: docmap[postings[position]])
+            postings = [docmap[postings[position]] for position in order]
+            freqs = [freqs[position] for position in order] if ranked else None
+            positions = [positions[position] for position in order] if positional else None
+        yield word, number, postings, freqs, positions
+
+
+def merge_segments(segments: list, output: str, codec=DEFAULT_POSTING_CODEC, keep_doc_ids=True):
+    """Merge consecutive segments from oldest to newest into one segment
+
+    Term frequencies, positions and n-grams are kept if every segment has
+    them. Renumbering of reordered segments is not, the merged segment
+    stores original ids of documents.
+    """
+    owners = dict()
+    doc_ids = set()
+    for number, segment in enumerate(segments):
+        segment_doc_ids = segment.doc_ids() if hasattr(segment, "doc_ids") else None
+        for doc_id in segment_doc_ids or []:
+            owners[doc_id] = number
+        doc_ids.update(segment_doc_ids or [])
+    features = [
+        {
+            "ranked": getattr(segment, "ranked", False),
+            "positional": getattr(segment, "positional", False),
+            "ngram_index": "ngrams" in getattr(segment, "sections", ()),
+        }
+        for segment in segments
+    ]
+    kept = {name: all(segment_features[name] for segment_features in features) for name in features[0]}
+    dropped = [
+        name for name in kept
+        if not kept[name] and any(segment_features[name] for segment_features in features)
+    ]
+    if dropped:
+        logger.warning("merged %s drops %s missing in some of merged segments", output, ", ".join(dropped))
+    if any(getattr(segment, "docmap", None) is not None for segment in segments):
+        logger.warning("merged %s keeps original document ids, build with --reorder to renumber them", output)
+    doc_lengths = None
+    if kept["ranked"]:
+        doc_lengths = dict()
+        for number, segment in enumerate(segments):
+            docmap = segment.docmap
+            for doc_id, length in segment.doc_lengths().items():
+                doc_id = docmap[doc_id] if docmap is not None else doc_id
+                if owners.get(doc_id, number) == number:
+                    doc_lengths[doc_id] = length
+    stop_words = set()
+    if kept["positional"]:
+        stop_words = set(chain.from_iterable(segment.stop_words for segment in segments))
+    numbered_items = [
+        _numbered_items(segment, number, kept["ranked"], kept["positional"])
+        for number, segment in enumerate(segments)
+    ]
+    merged = heapq.merge(*numbered_items, key=lambda item: item[0])
+
+    def merged_items():
+        for word, items in groupby(merged, key=lambda item: item[0]):
+            posting_lists = [
+                [
+                    (doc_id, freqs[position] if freqs is not None else None,
+                     positions[position] if positions is not None else None)
+                    for position, doc_id in enumerate(postings)
+                    if owners.get(doc_id, number) == number
+                ]
+                for _, number, postings, freqs, positions in items
+            ]
+            postings = list(heapq.merge(*posting_lists, key=lambda posting: posting[0]))
+            if postings:
+                yield (
+                    word, [doc_id for doc_id, _, _ in postings],
+                    [freq for _, freq, _ in postings] if kept["ranked"] else None,
+                    [positions for _, _, positions in postings] if kept["positional"] else None,
+                )
+
+    write_segment(
+        output, merged_items(), doc_ids if keep_doc_ids else None, codec, doc_lengths,
+        kept["positional"], stop_words, kept["ngram_index"],
+    )
+
+
+def plan_tiered_merge(sizes: list, tier_factor: int):
+    """Find first run of consecutive segments of one size tier long enough to merge"""
+    tiers = [int(math.log(max(size, 1), tier_factor)) for size in sizes]
+    start = 0
+    for end in range(1, len(tiers) + 1):
+        if end == len(tiers) or tiers[end] != tiers[start]:
+            if end - start >= tier_factor:
+                return start, end
+            start = end
+    return None
+
+
+def document_store_path(index_path: str) -> str:
+    """Return path of the document store built next to the index"""
+    return str(index_path) + DOC_STORE_SUFFIX
+
+
+class DocumentStoreWriter:
+    """Streaming writer of documents compressed with zlib in blocks
+
+    The file is the sequence of compressed blocks, the table of blocks,
+    the table of documents sorted by id and a footer pointing to both tables.
+    """
+    def __init__(self, filepath: str, block_size: int = DOC_STORE_BLOCK_SIZE):
+        self.filepath = filepath
+        self.block_size = block_size
+        self._temp_path = str(filepath) + ".tmp"
+        self._file = open(self._temp_path, 'wb')
+        self._file.write(DOC_STORE_MAGIC)
+        self._block = bytearray()
+        self._blocks = bytearray()
+        self._entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def abort(self):
+        """Remove the temporary file keeping the store at filepath untouched"""
+        if not self._file.closed:
+            self._file.close()
+            os.remove(self._temp_path)
+
+    def add(self, doc_id: int, text: str):
+        """Append text of the document to the current block"""
+        text_bin = text.encode()
+        block_number = len(self._blocks) // DOC_STORE_BLOCK.size
+        self._entries.append((doc_id, block_number, len(self._block), len(text_bin)))
+        self._block += text_bin
+        if len(self._block) >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        compressed = zlib.compress(bytes(self._block))
+        self._blocks += DOC_STORE_BLOCK.pack(self._file.tell(), len(compressed))
+        self._file.write(compressed)
+        self._block = bytearray()
+
+    def close(self):
+        """Write block and document tables and the footer"""
+        if self._file.closed:
+            return
+        if self._block:
+            self._flush_block()
+        blocks_offset = self._file.tell()
+        self._file.write(self._blocks)
+        docs_offset = self._file.tell()
+        self._entries.sort()
+        for entry in self._entries:
+            self._file.write(DOC_STORE_ENTRY.pack(*entry))
+        self._file.write(DOC_STORE_FOOTER.pack(
+            blocks_offset, len(self._blocks) // DOC_STORE_BLOCK.size,
+            docs_offset, len(self._entries), DOC_STORE_MAGIC,
+        ))
+        self._file.close()
+        os.replace(self._temp_path, self.filepath)
+
+
+class DocumentStore:
+    """Memory mapped document store decompressing one block per lookup"""
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        with open(filepath, 'rb') as store_file:
+            self._buffer = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (self._blocks_offset, self._block_count, self._docs_offset,
+         self._doc_count, magic) = DOC_STORE_FOOTER.unpack_from(
+            self._buffer, len(self._buffer) - DOC_STORE_FOOTER.size
+        )
+        if magic != DOC_STORE_MAGIC or self._buffer[:len(DOC_STORE_MAGIC)] != DOC_STORE_MAGIC:
+            self._buffer.close()
+            raise ValueError("%s is not a document store file" % filepath)
+        self._cached_block = (None, b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._doc_count
+
+    def close(self):
+        """Release the memory mapping"""
+        self._buffer.close()
+
+    def _entry(self, number):
+        return DOC_STORE_ENTRY.unpack_from(
+            self._buffer, self._docs_offset + number * DOC_STORE_ENTRY.size
+        )
+
+    def _block(self, number: int) -> bytes:
+        if self._cached_block[0] != number:
+            offset, length = DOC_STORE_BLOCK.unpack_from(
+                self._buffer, self._blocks_offset + number * DOC_STORE_BLOCK.size
+            )
+            self._cached_block = (number, zlib.decompress(self._buffer[offset:offset + length]))
+        return self._cached_block[1]
+
+    def items(self):
+        """Yield pairs of document id and text in order of ids"""
+        for number in range(self._doc_count):
+            doc_id, block, start, length = self._entry(number)
+            yield doc_id, self._block(block)[start:start + length].decode()
+
+    def get(self, doc_id: int):
+        """Return text of the document, None if there is no such document"""
+        low, high = 0, self._doc_count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            if entry[0] < doc_id:
+                low = middle + 1
+            elif entry[0] > doc_id:
+                high = middle
+            else:
+                _, block, start, length = entry
+                return self._block(block)[start:start + length].decode()
+        return None
+
+
+class SegmentedDocumentStore:
+    """Document stores of the index and of its segments, newer stores answer first"""
+    def __init__(self, filepaths: list):
+        self.stores = [DocumentStore(filepath) for filepath in filepaths]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Release memory mappings of all stores"""
+        for store in self.stores:
+            store.close()
+
+    def get(self, doc_id: int):
+        """Return text of the latest version of the document, None if there is no such document"""
+        for store in reversed(self.stores):
+            text = store.get(doc_id)
+            if text is not None:
+                return text
+        return None
+
+
+def write_document_store(filepath: str, documents, block_size: int = DOC_STORE_BLOCK_SIZE):
+    """Write pairs of document id and text into compressed document store"""
+    logger.info("write document store %s", filepath)
+    with DocumentStoreWriter(filepath, block_size) as writer:
+        for doc_id, text in documents:
+            writer.add(doc_id, text)
+
+
+class PrefixedStream(RawIOBase):
+    """Stream of bytes already read from the head of a file followed by the rest of the file"""
+    def __init__(self, head: bytes, stream):
+        super().__init__()
+        self._head = head
+        self._stream = stream
+
+    def readable(self) -> bool:
+        """Stream is always readable"""
+        return True
+
+    def readinto(self, buffer) -> int:
+        """Fill buffer with the rest of the head, or with bytes read from the stream"""
+        if self._head:
+            length = min(len(buffer), len(self._head))
+            buffer[:length] = self._head[:length]
+            self._head = self._head[length:]
+            return length
+        chunk = self._stream.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def read_head(stream, size: int) -> bytes:
+    """Read size bytes from the stream unless it ends earlier, a pipe may return them in parts"""
+    head = b""
+    while len(head) < size:
+        chunk = stream.read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    return head
+
 
-            dict_len = load_file.read(4)
-            dict_len = struct.unpack('>i', dict_len)[0]
-            for _ in range(dict_len):
-                key_len = load_file.read(1)
-                key_len = struct.unpack('>B', key_len)[0]
-                pack_format = '>' + str(key_len) + 's'
-                key = load_file.read(key_len)
-                key = struct.unpack(pack_format, key)[0]
-                key = key.decode()
+def open_dataset(filepath: str):
+    """Open dataset file or standard input for "-" and return it with a reader of its text bytes
 
-                list_len = load_file.read(2)
-                list_len = struct.unpack('>H', list_len)[0]
-                values = load_file.read(list_len * 2)
-                pack_format = '>' + str(list_len) + 'H'
-                values = struct.unpack(pack_format, values)
-                values = list(values)
-                dict_index[key] = values
-            inverted_index = cls(dict_index)
-        return inverted_index
+    Compressed gzip, bzip2 and xz datasets are recognized by magic bytes.
+    """
+    if str(filepath) == STDIN_DATASET_PATH:
+        dataset_file = sys.stdin.buffer
+    else:
+        dataset_file = open(filepath, 'rb')
+    head = read_head(dataset_file, max(len(magic) for magic, _ in DATASET_COMPRESSIONS))
+    reader = BufferedReader(PrefixedStream(head, dataset_file))
+    for magic, decompressor in DATASET_COMPRESSIONS:
+        if head.startswith(magic):
+            return dataset_file, decompressor(reader)
+    return dataset_file, reader
+
+
+def iter_dataset_chunks(filepath: str):
+    """Yield chunks of dataset bytes read and decompressed in a separate thread"""
+    chunks = queue.Queue(maxsize=DATASET_QUEUE_CHUNKS)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read_chunks():
+        dataset_file = None
+        try:
+            dataset_file, reader = open_dataset(filepath)
+            while not stopped.is_set():
+                chunk = reader.read(DATASET_CHUNK_SIZE)
+                put(chunk)
+                if not chunk:
+                    return
+        except BaseException as error:
+            put(error)
+        finally:
+            if dataset_file is not None and dataset_file is not sys.stdin.buffer:
+                dataset_file.close()
+
+    threading.Thread(target=read_chunks, daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        stopped.set()
 
 
+def iter_documents(filepath: str):
+    """Stream documents line by line and yield pairs of id and text
+
+    Dataset may be compressed or read from standard input with "-".
+    """
+    tail = b""
+    for chunk in iter_dataset_chunks(filepath):
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            idx, line = line.decode().rstrip().split(maxsplit=1)
+            yield int(idx), line.rstrip()
+    if tail:
+        idx, line = tail.decode().rstrip().split(maxsplit=1)
+        yield int(idx), line.rstrip()
+
 
 def load_documents(filepath: str):
     """Load file with documents and put into dictionary"""
     logger.info("loading documents to build inverted index")
-    documents = dict()
-    with open(filepath, 'r') as doc_file:
-        for line in doc_file:
-            line = line.rstrip()
-            idx, line = line.split(maxsplit=1)
-            documents[int(idx)] = line.rstrip()
+    documents = dict(iter_documents(filepath))
     return documents
 
 
@@ -190,68 +2455,869 @@ def load_stop_words(stop_words_path):
     return stop_words
 
 
-def build_inverted_index(documents, stop_words):
-    """Take list of documents and return inverted index"""
+def build_inverted_index(documents, stop_words, ranked=False, positional=False):
+    """Take list of documents and return inverted index
+
+    Ranked index also keeps term frequencies and document lengths for BM25,
+    positional index keeps positions of terms among all words of a document.
+    """
     logger.info("building inverted index for provided documents")
+    if positional:
+        return _build_positional_index(documents, stop_words, ranked)
     dict_index = defaultdict(list)
+    if not ranked:
+        for idx in documents:
+            document = documents[idx].split()
+            document = set(document) - stop_words
+            for word in document:
+                dict_index[word].append(idx)
+        inverted_index = InvertedIndex(dict_index)
+        return inverted_index
+
+    term_freqs = defaultdict(list)
+    doc_lengths = dict()
     for idx in documents:
-        document = documents[idx].split()
-        document = set(document) - stop_words
-        for word in document:
+        document = [word for word in documents[idx].split() if word not in stop_words]
+        doc_lengths[idx] = len(document)
+        for word, freq in Counter(document).items():
             dict_index[word].append(idx)
+            term_freqs[word].append(freq)
+    inverted_index = InvertedIndex(dict_index, term_freqs, doc_lengths)
+    return inverted_index
 
-    inverted_index = InvertedIndex()
-    inverted_index.dict_index = dict_index
+
+def _build_positional_index(documents, stop_words, ranked):
+    """Build inverted index keeping positions of every term in documents"""
+    dict_index = defaultdict(list)
+    positions = defaultdict(list)
+    doc_lengths = dict()
+    for idx in documents:
+        document_positions = defaultdict(list)
+        for position, word in enumerate(documents[idx].split()):
+            if word not in stop_words:
+                document_positions[word].append(position)
+        doc_lengths[idx] = sum(len(word_positions) for word_positions in document_positions.values())
+        for word, word_positions in document_positions.items():
+            dict_index[word].append(idx)
+            positions[word].append(word_positions)
+    term_freqs = None
+    if ranked:
+        term_freqs = {
+            word: [len(word_positions) for word_positions in position_lists]
+            for word, position_lists in positions.items()
+        }
+    inverted_index = InvertedIndex(
+        dict_index, term_freqs, doc_lengths if ranked else None, positions, set(stop_words)
+    )
     return inverted_index
 
 
+def _build_partial_index(shard):
+    """Build posting lists for a shard of documents inside worker process"""
+    documents, stop_words, ranked, positional = shard
+    inverted_index = build_inverted_index(documents, stop_words, ranked, positional)
+    return (
+        inverted_index.dict_index, inverted_index.term_freqs,
+        inverted_index.doc_lengths, inverted_index.positions,
+    )
+
+
+def merge_partial_indexes(partial_indexes, stop_words=None) -> InvertedIndex:
+    """Merge posting lists of partial indexes built over disjoint documents"""
+    dict_index = defaultdict(list)
+    term_freqs = None
+    doc_lengths = None
+    positions = None
+    for partial_index, partial_freqs, partial_lengths, partial_positions in partial_indexes:
+        for word, postings in partial_index.items():
+            dict_index[word].extend(postings)
+        if partial_freqs is not None:
+            term_freqs = term_freqs if term_freqs is not None else defaultdict(list)
+            doc_lengths = doc_lengths if doc_lengths is not None else dict()
+            for word, freqs in partial_freqs.items():
+                term_freqs[word].extend(freqs)
+            doc_lengths.update(partial_lengths)
+        if partial_positions is not None:
+            positions = positions if positions is not None else defaultdict(list)
+            for word, position_lists in partial_positions.items():
+                positions[word].extend(position_lists)
+    return InvertedIndex(dict_index, term_freqs, doc_lengths, positions, stop_words)
+
+
+def read_varint(buffer, offset: int):
+    """Decode one variable-byte integer, return it and the next offset"""
+    number = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, offset
+        shift += 7
+
+
+def _flush_run(dict_index, run_path: str):
+    """Write sorted partial index to the run file"""
+    logger.info("flush run of %d terms to %s", len(dict_index), run_path)
+    with open(run_path, 'wb') as run_file:
+        for word in sorted(dict_index):
+            word_bin = word.encode()
+            postings = sorted(dict_index[word])
+            values_pack = encode_postings(postings, CODEC_VBYTE)
+            run_file.write(encode_varints([len(word_bin)]))
+            run_file.write(word_bin)
+            run_file.write(encode_varints([len(postings), len(values_pack)]))
+            run_file.write(values_pack)
+
+
+def _iter_run(run_path: str):
+    """Read run file and yield pairs of term and posting list in sorted order"""
+    with open(run_path, 'rb') as run_file:
+        if os.fstat(run_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(run_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            offset = 0
+            while offset < len(buffer):
+                word_len, offset = read_varint(buffer, offset)
+                word = buffer[offset:offset + word_len].decode()
+                offset += word_len
+                list_len, offset = read_varint(buffer, offset)
+                values_len, offset = read_varint(buffer, offset)
+                postings = decode_postings(buffer, offset, values_len, list_len, CODEC_VBYTE)
+                offset += values_len
+                yield word, postings
+
+
+def merge_runs(run_paths: list):
+    """K-way merge of sorted runs yielding terms with merged posting lists"""
+    runs = [_iter_run(run_path) for run_path in run_paths]
+    merged = heapq.merge(*runs, key=lambda item: item[0])
+    for word, items in groupby(merged, key=lambda item: item[0]):
+        posting_lists = [postings for _, postings in items]
+        if len(posting_lists) == 1:
+            yield word, posting_lists[0]
+        else:
+            yield word, list(heapq.merge(*posting_lists))
+
+
+def build_inverted_index_external(dataset_path, stop_words, output, memory_limit: int,
+                                  codec=DEFAULT_POSTING_CODEC, ngram_index=False):
+    """Build inverted index streaming documents and spilling sorted runs to disk
+
+    Only postings are bounded by memory_limit, the term dictionary of the
+    final index is kept in memory while the runs are merged.
+    """
+    logger.info("building inverted index with memory limit %d bytes", memory_limit)
+    with tempfile.TemporaryDirectory(prefix="inverted_index_") as run_dir:
+        run_paths = []
+        dict_index = defaultdict(list)
+        memory_used = 0
+        for idx, document in iter_documents(dataset_path):
+            document = set(document.split()) - stop_words
+            for word in document:
+                postings = dict_index[word]
+                if not postings:
+                    memory_used += TERM_MEMORY_COST + len(word)
+                postings.append(idx)
+                memory_used += POSTING_MEMORY_COST
+            if memory_used >= memory_limit:
+                run_paths.append(os.path.join(run_dir, "run_%06d" % len(run_paths)))
+                _flush_run(dict_index, run_paths[-1])
+                dict_index = defaultdict(list)
+                memory_used = 0
+        if dict_index:
+            run_paths.append(os.path.join(run_dir, "run_%06d" % len(run_paths)))
+            _flush_run(dict_index, run_paths[-1])
+        logger.info("merge %d runs into %s", len(run_paths), output)
+        with IndexWriter(output, codec, ngram_index=ngram_index) as writer:
+            for word, postings in merge_runs(run_paths):
+                writer.add(word, postings)
+
+
+def build_inverted_index_parallel(documents, stop_words, workers, ranked=False, positional=False):
+    """Build inverted index over shards of documents in a process pool"""
+    logger.info("building inverted index with %d workers", workers)
+    items = list(documents.items())
+    shard_count = workers * SHARDS_PER_WORKER
+    shard_size = max(1, -(-len(items) // shard_count))
+    shards = [
+        (dict(items[start:start + shard_size]), stop_words, ranked, positional)
+        for start in range(0, len(items), shard_size)
+    ]
+    with Pool(workers) as pool:
+        partial_indexes = pool.map(_build_partial_index, shards)
+    return merge_partial_indexes(partial_indexes, set(stop_words) if positional else None)
+
+
 def callback_build(arguments):
     """Callback for build mod"""
-    return process_build(arguments.dataset_path, arguments.stop_words, arguments.output)
+    return process_build(
+        arguments.dataset_path, arguments.stop_words, arguments.output,
+        codec=arguments.codec, workers=arguments.workers,
+        memory_limit=arguments.memory_limit, ranked=arguments.ranked,
+        positional=arguments.positional, shards=arguments.shards,
+        doc_store=arguments.doc_store, ngram_index=arguments.ngram_index,
+        reorder=arguments.reorder,
+    )
 
 
-def process_build(dataset_path, stop_words_path, output):
-    """Contains building inverted index functionality"""
+def process_build(dataset_path, stop_words_path, output, codec=DEFAULT_POSTING_CODEC,
+                  workers=DEFAULT_BUILD_WORKERS, memory_limit=None, ranked=False,
+                  positional=False, shards=DEFAULT_SHARD_COUNT, doc_store=False,
+                  ngram_index=False, reorder=False):
+    """Contains building inverted index functionality
+
+    With memory_limit the dataset is streamed from disk and nothing is returned,
+    with several shards the list of shard indexes is returned. Dataset "-" is
+    read from standard input. Document store with texts is written next to
+    the index, with memory_limit streaming the dataset once more.
+    Reordered index renumbers documents and translates ids back in answers.
+    """
     logger.debug("call build with: %s and %s", dataset_path, output)
+    if memory_limit is not None and (ranked or positional or reorder):
+        raise ValueError("ranked, positional or reordered index can not be built with memory limit")
+    if shards > 1 and memory_limit is not None:
+        raise ValueError("sharded index can not be built with memory limit")
+    if memory_limit is not None and doc_store and str(dataset_path) == STDIN_DATASET_PATH:
+        raise ValueError("document store of standard input can not be built with memory limit")
+    if not doc_store and os.path.exists(document_store_path(output)):
+        os.remove(document_store_path(output))
+    if memory_limit is not None:
+        stop_words = load_stop_words(stop_words_path)
+        build_inverted_index_external(
+            dataset_path, stop_words, output, memory_limit, codec, ngram_index
+        )
+        if doc_store:
+            write_document_store(document_store_path(output), iter_documents(dataset_path))
+        remove_segments(output)
+        return None
     documents = load_documents(dataset_path)
     stop_words = load_stop_words(stop_words_path)
-    inverted_index = build_inverted_index(documents, stop_words)
-    inverted_index.dump(output)
+    if doc_store:
+        write_document_store(document_store_path(output), documents.items())
+    if shards > 1:
+        return build_sharded_index(
+            documents, stop_words, output, shards, codec, workers, ranked, positional,
+            ngram_index, reorder,
+        )
+    inverted_index = build_documents_index(documents, stop_words, workers, ranked, positional, reorder)
+    inverted_index.dump(output, codec, ngram_index)
+    remove_segments(output)
+    return inverted_index
+
+
+def build_documents_index(documents, stop_words, workers=DEFAULT_BUILD_WORKERS, ranked=False,
+                          positional=False, reorder=False) -> InvertedIndex:
+    """Build index in one or several processes, renumbering similar documents close if asked"""
+    docmap = None
+    if reorder:
+        docmap = reorder_documents(documents, stop_words)
+        documents = {new_id: documents[doc_id] for new_id, doc_id in enumerate(docmap)}
+    if workers > 1:
+        inverted_index = build_inverted_index_parallel(
+            documents, stop_words, workers, ranked, positional
+        )
+    else:
+        inverted_index = build_inverted_index(documents, stop_words, ranked, positional)
+    inverted_index.docmap = docmap
     return inverted_index
 
 
+def build_sharded_index(documents: dict, stop_words, output, shards: int,
+                        codec=DEFAULT_POSTING_CODEC, workers=DEFAULT_BUILD_WORKERS,
+                        ranked=False, positional=False, ngram_index=False, reorder=False) -> list:
+    """Build one index file per shard of documents split by hash of id and write manifest"""
+    shard_documents = [dict() for _ in range(shards)]
+    for idx, document in documents.items():
+        shard_documents[shard_number(idx, shards)][idx] = document
+    shard_names = []
+    shard_indexes = []
+    for number, documents in enumerate(shard_documents):
+        shard_name = "%s.shard%03d" % (os.path.basename(str(output)), number)
+        shard_path = os.path.join(os.path.dirname(str(output)), shard_name)
+        logger.info("build shard %s with %d documents", shard_path, len(documents))
+        inverted_index = build_documents_index(
+            documents, stop_words, workers, ranked, positional, reorder
+        )
+        inverted_index.dump(shard_path, codec, ngram_index)
+        remove_segments(shard_path)
+        if os.path.exists(document_store_path(shard_path)):
+            os.remove(document_store_path(shard_path))
+        shard_names.append(shard_name)
+        shard_indexes.append(inverted_index)
+    save_shards_manifest(output, shard_names)
+    remove_segments(output)
+    return shard_indexes
+
+
+def callback_add(arguments):
+    """Callback for add mod"""
+    return process_add(
+        arguments.inverted_index_path, arguments.dataset_path, arguments.stop_words,
+        codec=arguments.codec,
+    )
+
+
+def process_add(inverted_index_path, dataset_path, stop_words_path, codec=DEFAULT_POSTING_CODEC):
+    """Write documents as a new segment of existing inverted index"""
+    logger.debug("call add with: %s and %s", dataset_path, inverted_index_path)
+    documents = load_documents(dataset_path)
+    stop_words = load_stop_words(stop_words_path)
+    doc_store = os.path.exists(document_store_path(inverted_index_path))
+    if is_sharded_index(inverted_index_path):
+        paths = shard_paths(inverted_index_path)
+        partition = load_shards_manifest(inverted_index_path)["partition"]
+        return [
+            add_segment(path, {
+                idx: document for idx, document in documents.items()
+                if shard_number(idx, len(paths), partition) == number
+            }, stop_words, codec, doc_store)
+            for number, path in enumerate(paths)
+        ]
+    return add_segment(inverted_index_path, documents, stop_words, codec, doc_store)
+
+
+def add_segment(inverted_index_path, documents: dict, stop_words, codec=DEFAULT_POSTING_CODEC,
+                doc_store=False):
+    """Write documents as a new segment of one index file and list it in the manifest
+
+    With doc_store texts of the documents are written to the store of the segment.
+    """
+    features = index_file_features(inverted_index_path)
+    inverted_index = build_inverted_index(documents, stop_words, features["ranked"], features["positional"])
+    manifest = load_segments_manifest(inverted_index_path)
+    segment_name = "%s.seg%06d" % (os.path.basename(str(inverted_index_path)), manifest["next_segment"])
+    segment_path = os.path.join(os.path.dirname(str(inverted_index_path)), segment_name)
+    logger.info("write segment %s with %d documents", segment_path, len(documents))
+    write_segment(
+        segment_path, (
+            (word, postings, inverted_index.term_freqs[word] if inverted_index.ranked else None,
+             inverted_index.positions[word] if inverted_index.positional else None)
+            for word, postings in inverted_index.items()
+        ), documents.keys(), codec, inverted_index.doc_lengths, inverted_index.positional,
+        stop_words, features["ngram_index"],
+    )
+    if doc_store:
+        write_document_store(document_store_path(segment_path), sorted(documents.items()))
+    manifest["segments"].append(segment_name)
+    manifest["next_segment"] += 1
+    save_segments_manifest(inverted_index_path, manifest)
+    return segment_path
+
+
+def callback_merge(arguments):
+    """Callback for merge mod"""
+    return process_merge(
+        arguments.inverted_index_path, tier_factor=arguments.tier_factor,
+        merge_all=arguments.merge_all, codec=arguments.codec,
+    )
+
+
+def process_merge(inverted_index_path, tier_factor=DEFAULT_TIER_FACTOR, merge_all=False,
+                  codec=DEFAULT_POSTING_CODEC):
+    """Merge segments of similar size, or all of them into the base index"""
+    if is_sharded_index(inverted_index_path):
+        for shard_path in shard_paths(inverted_index_path):
+            process_merge(shard_path, tier_factor, merge_all, codec)
+        return
+    index_dir = os.path.dirname(str(inverted_index_path))
+    while True:
+        manifest = load_segments_manifest(inverted_index_path)
+        paths = [str(inverted_index_path)] + [
+            os.path.join(index_dir, segment_name) for segment_name in manifest["segments"]
+        ]
+        if merge_all:
+            plan = (0, len(paths)) if len(paths) > 1 else None
+        else:
+            plan = plan_tiered_merge([os.path.getsize(path) for path in paths], tier_factor)
+        if plan is None:
+            return
+        start, end = plan
+        logger.info("merge segments %d..%d of %s", start, end - 1, inverted_index_path)
+        segments = [open_index_file(path) for path in paths[start:end]]
+        if start == 0:
+            output = str(inverted_index_path)
+        else:
+            segment_name = "%s.seg%06d" % (
+                os.path.basename(str(inverted_index_path)), manifest["next_segment"]
+            )
+            manifest["next_segment"] += 1
+            output = os.path.join(index_dir, segment_name)
+        merge_segments(segments, output, codec, keep_doc_ids=start > 0)
+        for segment in segments:
+            if hasattr(segment, "close"):
+                segment.close()
+        merge_document_stores(paths[start:end], output)
+        merged_names = manifest["segments"][max(start - 1, 0):end - 1]
+        manifest["segments"][max(start - 1, 0):end - 1] = [] if start == 0 else [os.path.basename(output)]
+        save_segments_manifest(inverted_index_path, manifest)
+        for segment_name in merged_names:
+            segment_path = os.path.join(index_dir, segment_name)
+            os.remove(segment_path)
+            if os.path.exists(document_store_path(segment_path)):
+                os.remove(document_store_path(segment_path))
+        if merge_all:
+            return
+
+
+def merge_document_stores(paths: list, output: str):
+    """Write latest texts from stores of merged index files into the store of the output"""
+    store_paths = [document_store_path(path) for path in paths if os.path.exists(document_store_path(path))]
+    if not store_paths:
+        return
+    logger.info("write document store %s", document_store_path(output))
+    written_ids = set()
+    with SegmentedDocumentStore(store_paths) as stores, \
+            DocumentStoreWriter(document_store_path(output)) as writer:
+        for store in reversed(stores.stores):
+            for doc_id, text in store.items():
+                if doc_id not in written_ids:
+                    writer.add(doc_id, text)
+                    written_ids.add(doc_id)
+
+
+def index_file_paths(inverted_index_path) -> list:
+    """Return paths of all files of the index: shards, base file and segments"""
+    if is_sharded_index(inverted_index_path):
+        return [
+            path for shard_path in shard_paths(inverted_index_path)
+            for path in index_file_paths(shard_path)
+        ]
+    index_dir = os.path.dirname(str(inverted_index_path))
+    return [str(inverted_index_path)] + [
+        os.path.join(index_dir, segment_name)
+        for segment_name in load_segments_manifest(inverted_index_path)["segments"]
+    ]
+
+
+def collect_index_stats(inverted_index_path, top_terms: int = DEFAULT_STATS_TOP_TERMS) -> dict:
+    """Describe every file of the index and sum postings over all of them"""
+    files = []
+    for path in index_file_paths(inverted_index_path):
+        if not is_mapped_index(path):
+            raise ValueError("%s is stored in the format without header, rebuild it" % path)
+        with MappedInvertedIndex(path) as mapped_index:
+            files.append(mapped_index.stats(top_terms))
+    posting_count = sum(file_stats["postings"] for file_stats in files)
+    posting_bytes = sum(file_stats["posting_bytes"] for file_stats in files)
+    total = {
+        "files": len(files),
+        "file_bytes": sum(file_stats["file_bytes"] for file_stats in files),
+        "postings": posting_count,
+        "posting_bytes": posting_bytes,
+        "bytes_per_posting": posting_bytes / posting_count if posting_count else None,
+    }
+    return {"index": str(inverted_index_path), "files": files, "total": total}
+
+
+def format_index_stats(stats: dict) -> str:
+    """Format statistics of the index as human readable text"""
+    lines = ["index %s" % stats["index"]]
+    for file_stats in stats["files"]:
+        lines.append("file %s" % file_stats["path"])
+        lines.append("  format version %d, codec %s, %d bytes, features: %s" % (
+            file_stats["format_version"], file_stats["codec"], file_stats["file_bytes"],
+            ", ".join(file_stats["features"]) or "none",
+        ))
+        lines.append("  sections: " + ", ".join(
+            "%s %d" % (name, length) for name, length in file_stats["sections"].items()
+        ))
+        lines.append("  documents %s, terms %d, postings %d, posting bytes %d, bytes per posting %s" % (
+            file_stats["documents"] if file_stats["documents"] is not None else "unknown",
+            file_stats["terms"], file_stats["postings"], file_stats["posting_bytes"],
+            "%.3f" % file_stats["bytes_per_posting"] if file_stats["bytes_per_posting"] else "-",
+        ))
+        lines.append("  list codecs: " + ", ".join(
+            "%s %d" % (codec, count) for codec, count in sorted(file_stats["list_codecs"].items())
+        ))
+        lines.append("  posting lengths: " + ", ".join(
+            "%s: %d" % (bucket, count) for bucket, count in file_stats["posting_lengths"].items()
+        ))
+        lines.append("  top terms: " + ", ".join(
+            "%s %d (%d bytes)" % (term["term"], term["postings"], term["bytes"])
+            for term in file_stats["top_terms"]
+        ))
+    total = stats["total"]
+    lines.append("total: %d files, %d bytes, postings %d, posting bytes %d, bytes per posting %s" % (
+        total["files"], total["file_bytes"], total["postings"], total["posting_bytes"],
+        "%.3f" % total["bytes_per_posting"] if total["bytes_per_posting"] else "-",
+    ))
+    return "\n".join(lines)
+
+
+def callback_stats(arguments):
+    """Callback for stats mod"""
+    return process_stats(
+        arguments.inverted_index_path, as_json=arguments.as_json, top_terms=arguments.top_terms,
+    )
+
+
+def process_stats(inverted_index_path, as_json=False, top_terms=DEFAULT_STATS_TOP_TERMS):
+    """Print statistics of the index as text or JSON"""
+    stats = collect_index_stats(inverted_index_path, top_terms)
+    if as_json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print(format_index_stats(stats))
+    return stats
+
+
+def close_index(inverted_index):
+    """Release files of the index if it keeps any open"""
+    if hasattr(inverted_index, "close"):
+        inverted_index.close()
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """Answers GET /query?q=... with one line of document ids per query"""
+    def do_GET(self):
+        """Process query request"""
+        url = urlparse(self.path)
+        if url.path != "/query":
+            self.send_error(404, "use /query?q=<words>")
+            return
+        queries = parse_qs(url.query).get("q", [])
+        inverted_index = self.server.acquire_index()
+        lines = []
+        try:
+            for query in queries:
+                document_ids = run_query(inverted_index, query.split(), cache=self.server.cache)
+                lines.append(",".join(str(x) for x in document_ids))
+        except ValueError as exception:
+            self.send_error(400, str(exception))
+            return
+        finally:
+            self.server.release_index(inverted_index)
+        body = "".join(line + "\n" for line in lines).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server answering queries against inverted index loaded once
+
+    Requests count uses of the index they answer with, so the index
+    replaced on reload is closed once the last request using it finishes.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, inverted_index_path, compact=False,
+                 cache_size=DEFAULT_QUERY_CACHE_SIZE):
+        self.inverted_index_path = inverted_index_path
+        self.compact = compact
+        self.inverted_index = open_index(inverted_index_path, compact)
+        self._index_lock = threading.Lock()
+        self._index_users = dict()
+        self.cache = QueryCache(cache_size) if cache_size > 0 else None
+        if self.cache is not None:
+            self.cache.reset(self.inverted_index)
+        super().__init__(server_address, QueryRequestHandler)
+
+    def acquire_index(self):
+        """Return the current index counting the request using it"""
+        with self._index_lock:
+            key = id(self.inverted_index)
+            self._index_users[key] = self._index_users.get(key, 0) + 1
+            return self.inverted_index
+
+    def release_index(self, inverted_index):
+        """Finish using the index, close it if it is replaced and not used anymore"""
+        with self._index_lock:
+            key = id(inverted_index)
+            self._index_users[key] -= 1
+            if self._index_users[key] > 0:
+                return
+            del self._index_users[key]
+            if inverted_index is self.inverted_index:
+                return
+        close_index(inverted_index)
+
+    def reload(self) -> bool:
+        """Reopen inverted index, requests in flight keep using the old one
+
+        If the index cannot be opened, the error is logged and the old
+        index keeps serving. Return whether the index was replaced.
+        """
+        logger.info("reload inverted index %s", self.inverted_index_path)
+        try:
+            inverted_index = open_index(self.inverted_index_path, self.compact)
+        except Exception as error:
+            logger.error("cannot reload inverted index %s, keep serving the old one: %s",
+                         self.inverted_index_path, error)
+            return False
+        with self._index_lock:
+            replaced_index = self.inverted_index
+            self.inverted_index = inverted_index
+            if self.cache is not None:
+                logger.info("query cache: %d hits, %d misses", self.cache.hits, self.cache.misses)
+                self.cache.reset(inverted_index)
+            if id(replaced_index) in self._index_users:
+                return True
+        close_index(replaced_index)
+        return True
+
+    def server_close(self):
+        """Stop listening and release the index"""
+        super().server_close()
+        close_index(self.inverted_index)
+
+
+def callback_serve(arguments):
+    """Callback for serve mod"""
+    return process_serve(
+        arguments.inverted_index_path, arguments.host, arguments.port,
+        reload_on_signal=arguments.reload_on_signal, compact=arguments.compact,
+        cache_size=arguments.cache_size,
+    )
+
+
+def process_serve(inverted_index_path, host=DEFAULT_SERVER_HOST, port=DEFAULT_SERVER_PORT,
+                  reload_on_signal=False, compact=False, cache_size=DEFAULT_QUERY_CACHE_SIZE):
+    """Serve queries over HTTP until interrupted"""
+    server = QueryServer((host, port), inverted_index_path, compact, cache_size)
+    if reload_on_signal:
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.reload())
+    logger.info("serve inverted index %s on %s:%d", inverted_index_path, *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 def callback_query(arguments):
     """Callback for query mod"""
     if arguments.query_list is not None:
-        process_list_queries(arguments.inverted_index_path, arguments.query_list)
+        process_list_queries(
+            arguments.inverted_index_path, arguments.query_list,
+            arguments.top_k, arguments.boolean, arguments.compact, arguments.cache_size,
+            arguments.with_text,
+        )
     else:
-        process_file_queries(arguments.inverted_index_path, arguments.query_file)
+        process_file_queries(
+            arguments.inverted_index_path, arguments.query_file,
+            arguments.top_k, arguments.boolean, arguments.compact, arguments.cache_size,
+            arguments.with_text,
+        )
+
+
+class QueryCache:
+    """LRU cache of query answers and intersections of the rarest term pairs
+
+    Keys are sorted sets of terms, so repeated and reordered queries share
+    an entry. The cache is bound to one index and is cleared as soon as
+    another index is queried through it. Cache bound with reset, e.g. to
+    reloaded index, answers queries to other indexes without caching them.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inverted_index = None
+        self._bound = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Drop all cached answers"""
+        with self._lock:
+            self._entries.clear()
+
+    def reset(self, inverted_index):
+        """Drop all cached answers and bind the cache to the index"""
+        with self._lock:
+            self._entries.clear()
+            self._inverted_index = inverted_index
+            self._bound = True
+
+    def _get(self, key, inverted_index):
+        with self._lock:
+            answer = self._entries.get(key) if inverted_index is self._inverted_index else None
+            if answer is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return answer
+
+    def _put(self, key, answer, inverted_index):
+        with self._lock:
+            if inverted_index is not self._inverted_index:
+                return
+            self._entries[key] = tuple(answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _use_index(self, inverted_index) -> bool:
+        """Bind unbound cache to the index, return whether answers of the index are cached"""
+        with self._lock:
+            if inverted_index is self._inverted_index:
+                return True
+            if self._bound:
+                return False
+            self._entries.clear()
+            self._inverted_index = inverted_index
+            return True
+
+    def query(self, inverted_index, words: list) -> list:
+        """Return answer to the query of words using and filling the cache"""
+        if not self._use_index(inverted_index):
+            return inverted_index.query(list(words))
+        key = tuple(sorted(set(words)))
+        answer = self._get(key, inverted_index)
+        if answer is not None:
+            return list(answer)
+        if len(key) <= 2:
+            answer = inverted_index.query(list(key))
+        else:
+            if hasattr(inverted_index, "doc_freq"):
+                pair = tuple(sorted(sorted(key, key=inverted_index.doc_freq)[:2]))
+            else:
+                pair = key[:2]
+            pair_answer = self._get(pair, inverted_index)
+            if pair_answer is None:
+                pair_answer = inverted_index.query(list(pair))
+                self._put(pair, pair_answer, inverted_index)
+            answer = []
+            if pair_answer:
+                answer = intersect_with_terms(
+                    inverted_index, list(pair_answer), [word for word in key if word not in pair]
+                )
+        self._put(key, answer, inverted_index)
+        return list(answer)
+
+
+def intersect_with_terms(inverted_index, answer: list, words: list) -> list:
+    """Intersect answer with posting lists of the words from the rarest one
+
+    Index without posting lists of original document ids, e.g. reordered,
+    segmented or sharded one, is queried for the words instead.
+    """
+    if not hasattr(inverted_index, "postings") or getattr(inverted_index, "docmap", None) is not None:
+        return intersect_sorted(answer, inverted_index.query(words))
+    words.sort(key=lambda word: (is_term_pattern(word), inverted_index.doc_freq(word)))
+    for word in words:
+        if not answer:
+            break
+        answer = intersect_sorted(answer, term_postings(inverted_index, word))
+    return answer
+
+
+def run_query(inverted_index, words: list, top_k=None, boolean=False, cache=None) -> list:
+    """Return answer to query of words, boolean expression or top_k ids ranked by BM25
+
+    Only plain queries of words go through the cache.
+    """
+    if boolean:
+        return inverted_index.query_boolean(" ".join(words))
+    if top_k is None and cache is not None:
+        return cache.query(inverted_index, words)
+    if top_k is None:
+        return inverted_index.query(words)
+    if not getattr(inverted_index, "ranked", False):
+        raise missing_feature_error(inverted_index, "ranked", "ranked", "--ranked")
+    return [doc_id for doc_id, _ in inverted_index.query_ranked(words, top_k)]
+
+
+def run_query_or_skip(inverted_index, words: list, top_k=None, boolean=False, cache=None) -> list:
+    """Return answer to the query, or log why it is invalid and answer nothing
+
+    A bad query in a batch then costs only its own answer line.
+    """
+    try:
+        return run_query(inverted_index, words, top_k, boolean, cache)
+    except ValueError as error:
+        logger.warning("cannot answer query %r: %s", " ".join(words), error)
+        return []
+
+
+def open_document_store(inverted_index_path):
+    """Open document store built next to the index together with stores of its shards and segments"""
+    store_path = document_store_path(inverted_index_path)
+    if not os.path.exists(store_path):
+        raise ValueError("query with text needs index built with --doc-store")
+    store_paths = [store_path] + [
+        document_store_path(path) for path in index_file_paths(inverted_index_path)
+        if path != str(inverted_index_path) and os.path.exists(document_store_path(path))
+    ]
+    return SegmentedDocumentStore(store_paths)
+
+
+def print_answer(document_ids: list, document_store=None) -> str:
+    """Print ids of documents in one line, or every document with snippet of its text
+
+    Answers with texts are separated by empty lines.
+    """
+    if document_store is not None:
+        for doc_id in document_ids:
+            text = document_store.get(doc_id)
+            if text is None:
+                logger.warning("document %d is missing from the document store", doc_id)
+                text = ""
+            print("%d\t%s" % (doc_id, text[:DEFAULT_SNIPPET_LENGTH]))
+        print()
+    document_ids = [str(x) for x in document_ids]
+    document_ids = ",".join(document_ids)
+    if document_store is None:
+        print(document_ids)
+    return document_ids
 
 
-def process_file_queries(inverted_index_path, query_file):
+def process_file_queries(inverted_index_path, query_file, top_k=None, boolean=False,
+                         compact=False, cache_size=DEFAULT_QUERY_CACHE_SIZE, with_text=False):
     """Contains using inverted index functionality for queries from file"""
-    inverted_index = InvertedIndex.load(inverted_index_path)
+    inverted_index = open_index(inverted_index_path, compact)
+    cache = QueryCache(cache_size) if cache_size > 0 else None
+    document_store = open_document_store(inverted_index_path) if with_text else None
     for query in query_file:
         query = query.strip()
         query = query.split()
-        document_ids = inverted_index.query(query)
-        document_ids = [str(x) for x in document_ids]
-        document_ids = ",".join(document_ids)
-        print(document_ids)
+        document_ids = run_query_or_skip(inverted_index, query, top_k, boolean, cache)
+        document_ids = print_answer(document_ids, document_store)
+    if cache is not None:
+        logger.info("query cache: %d hits, %d misses", cache.hits, cache.misses)
     return document_ids
 
 
-def process_list_queries(inverted_index_path, query_list):
+def process_list_queries(inverted_index_path, query_list, top_k=None, boolean=False,
+                         compact=False, cache_size=DEFAULT_QUERY_CACHE_SIZE, with_text=False):
     """Contains using inverted index functionality for queries from comand string"""
-    inverted_index = InvertedIndex.load(inverted_index_path)
+    inverted_index = open_index(inverted_index_path, compact)
+    cache = QueryCache(cache_size) if cache_size > 0 else None
+    document_store = open_document_store(inverted_index_path) if with_text else None
     for query in query_list:
-        document_ids = inverted_index.query(query)
-        document_ids = [str(x) for x in document_ids]
-        document_ids = ",".join(document_ids)
-        print(document_ids)
+        document_ids = run_query_or_skip(inverted_index, query, top_k, boolean, cache)
+        document_ids = print_answer(document_ids, document_store)
+    if cache is not None:
+        logger.info("query cache: %d hits, %d misses", cache.hits, cache.misses)
     return document_ids
 
 
+def memory_size(string):
+    """Parse memory size with optional K, M or G suffix into bytes"""
+    string = string.strip().upper().rstrip("B")
+    unit = string[-1:] if string[-1:] in MEMORY_SIZE_UNITS else ""
+    try:
+        size = int(string[:len(string) - len(unit)]) * MEMORY_SIZE_UNITS[unit]
+    except ValueError as exception:
+        raise ArgumentTypeError("invalid memory size '%s'" % string) from exception
+    if size <= 0:
+        raise ArgumentTypeError("memory size should be positive")
+    return size
+
+
 def setup_parser(parser):
     """Sets up subparesers and keywords for CLI"""
     subparsers = parser.add_subparsers(help="choose comand")
@@ -264,7 +3330,7 @@ def setup_parser(parser):
     build_parser.add_argument(
         "-d", "--dataset", dest='dataset_path', required=False,
         default=DEFAULT_DATASET_PATH,
-        help="path to dataset to load",
+        help="path to dataset to load, may be compressed with gzip, bzip2 or xz, - for stdin",
     )
     build_parser.add_argument(
         "-o", "--output", required=False,
@@ -276,6 +3342,46 @@ def setup_parser(parser):
         default=DEFAULT_STOP_WORDS_PATH,
         help="path to stop words",
     )
+    build_parser.add_argument(
+        "--codec", required=False, choices=sorted(POSTING_CODECS),
+        default=DEFAULT_POSTING_CODEC,
+        help="posting list encoding",
+    )
+    build_parser.add_argument(
+        "-w", "--workers", type=int, required=False,
+        default=DEFAULT_BUILD_WORKERS,
+        help="number of processes to build index with",
+    )
+    build_parser.add_argument(
+        "--memory-limit", dest="memory_limit", type=memory_size, required=False,
+        default=None,
+        help="stream dataset and spill postings to disk above this size, e.g. 512M",
+    )
+    build_parser.add_argument(
+        "--ranked", required=False, action="store_true",
+        help="store term frequencies and document lengths for BM25 ranking",
+    )
+    build_parser.add_argument(
+        "--positions", dest="positional", required=False, action="store_true",
+        help="store positions of terms for phrase queries",
+    )
+    build_parser.add_argument(
+        "--shards", type=int, required=False,
+        default=DEFAULT_SHARD_COUNT,
+        help="split documents by id into this many index files queried in parallel",
+    )
+    build_parser.add_argument(
+        "--doc-store", dest="doc_store", required=False, action="store_true",
+        help="store compressed texts of documents next to the index",
+    )
+    build_parser.add_argument(
+        "--ngram-index", dest="ngram_index", required=False, action="store_true",
+        help="store n-grams of terms for fuzzy queries like word~ or word~2",
+    )
+    build_parser.add_argument(
+        "--reorder", required=False, action="store_true",
+        help="renumber documents so that similar ones get close ids for smaller posting lists",
+    )
     build_parser.add_argument(
         "-v", "--verbocity", dest='verbocity', required=False,
         default=0, action='count',
@@ -297,6 +3403,27 @@ def setup_parser(parser):
         "--query", required=False, dest="query_list", action="append", nargs="+",
         help="query string",
     )
+    query_parser.add_argument(
+        "--top-k", dest="top_k", type=int, required=False, default=None,
+        help="return this many documents ranked by BM25 instead of boolean answer",
+    )
+    query_parser.add_argument(
+        "--boolean", required=False, action="store_true",
+        help='treat queries as expressions with AND, OR, NOT, parentheses and "phrases"',
+    )
+    query_parser.add_argument(
+        "--compact", required=False, action="store_true",
+        help="load index into one in-memory array of postings instead of memory mapping it",
+    )
+    query_parser.add_argument(
+        "--cache-size", dest="cache_size", type=int, required=False,
+        default=DEFAULT_QUERY_CACHE_SIZE,
+        help="number of answers to keep in LRU cache of plain queries, 0 disables it",
+    )
+    query_parser.add_argument(
+        "--with-text", dest="with_text", required=False, action="store_true",
+        help="print every found document with snippet of its text from document store",
+    )
     query_file_group = query_parser.add_mutually_exclusive_group(required=False)
     query_file_group.add_argument(
         "--query-file-utf8", dest="query_file", type=EncodedFileType("r", encoding="utf-8"),
@@ -315,6 +3442,132 @@ def setup_parser(parser):
     )
     query_parser.set_defaults(callback=callback_query)
 
+    add_parser = subparsers.add_parser(
+        "add", help="add documents to inverted index as a new segment",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    add_parser.add_argument(
+        "-i", "--index", required=False,
+        dest="inverted_index_path",
+        default=DEFAULT_INVERTED_INDEX_STORE_PATH,
+        help="path to inverted index to add documents to",
+    )
+    add_parser.add_argument(
+        "-d", "--dataset", dest='dataset_path', required=True,
+        help="path to dataset with new or updated documents",
+    )
+    add_parser.add_argument(
+        "-s", "--stop-words", dest='stop_words', required=False,
+        default=DEFAULT_STOP_WORDS_PATH,
+        help="path to stop words",
+    )
+    add_parser.add_argument(
+        "--codec", required=False, choices=sorted(POSTING_CODECS),
+        default=DEFAULT_POSTING_CODEC,
+        help="posting list encoding",
+    )
+    add_parser.add_argument(
+        "-v", "--verbocity", dest='verbocity', required=False,
+        default=0, action='count',
+        help="choose verbocity level",
+    )
+    add_parser.set_defaults(callback=callback_add)
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="merge segments of inverted index",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    merge_parser.add_argument(
+        "-i", "--index", required=False,
+        dest="inverted_index_path",
+        default=DEFAULT_INVERTED_INDEX_STORE_PATH,
+        help="path to inverted index to merge segments of",
+    )
+    merge_parser.add_argument(
+        "--tier-factor", dest="tier_factor", type=int, required=False,
+        default=DEFAULT_TIER_FACTOR,
+        help="merge this many consecutive segments of one size tier",
+    )
+    merge_parser.add_argument(
+        "--all", dest="merge_all", required=False, action="store_true",
+        help="merge all segments into the base index",
+    )
+    merge_parser.add_argument(
+        "--codec", required=False, choices=sorted(POSTING_CODECS),
+        default=DEFAULT_POSTING_CODEC,
+        help="posting list encoding",
+    )
+    merge_parser.add_argument(
+        "-v", "--verbocity", dest='verbocity', required=False,
+        default=0, action='count',
+        help="choose verbocity level",
+    )
+    merge_parser.set_defaults(callback=callback_merge)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="load inverted index once and answer queries over HTTP",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    serve_parser.add_argument(
+        "-i", "--index", required=False,
+        dest="inverted_index_path",
+        default=DEFAULT_INVERTED_INDEX_STORE_PATH,
+        help="path to read inverted index",
+    )
+    serve_parser.add_argument(
+        "--host", required=False, default=DEFAULT_SERVER_HOST,
+        help="address to listen on",
+    )
+    serve_parser.add_argument(
+        "-p", "--port", type=int, required=False, default=DEFAULT_SERVER_PORT,
+        help="port to listen on",
+    )
+    serve_parser.add_argument(
+        "--reload-on-signal", dest="reload_on_signal", required=False, action="store_true",
+        help="reopen inverted index on SIGHUP",
+    )
+    serve_parser.add_argument(
+        "--compact", required=False, action="store_true",
+        help="load index into one in-memory array of postings instead of memory mapping it",
+    )
+    serve_parser.add_argument(
+        "--cache-size", dest="cache_size", type=int, required=False,
+        default=DEFAULT_QUERY_CACHE_SIZE,
+        help="number of answers to keep in LRU cache of plain queries, 0 disables it",
+    )
+    serve_parser.add_argument(
+        "-v", "--verbocity", dest='verbocity', required=False,
+        default=0, action='count',
+        help="choose verbocity level",
+    )
+    serve_parser.set_defaults(callback=callback_serve)
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="show statistics of inverted index read from its tables",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    stats_parser.add_argument(
+        "-i", "--index", required=False,
+        dest="inverted_index_path",
+        default=DEFAULT_INVERTED_INDEX_STORE_PATH,
+        help="path to read inverted index",
+    )
+    stats_parser.add_argument(
+        "--json", dest="as_json", required=False, action="store_true",
+        help="print statistics in JSON",
+    )
+    stats_parser.add_argument(
+        "--top-terms", dest="top_terms", type=int, required=False,
+        default=DEFAULT_STATS_TOP_TERMS,
+        help="number of terms with the longest posting lists to show",
+    )
+    stats_parser.add_argument(
+        "-v", "--verbocity", dest='verbocity', required=False,
+        default=0, action='count',
+        help="choose verbocity level",
+    )
+    stats_parser.set_defaults(callback=callback_stats)
+
 def setup_logging(arguments):
     """Sets up logging for CLI"""
     verbocity_dict = {
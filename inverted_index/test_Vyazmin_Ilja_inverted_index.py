@@ -1,13 +1,35 @@
 from textwrap import dedent
+from io import TextIOWrapper
+import bz2
+import gzip
+import io
+import json
+import lzma
+import os
+import struct
+import sys
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from argparse import ArgumentTypeError
 
 import pytest
 import logging
 
+import task_Vyazmin_Ilja_inverted_index
 from task_Vyazmin_Ilja_inverted_index import (
 	InvertedIndex, build_inverted_index, load_documents, load_stop_words,
 	process_file_queries, process_list_queries, DEFAULT_INVERTED_INDEX_STORE_PATH,
-	process_build, DEFAULT_STOP_WORDS_PATH, DEFAULT_DATASET_PATH
+	process_build, DEFAULT_STOP_WORDS_PATH, DEFAULT_DATASET_PATH,
+	MappedInvertedIndex, open_index, encode_postings, decode_postings, CODEC_VBYTE,
+	galloping_search, intersect_postings, build_inverted_index_parallel,
+	memory_size, process_add, process_merge, plan_tiered_merge, SegmentedIndex,
+	QueryServer, Bm25, RoaringBitmap, CODEC_AUTO, CODEC_ROARING,
+	parse_boolean_query, CompactInvertedIndex, QueryCache, ShardedIndex,
+	BloomFilter, DocumentStore, write_document_store, expand_term, edit_distance,
+	reorder_documents, process_stats
 )
+from benchmark_Vyazmin_Ilja_inverted_index import generate_corpus, generate_queries, run_benchmark
 
 DATASET_TINY_STR = dedent("""\
 	123	some words A_word and nothing
@@ -187,4 +209,731 @@ def test_process_file_list_can_process_all_qutries_from_list(tiny_dataset_fio, s
 		inverted_index_path=tiny_index,
 		query_list=[["A_word", "B_word"]]
 	)
-	assert ids == '37'
\ No newline at end of file
+	assert ids == '37'
+
+
+def test_bad_queries_get_empty_answers_and_batch_continues(tmpdir, tiny_dataset_fio, stop_words_fio, tiny_index, capsys, caplog):
+	process_build(dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio, output=tiny_index)
+	query_fio = tmpdir.join("queries.txt")
+	query_fio.write("(B_word\nA_word OR B_word\na~ OR B_word\nB_word\n")
+	with open(query_fio) as query_fin:
+		process_file_queries(tiny_index, query_fin, boolean=True)
+	assert capsys.readouterr().out == "\n2,37,123\n\n2,37\n"
+	assert "cannot answer query '(B_word'" in caplog.text
+	process_list_queries(tiny_index, [["A_word"], ["B_word"]], top_k=2)
+	assert capsys.readouterr().out == "\n\n"
+	assert "ranked query needs index built with --ranked" in caplog.text
+
+
+def test_mapped_index_decodes_only_requested_terms(tiny_dataset_fio, stop_words_fio, tiny_index):
+	documents = load_documents(tiny_dataset_fio)
+	stop_words = load_stop_words(stop_words_fio)
+	build_inverted_index(documents, stop_words).dump(tiny_index)
+	with MappedInvertedIndex(tiny_index) as mapped_index:
+		assert len(mapped_index) == 16
+		assert "A_word" in mapped_index
+		assert "to_be" not in mapped_index
+		assert mapped_index.postings("B_word") == [2, 37]
+		assert mapped_index.doc_freq("some") == 2
+		assert list(mapped_index.terms()) == sorted(mapped_index.terms())
+		assert sorted(mapped_index.query(["A_word", "B_word"])) == [37]
+		assert mapped_index.query(["word_does_not_exist", "A_word"]) == []
+
+
+def test_can_load_legacy_index_format(tmpdir):
+	index_fio = tmpdir.join("legacy.index")
+	legacy_dump = struct.pack('>i', 1)
+	legacy_dump += struct.pack('>B', 3) + b"abc" + struct.pack('>B', 2) + struct.pack('>2H', 1, 7)
+	legacy_dump += struct.pack('>i', 1)
+	legacy_dump += struct.pack('>B', 1) + b"s" + struct.pack('>H', 300)
+	legacy_dump += struct.pack('>300H', *range(300))
+	index_fio.write_binary(legacy_dump)
+	loaded_inverted_index = open_index(index_fio)
+	assert loaded_inverted_index == InvertedIndex({'abc': [1, 7], 's': list(range(300))})
+
+
+@pytest.mark.parametrize("codec", ["raw", "vbyte"])
+def test_dump_supports_32_bit_document_ids(tmpdir, codec):
+	index_fio = tmpdir.join("large_ids.index")
+	inverted_index = InvertedIndex({'abc': [2 ** 32 - 1, 0, 70000], 'long' * 100: list(range(1000))})
+	inverted_index.dump(index_fio, codec)
+	assert InvertedIndex.load(index_fio) == inverted_index
+
+
+def test_failed_dump_keeps_previous_files(tmpdir):
+	index_fio = tmpdir.join("kept.index")
+	inverted_index = InvertedIndex({'a': [1, 2], 'b': [2]})
+	inverted_index.dump(index_fio, "vbyte")
+	with pytest.raises(ValueError):
+		InvertedIndex({'a': [1, 2], 'b': [2 ** 33]}).dump(index_fio, "vbyte")
+	assert InvertedIndex.load(index_fio) == inverted_index
+	store_fio = tmpdir.join("kept.docs")
+	write_document_store(store_fio, [(1, "first")])
+	with pytest.raises(AttributeError):
+		write_document_store(store_fio, [(1, "second"), (2, None)])
+	with DocumentStore(store_fio) as document_store:
+		assert len(document_store) == 1 and document_store.get(1) == "first"
+	assert sorted(path.basename for path in tmpdir.listdir()) == ["kept.docs", "kept.index"]
+
+
+def test_vbyte_postings_are_delta_encoded():
+	postings = [3, 130, 131, 2 ** 32 - 1]
+	encoded = encode_postings(postings, CODEC_VBYTE)
+	assert len(encoded) == 1 + 1 + 1 + 5
+	assert decode_postings(encoded, 0, len(encoded), len(postings), CODEC_VBYTE) == postings
+	with pytest.raises(ValueError):
+		encode_postings([2 ** 32], CODEC_VBYTE)
+
+
+def test_galloping_search_finds_first_not_less_posting():
+	postings = [1, 3, 5, 7, 9, 11, 13, 15, 17]
+	assert galloping_search(postings, 0) == 0
+	assert galloping_search(postings, 8) == 4
+	assert galloping_search(postings, 13, 2) == 6
+	assert galloping_search(postings, 18) == len(postings)
+	assert galloping_search(postings, 3, 5) == 5
+
+
+def test_intersect_postings_matches_set_intersection():
+	common = list(range(0, 100000, 7))
+	rare = [14, 15, 700, 99995, 99996]
+	middle = list(range(0, 100000, 2))
+	assert intersect_postings([common, rare, middle]) == sorted(set(common) & set(rare) & set(middle))
+	assert intersect_postings([common, []]) == []
+	assert intersect_postings([]) == []
+
+
+def test_query_does_not_modify_words(tiny_dataset_fio, stop_words_fio):
+	documents = load_documents(tiny_dataset_fio)
+	stop_words = load_stop_words(stop_words_fio)
+	tiny_inverted_index = build_inverted_index(documents, stop_words)
+	words = ["A_word", "B_word"]
+	assert tiny_inverted_index.query(words) == [37]
+	assert words == ["A_word", "B_word"]
+
+
+def test_parallel_build_is_identical_to_single_process(wikipedia_documents, stop_words_doc, wikipedia_inverted_index):
+	parallel_inverted_index = build_inverted_index_parallel(wikipedia_documents, stop_words_doc, workers=2)
+	assert parallel_inverted_index.dict_index == wikipedia_inverted_index.dict_index
+
+
+@pytest.mark.parametrize("memory_limit", [1, 2 ** 30], ids=["run per document", "single run"])
+def test_external_build_is_identical_to_in_memory_build(tiny_dataset_fio, stop_words_fio, tiny_index, memory_limit):
+	process_build(
+		dataset_path=tiny_dataset_fio,
+		stop_words_path=stop_words_fio,
+		output=tiny_index,
+		memory_limit=memory_limit
+	)
+	documents = load_documents(tiny_dataset_fio)
+	stop_words = load_stop_words(stop_words_fio)
+	assert InvertedIndex.load(tiny_index) == build_inverted_index(documents, stop_words)
+
+
+def test_memory_size_parses_units():
+	assert memory_size("100") == 100
+	assert memory_size("2k") == 2048
+	assert memory_size("512MB") == 512 * 2 ** 20
+	with pytest.raises(ArgumentTypeError):
+		memory_size("lots")
+
+
+def test_added_segments_are_queried_and_merged(tmpdir, tiny_dataset_fio, stop_words_fio, tiny_index):
+	tiny_dataset_fio.write("".join("%d\tfiller_%d\n" % (2000 + idx, idx) for idx in range(16)), mode="a")
+	process_build(dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio, output=tiny_index)
+	delta_fio = tmpdir.join("delta.txt")
+	delta_fio.write("2\tB_word was replaced\n1000\tnew A_word and B_word\n")
+	process_add(tiny_index, delta_fio, stop_words_fio)
+	more_fio = tmpdir.join("more.txt")
+	more_fio.write("1001\tanother A_word\n1002\tnothing was here\n")
+	process_add(tiny_index, more_fio, stop_words_fio)
+	expected_answers = {
+		("A_word",): [37, 123, 1000, 1001],
+		("A_word", "B_word"): [37, 1000],
+		("dataset",): [],
+		("replaced",): [2],
+	}
+	segmented_index = open_index(tiny_index)
+	assert isinstance(segmented_index, SegmentedIndex)
+	assert len(segmented_index.segments) == 3
+	for query, answer in expected_answers.items():
+		assert segmented_index.query(list(query)) == answer
+	segmented_index.close()
+
+	process_merge(tiny_index, tier_factor=2)
+	segmented_index = open_index(tiny_index)
+	assert len(segmented_index.segments) == 2
+	for query, answer in expected_answers.items():
+		assert segmented_index.query(list(query)) == answer
+	segmented_index.close()
+
+	process_merge(tiny_index, merge_all=True)
+	assert sorted(os.listdir(tmpdir)) == ["dataset.txt", "delta.txt", "more.txt", "stop_words_tiny.txt", "tiny.index"]
+	merged_index = open_index(tiny_index)
+	assert isinstance(merged_index, MappedInvertedIndex)
+	for query, answer in expected_answers.items():
+		assert merged_index.query(list(query)) == answer
+
+
+def test_segments_keep_ranking_positions_and_ngrams(tmpdir, tiny_dataset_fio, stop_words_fio, tiny_index):
+	delta_str = "1000\tnew A_word and B_word are here\n1001\tsome words\n"
+	process_build(
+		dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio, output=tiny_index,
+		ranked=True, positional=True, ngram_index=True, reorder=True,
+	)
+	delta_fio = tmpdir.join("delta.txt")
+	delta_fio.write(delta_str)
+	process_add(tiny_index, delta_fio, stop_words_fio)
+	all_fio = tmpdir.join("all.txt")
+	all_fio.write(DATASET_TINY_STR + delta_str)
+	single_index = process_build(
+		dataset_path=all_fio, stop_words_path=stop_words_fio, output=tmpdir.join("single.index"),
+		ranked=True, positional=True,
+	)
+	queries = (["A_word"], ["A_word", "B_word"], ["some", "words"], ["here", "new"])
+
+	def assert_ranked_like_single_index(inverted_index):
+		for words in queries:
+			top = inverted_index.query_ranked(words, 3)
+			expected_top = single_index.query_ranked(words, 3)
+			assert [doc_id for doc_id, _ in top] == [doc_id for doc_id, _ in expected_top]
+			assert [score for _, score in top] == pytest.approx([score for _, score in expected_top])
+		assert inverted_index.query_boolean('"A_word and B_word"') == [37, 1000]
+		assert inverted_index.query(["B_wor?", "here"]) == [37, 1000]
+
+	segmented_index = open_index(tiny_index)
+	assert isinstance(segmented_index, SegmentedIndex)
+	assert segmented_index.ranked and segmented_index.positional
+	assert_ranked_like_single_index(segmented_index)
+	segmented_index.close()
+	assert process_list_queries(tiny_index, [["A_word", "B_word"]], top_k=1) == "1000"
+
+	process_merge(tiny_index, merge_all=True)
+	merged_index = open_index(tiny_index)
+	assert isinstance(merged_index, MappedInvertedIndex)
+	assert "ngrams" in merged_index.sections
+	assert_ranked_like_single_index(merged_index)
+	merged_index.close()
+
+
+def test_plan_tiered_merge_picks_consecutive_segments_of_one_tier():
+	assert plan_tiered_merge([10 ** 6, 100, 120, 90, 5000], 3) == (1, 4)
+	assert plan_tiered_merge([10 ** 6, 100, 5000, 120], 3) is None
+	assert plan_tiered_merge([10 ** 6], 2) is None
+
+
+def test_query_server_answers_queries_and_reloads_index(tiny_dataset_fio, stop_words_fio, tiny_index, monkeypatch):
+	documents = load_documents(tiny_dataset_fio)
+	stop_words = load_stop_words(stop_words_fio)
+	build_inverted_index(documents, stop_words).dump(tiny_index)
+	server = QueryServer(("127.0.0.1", 0), tiny_index)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.start()
+	address = "http://127.0.0.1:%d" % server.server_address[1]
+	try:
+		with urlopen(address + "/query?q=A_word+B_word&q=A_word&q=missing") as response:
+			assert response.read().decode() == "37\n37,123\n\n"
+		first_index = server.inverted_index
+		in_flight_index = server.acquire_index()
+		InvertedIndex({"A_word": [1]}).dump(tiny_index)
+		server.reload()
+		with urlopen(address + "/query?q=A_word") as response:
+			assert response.read().decode() == "1\n"
+		assert not first_index._buffer.closed
+		server.release_index(in_flight_index)
+		assert first_index._buffer.closed
+		second_index = server.inverted_index
+		assert server.reload()
+		assert second_index._buffer.closed
+
+		current_index = server.inverted_index
+		os.rename(tiny_index, str(tiny_index) + ".moved")
+		assert not server.reload()
+		assert server.inverted_index is current_index and not current_index._buffer.closed
+		with urlopen(address + "/query?q=A_word") as response:
+			assert response.read().decode() == "1\n"
+		os.rename(str(tiny_index) + ".moved", tiny_index)
+
+		monkeypatch.setattr(task_Vyazmin_Ilja_inverted_index, "MAX_TERM_EXPANSIONS", 0)
+		with pytest.raises(HTTPError) as error:
+			urlopen(address + "/query?q=A_wor%3F")
+		assert error.value.code == 400
+		with urlopen(address + "/query?q=A_word") as response:
+			assert response.read().decode() == "1\n"
+	finally:
+		server.shutdown()
+		server.server_close()
+		server_thread.join()
+
+
+def brute_force_bm25(documents, stop_words, words, top_k):
+	doc_lengths = {
+		idx: len([word for word in document.split() if word not in stop_words])
+		for idx, document in documents.items()
+	}
+	scorer = Bm25.from_doc_lengths(doc_lengths)
+	scores = dict()
+	for word in set(words):
+		containing = [idx for idx, document in documents.items() if word in document.split()]
+		idf = scorer.idf(len(containing))
+		for idx in containing:
+			freq = documents[idx].split().count(word)
+			scores[idx] = scores.get(idx, 0.0) + scorer.score(freq, doc_lengths[idx], idf)
+	return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+
+@pytest.mark.parametrize("words", [["wikipedia"], ["python", "language", "wikipedia"], ["free", "encyclopedia", "word_does_not_exist"]])
+def test_ranked_query_returns_bm25_top_k(tmpdir, wikipedia_documents, stop_words_doc, words):
+	ranked_index = build_inverted_index(wikipedia_documents, stop_words_doc, ranked=True)
+	index_fio = tmpdir.join("ranked.index")
+	ranked_index.dump(index_fio)
+	etalon_answer = brute_force_bm25(wikipedia_documents, stop_words_doc, words, 10)
+	with MappedInvertedIndex(index_fio) as mapped_index:
+		for answer in (ranked_index.query_ranked(words, 10), mapped_index.query_ranked(words, 10)):
+			assert [idx for idx, _ in answer] == [idx for idx, _ in etalon_answer]
+			assert [score for _, score in answer] == pytest.approx([score for _, score in etalon_answer])
+		assert sorted(mapped_index.query(words)) == sorted(ranked_index.query(words))
+	assert InvertedIndex.load(index_fio).term_freqs == ranked_index.term_freqs
+
+
+def test_roaring_bitmap_intersections_match_sets():
+	dense = list(range(0, 200000, 3))
+	sparse = [5, 6, 9, 70000, 70002, 131073, 4000000000]
+	another_dense = list(range(0, 200000, 5))
+	dense_bitmap = RoaringBitmap.from_sorted(dense)
+	sparse_bitmap = RoaringBitmap.from_sorted(sparse)
+	another_bitmap = RoaringBitmap.from_sorted(another_dense)
+	serialized = dense_bitmap.to_bytes()
+	assert RoaringBitmap.from_buffer(serialized, 0).to_list() == dense
+	assert len(sparse_bitmap) == len(sparse)
+	assert (dense_bitmap & another_bitmap).to_list() == sorted(set(dense) & set(another_dense))
+	assert (dense_bitmap & sparse_bitmap).to_list() == sorted(set(dense) & set(sparse))
+	assert dense_bitmap.filter(sparse) == sorted(set(dense) & set(sparse))
+
+
+def test_auto_codec_chooses_bitmaps_for_dense_terms(tmpdir):
+	dense = list(range(0, 30000, 2))
+	encoded = encode_postings(dense, CODEC_AUTO)
+	assert encoded[0] == CODEC_ROARING
+	assert decode_postings(encoded, 0, len(encoded), len(dense), CODEC_AUTO) == dense
+	assert encode_postings([1, 1000], CODEC_AUTO)[0] == CODEC_VBYTE
+	inverted_index = InvertedIndex({
+		"even": dense, "third": list(range(0, 30000, 3)), "rare": [6, 7, 12, 29994],
+	})
+	index_fio = tmpdir.join("hybrid.index")
+	inverted_index.dump(index_fio)
+	with MappedInvertedIndex(index_fio) as mapped_index:
+		assert mapped_index.query(["even", "third"]) == list(range(0, 30000, 6))
+		assert mapped_index.query(["even", "third", "rare"]) == [6, 12, 29994]
+		assert mapped_index.postings("even") == dense
+
+
+def test_parse_boolean_query_builds_tree():
+	assert parse_boolean_query('a b OR NOT (c AND "d e")') == (
+		"or", [
+			("and", [("term", "a"), ("term", "b")]),
+			("not", ("and", [("term", "c"), ("phrase", ["d", "e"])])),
+		]
+	)
+	with pytest.raises(ValueError):
+		parse_boolean_query("(a OR b")
+	with pytest.raises(ValueError):
+		parse_boolean_query("a AND")
+
+
+@pytest.mark.parametrize(
+	"query, etalon_answer",
+	[
+		pytest.param("A_word B_word", [37], id="implicit and"),
+		pytest.param("nothing OR dataset", [2, 123], id="or"),
+		pytest.param("words NOT (B_word OR nothing)", [], id="not group"),
+		pytest.param("some AND NOT A_word", [2], id="and not"),
+		pytest.param('"A_word and B_word"', [37], id="phrase"),
+		pytest.param('"B_word and A_word"', [], id="phrase in wrong order"),
+		pytest.param('"famous_phrases to_be"', [5], id="phrase with stop word"),
+		pytest.param('"words A_word" OR "word B_word"', [2, 123], id="phrases or"),
+	],
+)
+def test_boolean_queries_on_positional_index(tmpdir, tiny_dataset_fio, stop_words_fio, query, etalon_answer):
+	documents = load_documents(tiny_dataset_fio)
+	stop_words = load_stop_words(stop_words_fio)
+	positional_index = build_inverted_index(documents, stop_words, positional=True)
+	index_fio = tmpdir.join("positional.index")
+	positional_index.dump(index_fio)
+	assert positional_index.query_boolean(query) == etalon_answer
+	with MappedInvertedIndex(index_fio) as mapped_index:
+		assert mapped_index.query_boolean(query) == etalon_answer
+	assert InvertedIndex.load(index_fio).positions == positional_index.positions
+
+
+def test_boolean_query_rejects_unsupported_queries(tiny_dataset_fio, stop_words_fio):
+	documents = load_documents(tiny_dataset_fio)
+	stop_words = load_stop_words(stop_words_fio)
+	tiny_inverted_index = build_inverted_index(documents, stop_words)
+	with pytest.raises(ValueError):
+		tiny_inverted_index.query_boolean("NOT A_word")
+	with pytest.raises(ValueError):
+		tiny_inverted_index.query_boolean('"A_word and"')
+
+
+def test_benchmark_reports_every_phase(tmpdir):
+	dataset_path = str(tmpdir.join("synthetic.txt"))
+	generate_corpus(dataset_path, document_count=50, vocabulary_size=100, document_length=10)
+	assert len(load_documents(dataset_path)) == 50
+	queries = generate_queries(20, vocabulary_size=100)
+	results = run_benchmark(dataset_path, queries, str(tmpdir), trace_memory=True)
+	phases = ("load_documents", "build", "dump", "load", "query_loaded", "open_mapped", "query_mapped")
+	for phase in phases:
+		assert results[phase]["max_rss_so_far_bytes"] > 0
+		assert results[phase]["peak_traced_bytes"] > 0
+	assert results["build"]["peak_traced_bytes"] > results["open_mapped"]["peak_traced_bytes"]
+	untraced_results = run_benchmark(dataset_path, queries, str(tmpdir))
+	assert "peak_traced_bytes" not in untraced_results["build"]
+	assert results["dump"]["index_bytes"] == tmpdir.join("benchmark.index").size()
+	assert set(results["query_mapped"]["latency_seconds"]) == {"p50", "p90", "p99"}
+
+
+@pytest.mark.parametrize("codec", ["raw", "auto"])
+def test_compact_index_answers_like_dict_index(tmpdir, wikipedia_inverted_index, codec):
+	index_fio = tmpdir.join("compact.index")
+	wikipedia_inverted_index.dump(index_fio, codec)
+	compact_index = CompactInvertedIndex.load(index_fio)
+	assert len(compact_index) == len(wikipedia_inverted_index.dict_index)
+	assert len(compact_index.postings_array) == sum(map(len, wikipedia_inverted_index.dict_index.values()))
+	for query in (["wikipedia"], ["python", "language"], ["free", "word_does_not_exist"]):
+		assert compact_index.query(list(query)) == wikipedia_inverted_index.query(list(query))
+	assert compact_index.query_boolean("python OR free") == wikipedia_inverted_index.query_boolean("python OR free")
+	assert InvertedIndex(dict(compact_index.items())) == wikipedia_inverted_index
+
+
+def test_compact_index_explains_missing_ranking_and_positions(tiny_dataset_fio, stop_words_fio, tiny_index, caplog):
+	process_build(
+		dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio, output=tiny_index,
+		ranked=True, positional=True,
+	)
+	compact_index = CompactInvertedIndex.load(tiny_index)
+	assert compact_index.unloaded_features == {"ranked", "positional"}
+	assert compact_index.query_boolean("famous_phrases OR B_word") == [2, 5, 37]
+	process_list_queries(tiny_index, [["A_word"]], top_k=1, compact=True)
+	process_list_queries(tiny_index, [['"A_word', 'and', 'B_word"']], boolean=True, compact=True)
+	assert "ranked query is not supported by index loaded with --compact" in caplog.text
+	assert "phrase query is not supported by index loaded with --compact" in caplog.text
+	assert "needs index built with" not in caplog.text
+
+
+def test_query_cache_reuses_answers_and_pairs():
+	inverted_index = InvertedIndex({
+		"rare": [2, 5, 8], "scarce": [1, 2, 5, 8], "common": [1, 2, 3, 5, 7],
+		"usual": [1, 2, 3, 4, 5, 6, 7, 8],
+	})
+	cache = QueryCache(maxsize=3)
+	assert cache.query(inverted_index, ["common", "rare", "scarce"]) == [2, 5]
+	assert (cache.hits, cache.misses, len(cache)) == (0, 2, 2)
+	assert cache.query(inverted_index, ["scarce", "common", "rare", "scarce"]) == [2, 5]
+	assert (cache.hits, cache.misses) == (1, 2)
+	assert cache.query(inverted_index, ["usual", "rare", "scarce"]) == [2, 5, 8]
+	assert (cache.hits, cache.misses) == (2, 3)
+	cache.query(inverted_index, ["usual"])
+	assert len(cache) == 3
+
+	reloaded_index = InvertedIndex({"common": [1], "rare": [1], "scarce": [1]})
+	assert cache.query(reloaded_index, ["common", "rare", "scarce"]) == [1]
+	assert cache.misses == 6
+
+
+def test_query_cache_probes_common_terms_and_skips_replaced_index():
+	inverted_index = InvertedIndex({
+		"rare": [2, 5, 8], "scarce": [1, 2, 5, 8], "common": list(range(100)), "usual": list(range(0, 100, 2)),
+	})
+	queried = []
+	original_query = inverted_index.query
+	inverted_index.query = lambda words: queried.append(sorted(words)) or original_query(words)
+	cache = QueryCache(maxsize=10)
+	cache.reset(inverted_index)
+	assert cache.query(inverted_index, ["common", "usual", "rare", "scarce"]) == [2, 8]
+	assert queried == [["rare", "scarce"]]
+
+	reloaded_index = InvertedIndex({"common": [1], "rare": [1], "scarce": [1], "usual": [1]})
+	cache.reset(reloaded_index)
+	assert cache.query(inverted_index, ["common", "usual", "rare", "scarce"]) == [2, 8]
+	assert len(cache) == 0
+	assert cache.query(reloaded_index, ["common", "usual", "rare", "scarce"]) == [1]
+	assert cache.query(reloaded_index, ["usual", "common", "rare", "scarce"]) == [1]
+	assert cache.hits == 1
+
+
+def test_sharded_index_answers_like_single_index(tmpdir, tiny_dataset_fio, stop_words_fio, tiny_index):
+	single_index = process_build(
+		dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio,
+		output=tmpdir.join("single.index"), ranked=True,
+	)
+	process_build(
+		dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio,
+		output=tiny_index, ranked=True, shards=3,
+	)
+	assert sorted(os.listdir(tmpdir))[-3:] == ["tiny.index.shard000", "tiny.index.shard001", "tiny.index.shard002"]
+	sharded_index = open_index(tiny_index)
+	assert isinstance(sharded_index, ShardedIndex)
+	for query in (["A_word"], ["B_word"], ["A_word", "B_word"], ["some"], ["absent"]):
+		assert sharded_index.query(query) == single_index.query(query)
+	assert sharded_index.query_boolean("A_word OR dataset") == [2, 37, 123]
+	assert sharded_index.doc_freq("some") == 2
+	assert [doc_id for doc_id, _ in sharded_index.query_ranked(["A_word", "B_word"], 1)] == [37]
+	sharded_index.close()
+
+	delta_fio = tmpdir.join("delta.txt")
+	delta_fio.write("2\tB_word was replaced\n1000\tnew A_word and B_word\n")
+	process_add(tiny_index, delta_fio, stop_words_fio)
+	process_merge(tiny_index, merge_all=True)
+	sharded_index = open_index(tiny_index)
+	assert sharded_index.query(["B_word"]) == [2, 37, 1000]
+	assert sharded_index.query(["dataset"]) == []
+	assert sharded_index.query(["replaced"]) == [2]
+	sharded_index.close()
+
+
+def test_sharded_ranked_query_matches_single_index(tmpdir):
+	process_build(
+		dataset_path=DEFAULT_DATASET_PATH, stop_words_path=DEFAULT_STOP_WORDS_PATH,
+		output=tmpdir.join("single.index"), ranked=True,
+	)
+	index_fio = tmpdir.join("sharded.index")
+	process_build(
+		dataset_path=DEFAULT_DATASET_PATH, stop_words_path=DEFAULT_STOP_WORDS_PATH,
+		output=index_fio, ranked=True, shards=4,
+	)
+	single_index = MappedInvertedIndex(tmpdir.join("single.index"))
+	sharded_index = open_index(index_fio)
+	for words in (
+		["wikipedia"], ["python", "language"], ["free", "encyclopedia"], ["w33", "w1762", "w2400"],
+		["w454", "python"], ["w1860", "w610"], ["wikipedia", "w1398", "w1807"],
+	):
+		expected_top = single_index.query_ranked(words, 10)
+		top = sharded_index.query_ranked(words, 10)
+		assert len(top) == 10
+		assert [doc_id for doc_id, _ in top] == [doc_id for doc_id, _ in expected_top]
+		assert [score for _, score in top] == pytest.approx([score for _, score in expected_top])
+	sharded_index.close()
+	single_index.close()
+
+
+def test_shards_are_balanced_for_ids_with_common_step(tmpdir, wikipedia_documents):
+	assert {doc_id % 3 for doc_id in wikipedia_documents} == {1}
+	index_fio = tmpdir.join("sharded.index")
+	shard_indexes = process_build(
+		dataset_path=DEFAULT_DATASET_PATH, stop_words_path=DEFAULT_STOP_WORDS_PATH,
+		output=index_fio, shards=3,
+	)
+	shard_sizes = [
+		len({doc_id for _, postings in shard_index.items() for doc_id in postings})
+		for shard_index in shard_indexes
+	]
+	assert sum(shard_sizes) <= len(wikipedia_documents)
+	assert min(shard_sizes) > 0.9 * len(wikipedia_documents) / 3
+	assert json.loads(index_fio.read())["partition"] == "hash"
+
+	index_fio.write(json.dumps({"shards": ["sharded.index.shard%03d" % number for number in range(3)]}))
+	delta_fio = tmpdir.join("delta.txt")
+	delta_fio.write("3000\tadded python\n")
+	segment_paths = process_add(index_fio, delta_fio, DEFAULT_STOP_WORDS_PATH)
+	assert [os.path.exists(path) for path in segment_paths] == [True, True, True]
+	segment_doc_ids = []
+	for path in segment_paths:
+		with MappedInvertedIndex(path) as segment:
+			segment_doc_ids.append(list(segment.doc_ids()))
+	assert segment_doc_ids == [[3000], [], []]
+
+
+def test_bloom_filter_skips_absent_terms_without_touching_dictionary(tiny_dataset_fio, stop_words_fio, tiny_index):
+	terms = [("term_%d" % idx).encode() for idx in range(1000)]
+	bloom = BloomFilter.from_terms(terms)
+	assert all(term in bloom for term in terms)
+	false_positives = sum(("absent_%d" % idx) in bloom for idx in range(1000))
+	assert false_positives < 50
+	assert all(term in BloomFilter.from_buffer(b"pad" + bloom.to_bytes(), 3) for term in terms)
+
+	documents = load_documents(tiny_dataset_fio)
+	build_inverted_index(documents, load_stop_words(stop_words_fio)).dump(tiny_index)
+	mapped_index = MappedInvertedIndex(tiny_index)
+	assert "bloom" in mapped_index.sections
+	assert mapped_index.might_contain(["A_word", "B_word"])
+	mapped_index._entry = lambda number: pytest.fail("term dictionary should not be read")
+	assert mapped_index.query(["A_word", "absent_word"]) == []
+	assert mapped_index.postings("absent_word") == []
+	mapped_index.close()
+
+
+def test_document_store_fetches_texts_by_id(tmpdir, tiny_dataset_fio):
+	store_fio = tmpdir.join("tiny.docs")
+	documents = load_documents(tiny_dataset_fio)
+	write_document_store(store_fio, documents.items(), block_size=32)
+	with DocumentStore(store_fio) as document_store:
+		assert len(document_store) == len(documents)
+		for doc_id in sorted(documents, reverse=True):
+			assert document_store.get(doc_id) == documents[doc_id]
+		assert document_store.get(1) is None
+
+
+def test_process_queries_can_print_document_texts(capsys, tmpdir, tiny_dataset_fio, stop_words_fio, tiny_index):
+	process_build(
+		dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio,
+		output=tiny_index, doc_store=True,
+	)
+	process_list_queries(tiny_index, [["A_word", "B_word"], ["famous_phrases"]], with_text=True)
+	captured = capsys.readouterr()
+	assert captured.out == (
+		"37\tall words such as A_word and B_word are here\n\n"
+		"5\tfamous_phrases to_be\n\n"
+	)
+	delta_fio = tmpdir.join("delta.txt")
+	delta_fio.write("5\tfamous_phrases replaced\n1000\tnew A_word and B_word\n")
+	process_add(tiny_index, delta_fio, stop_words_fio)
+	for merge_all in (False, True):
+		process_list_queries(tiny_index, [["A_word", "B_word"], ["famous_phrases"]], with_text=True)
+		assert capsys.readouterr().out == (
+			"37\tall words such as A_word and B_word are here\n1000\tnew A_word and B_word\n\n"
+			"5\tfamous_phrases replaced\n\n"
+		)
+		process_merge(tiny_index, merge_all=merge_all)
+	assert sorted(path.basename for path in tmpdir.listdir() if ".docs" in path.basename) == ["tiny.index.docs"]
+	with DocumentStore(str(tiny_index) + ".docs") as document_store:
+		assert len(document_store) == 5
+	process_build(dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio, output=tiny_index)
+	with pytest.raises(ValueError):
+		process_list_queries(tiny_index, [["A_word"]], with_text=True)
+
+
+def test_edit_distance_stops_above_limit():
+	assert edit_distance("python", "python", 1) == 0
+	assert edit_distance("python", "pyhton", 2) == 2
+	assert edit_distance("python", "jython", 1) == 1
+	assert edit_distance("python", "java", 2) == 3
+
+
+@pytest.mark.parametrize("ngram_index", [False, True])
+def test_queries_expand_wildcards_and_fuzzy_terms(tiny_dataset_fio, stop_words_fio, tiny_index, ngram_index, caplog):
+	inverted_index = process_build(
+		dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio,
+		output=tiny_index, ngram_index=ngram_index,
+	)
+	mapped_index = MappedInvertedIndex(tiny_index)
+	assert ("ngramtab" in mapped_index.sections) == ngram_index
+	compact_index = CompactInvertedIndex.load(tiny_index)
+	for index in (inverted_index, mapped_index, compact_index):
+		assert expand_term(index, "word*") == ["word", "words"]
+		assert expand_term(index, "?_word") == ["A_word", "B_word"]
+		assert expand_term(index, "wrds~") == ["words"]
+		assert expand_term(index, "wordss~2") == ["word", "words"]
+		for short_term in ("wrd~2", "a~"):
+			with pytest.raises(ValueError):
+				expand_term(index, short_term)
+		assert index.query(["word*"]) == [2, 37, 123]
+		assert index.query(["*_word", "some"]) == [2, 123]
+		assert index.query(["A_wrd~", "all"]) == [37]
+		assert index.query(["absent*"]) == []
+		assert index.query_boolean("dat* OR famous_phrase~") == [2, 5]
+	mapped_index.close()
+	assert ("has no stored n-grams" in caplog.text) != ngram_index
+
+
+def test_reorder_puts_documents_with_shared_terms_together():
+	documents = {
+		1: "apple banana cherry", 2: "xray yankee zulu", 3: "apple banana cherry",
+		4: "xray yankee zulu", 5: "apple banana cherry",
+	}
+	order = reorder_documents(documents, set())
+	assert sorted(order) == [1, 2, 3, 4, 5]
+	assert sorted(order[:3]) == [1, 3, 5] or sorted(order[:2]) == [2, 4]
+
+
+def test_reordered_index_answers_with_original_ids(tmpdir, tiny_dataset_fio, stop_words_fio, tiny_index):
+	process_build(
+		dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio,
+		output=tmpdir.join("plain.index"), ranked=True,
+	)
+	reordered_index = process_build(
+		dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio,
+		output=tiny_index, ranked=True, reorder=True,
+	)
+	assert sorted(reordered_index.docmap) == [2, 5, 37, 123]
+	plain_index = MappedInvertedIndex(tmpdir.join("plain.index"))
+	mapped_index = MappedInvertedIndex(tiny_index)
+	for index in (reordered_index, mapped_index, InvertedIndex.load(tiny_index), CompactInvertedIndex.load(tiny_index)):
+		for query in (["A_word"], ["some"], ["words", "A_word"], ["B_wor?"]):
+			assert index.query(query) == plain_index.query(query)
+		assert index.query_boolean("some AND NOT dataset") == [123]
+	assert mapped_index.doc_ids() == [2, 5, 37, 123]
+	assert mapped_index.query_ranked(["A_word", "B_word"], 2) == plain_index.query_ranked(["A_word", "B_word"], 2)
+	plain_index.close()
+	mapped_index.close()
+
+	delta_fio = tmpdir.join("delta.txt")
+	delta_fio.write("2\tB_word was replaced\n1000\tnew A_word\n")
+	process_add(tiny_index, delta_fio, stop_words_fio)
+	process_merge(tiny_index, merge_all=True)
+	merged_index = open_index(tiny_index)
+	assert merged_index.query(["A_word"]) == [37, 123, 1000]
+	assert merged_index.query(["B_word"]) == [2, 37]
+	merged_index.close()
+
+
+@pytest.mark.parametrize("compress", [gzip.compress, bz2.compress, lzma.compress, lambda data: data])
+def test_load_documents_reads_compressed_datasets(tmpdir, tiny_dataset_fio, compress):
+	compressed_fio = tmpdir.join("dataset.compressed")
+	compressed_fio.write_binary(compress(DATASET_TINY_STR.encode()))
+	assert load_documents(compressed_fio) == load_documents(tiny_dataset_fio)
+
+
+class TrickleStream(io.RawIOBase):
+	def __init__(self, data):
+		super().__init__()
+		self.data = data
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		chunk, self.data = self.data[:1], self.data[1:]
+		buffer[:len(chunk)] = chunk
+		return len(chunk)
+
+
+@pytest.mark.parametrize("compress", [gzip.compress, bz2.compress, lzma.compress, lambda data: data])
+def test_load_documents_reads_stdin_returning_short_reads(monkeypatch, tiny_dataset_fio, compress):
+	pipe = io.BufferedReader(TrickleStream(compress(DATASET_TINY_STR.encode())), buffer_size=1)
+	monkeypatch.setattr(sys, "stdin", TextIOWrapper(pipe))
+	assert load_documents("-") == load_documents(tiny_dataset_fio)
+
+
+def test_build_reads_dataset_from_stdin(monkeypatch, tiny_dataset_fio, stop_words_fio, tiny_index):
+	monkeypatch.setattr(sys, "stdin", TextIOWrapper(io.BufferedReader(io.BytesIO(gzip.compress(DATASET_TINY_STR.encode())))))
+	inverted_index = process_build(
+		dataset_path="-", stop_words_path=stop_words_fio, output=tiny_index, doc_store=True,
+	)
+	assert inverted_index == build_inverted_index(load_documents(tiny_dataset_fio), load_stop_words(stop_words_fio))
+	with DocumentStore(str(tiny_index) + ".docs") as document_store:
+		assert document_store.get(5) == "famous_phrases to_be"
+
+
+def test_stats_describe_every_file_of_index(capsys, tmpdir, tiny_dataset_fio, stop_words_fio, tiny_index):
+	process_build(dataset_path=tiny_dataset_fio, stop_words_path=stop_words_fio, output=tiny_index, ranked=True)
+	delta_fio = tmpdir.join("delta.txt")
+	delta_fio.write("1000\tnew A_word\n")
+	process_add(tiny_index, delta_fio, stop_words_fio)
+	stats = process_stats(tiny_index, top_terms=2)
+	base_stats, segment_stats = stats["files"]
+	assert base_stats["features"] == ["ranked", "bloom"]
+	assert base_stats["documents"] == 4
+	assert base_stats["terms"] == 16
+	assert base_stats["postings"] == 21
+	assert base_stats["posting_lengths"] == {"1": 11, "2-3": 5}
+	assert base_stats["list_codecs"] == {"vbyte": 16}
+	assert [term["term"] for term in base_stats["top_terms"]] == ["A_word", "B_word"]
+	assert segment_stats["documents"] == 1
+	assert stats["total"]["postings"] == 23
+	captured = capsys.readouterr()
+	assert "top terms: A_word 2" in captured.out
+	assert "total: 2 files" in captured.out
+
+	process_stats(tiny_index, as_json=True)
+	assert json.loads(capsys.readouterr().out)["total"]["files"] == 2
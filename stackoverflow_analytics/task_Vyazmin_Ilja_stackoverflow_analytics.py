@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 """Module for search most popular topics at stackoverflow"""
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType
-from collections import Counter
+from array import array
+from bisect import bisect_left, bisect_right
+from calendar import monthrange
+from collections import Counter, defaultdict
+from datetime import date
+from hashlib import blake2b
+from multiprocessing import Pool
 import logging
 import logging.config
 import json
+import mmap
+import os
 import re
+import struct
+import sys
 
 import yaml
 from lxml import etree
@@ -14,31 +24,156 @@ APPLICATION_NAME = "stackoverflow_analytics"
 DEFAULT_QUESTIONS_PATH = "./stackoverflow_posts_sample.xml"
 DEFAULT_STOP_WORDS_PATH = "./stop_words_en.txt"
 DEFAULT_LOGGING_CONFIG_FILE_PATH = "logging.conf.yml"
+DEFAULT_LOAD_WORKERS = 1
+CHUNKS_PER_WORKER = 4
+ROW_PREFIX = b"<row"
+QUESTION_ROW_MARKER = b' PostTypeId="1"'
+QUESTIONS_CACHE_SUFFIX = ".cache"
+QUESTIONS_CACHE_VERSION = 2
+QUESTIONS_HASH_SAMPLE_SIZE = 1 << 20
+HASH_BLOCK_SIZE = 1 << 20
+CACHE_MAGIC = b"SOQC"
+CACHE_HEADER = struct.Struct("<4sII")
+CACHE_COLUMN = struct.Struct("<8scQQ")
+CACHE_ALIGNMENT = 8
 
 
 logger = logging.getLogger(APPLICATION_NAME)
 
 
-def load_questions(questions_path):
-    """Load and prepare information about stackoverflow questions"""
-    questions = []
-    with open(questions_path, "r", encoding="utf-8") as questions_fio:
-        for line in questions_fio:
+def creation_day(creation_date):
+    """Number of day of question creation date like 2019-10-14T17:28:54.933"""
+    return date.fromisoformat(creation_date[:10]).toordinal()
+
+
+def period_days(period):
+    """First and last day numbers of year, month or day like 2019, 2019-03 or 2019-03-01"""
+    period = str(period).strip()
+    if len(period) == 4:
+        first, last = date(int(period), 1, 1), date(int(period), 12, 31)
+    elif len(period) == 7:
+        first = date.fromisoformat(period + "-01")
+        last = first.replace(day=monthrange(first.year, first.month)[1])
+    else:
+        first = last = date.fromisoformat(period)
+    return first.toordinal(), last.toordinal()
+
+
+def split_at_rows(questions_path, parts):
+    """Split file into byte ranges of similar size starting at beginnings of rows"""
+    file_size = os.path.getsize(questions_path)
+    offsets = [0]
+    with open(questions_path, "rb") as questions_fio:
+        for part in range(1, parts):
+            questions_fio.seek(max(file_size * part // parts - 1, offsets[-1]))
+            questions_fio.readline()
+            offsets.append(min(questions_fio.tell(), file_size))
+    offsets.append(file_size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+def iter_questions_range(questions_path, start, end):
+    """Yield creation date with its day number, title and score of questions from the byte range of file
+
+    Rows of other posts are skipped before they are parsed, None is
+    yielded for every malformed question row.
+    """
+    with open(questions_path, "rb") as questions_fio:
+        questions_fio.seek(start)
+        while questions_fio.tell() < end:
+            line = questions_fio.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line.startswith(ROW_PREFIX) or QUESTION_ROW_MARKER not in line:
+                continue
             try:
                 root = etree.XML(line)
-                post_type = int(root.attrib['PostTypeId'])
-                if post_type != 1:
+                if int(root.attrib['PostTypeId']) != 1:
                     continue
-                question_dict = dict()
-                question_dict['CreationDate'] = root.attrib['CreationDate']
-                question_dict['Title'] = root.attrib['Title']
-                question_dict['Score'] = root.attrib['Score']
-                questions.append(question_dict)
-            except BaseException:
+                creation_date = root.attrib['CreationDate']
+                title = root.attrib['Title']
+                score = root.attrib['Score']
+                day = creation_day(creation_date)
+                int(score)
+            except (etree.XMLSyntaxError, KeyError, ValueError):
+                yield None
                 continue
+            yield creation_date, day, title, score
+
+
+def load_questions_range(questions_range):
+    """Parse questions from the byte range of file, return them with number of malformed rows"""
+    questions = []
+    malformed_rows = 0
+    for question in iter_questions_range(*questions_range):
+        if question is None:
+            malformed_rows += 1
+            continue
+        creation_date, _, title, score = question
+        questions.append({'CreationDate': creation_date, 'Title': title, 'Score': score})
+    return questions, malformed_rows
+
+
+def load_store_range(store_range):
+    """Parse questions from the byte range of file into a store, return it with number of malformed rows"""
+    questions_path, start, end, stop_words = store_range
+    store = QuestionStore()
+    malformed_rows = 0
+    for question in iter_questions_range(questions_path, start, end):
+        if question is None:
+            malformed_rows += 1
+            continue
+        _, day, title, score = question
+        store.add_question(day, title, int(score), stop_words)
+    return store, malformed_rows
+
+
+def map_ranges(function, questions_path, workers, *arguments):
+    """Call function for ranges of rows of file in a pool of processes, count malformed rows"""
+    questions_ranges = [
+        (str(questions_path), start, end) + arguments
+        for start, end in split_at_rows(questions_path, workers * CHUNKS_PER_WORKER)
+    ]
+    if workers > 1:
+        with Pool(workers) as pool:
+            loaded_ranges = pool.map(function, questions_ranges)
+    else:
+        loaded_ranges = map(function, questions_ranges)
+    results = []
+    malformed_rows = 0
+    for result, range_malformed_rows in loaded_ranges:
+        results.append(result)
+        malformed_rows += range_malformed_rows
+    if malformed_rows:
+        logger.warning("skipped %d malformed question rows in %s", malformed_rows, questions_path)
+    return results
+
+
+def load_questions(questions_path, workers=DEFAULT_LOAD_WORKERS):
+    """Load and prepare information about stackoverflow questions
+
+    File is parsed by ranges of rows in a pool of processes, malformed
+    question rows are counted and skipped.
+    """
+    questions = []
+    for range_questions in map_ranges(load_questions_range, questions_path, workers):
+        questions.extend(range_questions)
     return questions
 
 
+def load_question_store(questions_path, stop_words, workers=DEFAULT_LOAD_WORKERS):
+    """Load questions into a store of columns without keeping strings of rows
+
+    Ranges of rows are parsed into stores in a pool of processes and
+    merged in order of the file.
+    """
+    store = QuestionStore()
+    for range_store in map_ranges(load_store_range, questions_path, workers, stop_words):
+        store.extend(range_store)
+    return store
+
+
 def load_stop_words(stop_words_path):
     """Load file with stop words"""
     stop_words = set()
@@ -50,40 +185,372 @@ def load_stop_words(stop_words_path):
     return stop_words
 
 
+class QuestionStore:
+    """Columns of questions with titles tokenized to ids of distinct non stop words
+
+    Day of creation is kept as uint32 number of the day, score as int32
+    and titles as one array of word ids with offsets of every question
+    in it.
+    """
+    def __init__(self, vocabulary=None, days=None, scores=None, word_offsets=None, word_ids=None):
+        self.vocabulary = vocabulary if vocabulary is not None else []
+        self.days = days if days is not None else array("I")
+        self.scores = scores if scores is not None else array("i")
+        self.word_offsets = word_offsets if word_offsets is not None else array("Q", [0])
+        self.word_ids = word_ids if word_ids is not None else array("I")
+        self._vocabulary_ids = None
+
+    def __len__(self):
+        return len(self.days)
+
+    @classmethod
+    def from_questions(cls, questions, stop_words):
+        """Tokenize titles of questions and lay questions out in columns"""
+        store = cls()
+        for question_dict in questions:
+            store.add_question(
+                creation_day(question_dict['CreationDate']), question_dict['Title'],
+                int(question_dict['Score']), stop_words,
+            )
+        return store
+
+    def word_id(self, word):
+        """Id of word in vocabulary, the word is added if it is new"""
+        if self._vocabulary_ids is None:
+            self._vocabulary_ids = {word: word_id for word_id, word in enumerate(self.vocabulary)}
+        word_id = self._vocabulary_ids.get(word)
+        if word_id is None:
+            word_id = self._vocabulary_ids[word] = len(self.vocabulary)
+            self.vocabulary.append(word)
+        return word_id
+
+    def add_question(self, day, title, score, stop_words):
+        """Append question with ids of distinct words of its title"""
+        self.days.append(day)
+        self.scores.append(score)
+        for word in set(re.findall(r"\w+", title.lower())) - stop_words:
+            self.word_ids.append(self.word_id(word))
+        self.word_offsets.append(len(self.word_ids))
+
+    def extend(self, other):
+        """Append questions of other store translating ids of its words"""
+        word_ids = [self.word_id(word) for word in other.vocabulary]
+        shift = len(self.word_ids)
+        self.days.extend(other.days)
+        self.scores.extend(other.scores)
+        self.word_ids.extend(word_ids[word_id] for word_id in other.word_ids)
+        self.word_offsets.extend(offset + shift for offset in other.word_offsets[1:])
+
+    def title_word_ids(self, number):
+        """Ids of distinct words in title of question by its number"""
+        return self.word_ids[self.word_offsets[number]:self.word_offsets[number + 1]]
+
+    def columns(self):
+        """Columns to save in cache"""
+        return {
+            "vocab": "\n".join(self.vocabulary).encode(),
+            "days": self.days,
+            "scores": self.scores,
+            "offsets": self.word_offsets,
+            "wordids": self.word_ids,
+        }
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Restore store from columns of cache"""
+        return cls(
+            decode_vocabulary(columns["vocab"]), columns["days"], columns["scores"],
+            columns["offsets"], columns["wordids"],
+        )
+
+
+class DailyWordScores:
+    """Scores of title words summed per day of questions with blocks of merged days
+
+    Days with questions are sorted into buckets. Level 0 keeps a block of
+    word ids and scores for every bucket, a block of level k merges 2**k
+    buckets starting at a multiple of 2**k. Any range of buckets is
+    covered by at most two blocks of each level, so a query merges a
+    logarithmic number of blocks. A word stays in answers even if its
+    score sums to zero.
+    """
+    def __init__(self, vocabulary, days, level_starts, block_offsets, word_ids, scores):
+        self.vocabulary = vocabulary
+        self.days = days
+        self.level_starts = level_starts
+        self.block_offsets = block_offsets
+        self.word_ids = word_ids
+        self.scores = scores
+
+    @classmethod
+    def from_questions(cls, questions, stop_words):
+        """Aggregate scores of words from titles of questions"""
+        return cls.from_store(QuestionStore.from_questions(questions, stop_words))
+
+    @classmethod
+    def from_store(cls, store):
+        """Aggregate scores of words from columns of questions"""
+        day_scores = defaultdict(lambda: defaultdict(int))
+        for number, (day, score) in enumerate(zip(store.days, store.scores)):
+            scores = day_scores[day]
+            for word_id in store.title_word_ids(number):
+                scores[word_id] += score
+        days = sorted(day_scores)
+        level_starts = array("Q", [0])
+        block_offsets = array("Q", [0])
+        word_ids = array("I")
+        scores = array("q")
+        level = [day_scores[day] for day in days]
+        while level:
+            for block in level:
+                for word_id, score in sorted(block.items()):
+                    word_ids.append(word_id)
+                    scores.append(score)
+                block_offsets.append(len(word_ids))
+            level_starts.append(len(block_offsets) - 1)
+            level = [
+                merge_scores(level[number], level[number + 1])
+                for number in range(0, len(level) - 1, 2)
+            ]
+        return cls(store.vocabulary, array("I", days), level_starts, block_offsets, word_ids, scores)
+
+    def covering_blocks(self, first, last):
+        """Numbers of blocks covering buckets from first to last exclusive"""
+        blocks = []
+        level = 0
+        while first < last:
+            if first & 1:
+                blocks.append(self.level_starts[level] + first)
+                first += 1
+            if last & 1:
+                last -= 1
+                blocks.append(self.level_starts[level] + last)
+            first >>= 1
+            last >>= 1
+            level += 1
+        return blocks
+
+    def count(self, start, end):
+        """Create dict of word scores for questions from start to end period inclusive
+
+        Periods are years, months or days like 2019, 2019-03 or 2019-03-01.
+        """
+        first = bisect_left(self.days, period_days(start)[0])
+        last = bisect_right(self.days, period_days(end)[1])
+        total_scores = defaultdict(int)
+        for block in self.covering_blocks(first, last):
+            block_start = self.block_offsets[block]
+            block_end = self.block_offsets[block + 1]
+            for word_id, score in zip(self.word_ids[block_start:block_end], self.scores[block_start:block_end]):
+                total_scores[word_id] += score
+        return Counter({self.vocabulary[word_id]: score for word_id, score in total_scores.items()})
+
+    def columns(self):
+        """Columns to save in cache"""
+        return {
+            "adays": self.days,
+            "alevels": self.level_starts,
+            "aoffsets": self.block_offsets,
+            "awordids": self.word_ids,
+            "ascores": self.scores,
+        }
+
+    @classmethod
+    def from_columns(cls, columns, vocabulary):
+        """Restore word scores from columns of cache"""
+        return cls(
+            vocabulary, columns["adays"], columns["alevels"], columns["aoffsets"],
+            columns["awordids"], columns["ascores"],
+        )
+
+
+def merge_scores(first_scores, second_scores):
+    """Sum two dicts of word scores"""
+    scores = defaultdict(int, first_scores)
+    for word_id, score in second_scores.items():
+        scores[word_id] += score
+    return scores
+
+
 def count_words(questions, query, stop_words):
-    """Create dict of count words from questions by query"""
-    dict_words = Counter()
-    for question_dict in questions:
-        year = int(question_dict['CreationDate'][:4])
-        if year < query[0] or year > query[1]:
-            continue
-        text = set(re.findall(r"\w+", question_dict['Title'].lower())) - stop_words
-        for word in text:
-            dict_words[word] += int(question_dict['Score'])
-    return dict_words
+    """Create dict of count words from questions by query
+
+    Questions are either a list of question dicts or a store with titles
+    already tokenized without stop words.
+    """
+    if isinstance(questions, QuestionStore):
+        word_scores = DailyWordScores.from_store(questions)
+    else:
+        word_scores = DailyWordScores.from_questions(questions, stop_words)
+    return word_scores.count(query[0], query[1])
+
+
+def decode_vocabulary(vocabulary_bytes):
+    """Split vocabulary column of cache into words"""
+    vocabulary_str = bytes(vocabulary_bytes).decode()
+    return vocabulary_str.split("\n") if vocabulary_str else []
+
+
+def file_hash(filepath, sample_size=None):
+    """Hash content of file, or only its head, middle and tail of sample_size bytes each"""
+    content_hash = blake2b(digest_size=16)
+    file_size = os.path.getsize(filepath)
+    with open(filepath, "rb") as file_fio:
+        if sample_size is None or file_size <= 3 * sample_size:
+            for block in iter(lambda: file_fio.read(HASH_BLOCK_SIZE), b""):
+                content_hash.update(block)
+        else:
+            for offset in (0, (file_size - sample_size) // 2, file_size - sample_size):
+                file_fio.seek(offset)
+                content_hash.update(file_fio.read(sample_size))
+    return content_hash.hexdigest()
+
+
+def questions_cache_key(questions_path, stop_words_path):
+    """Fingerprint of questions and stop words the cache is built from"""
+    questions_stat = os.stat(questions_path)
+    return {
+        "version": QUESTIONS_CACHE_VERSION,
+        "questions": {
+            "size": questions_stat.st_size,
+            "mtime_ns": questions_stat.st_mtime_ns,
+            "hash": file_hash(questions_path, QUESTIONS_HASH_SAMPLE_SIZE),
+        },
+        "stop_words": {"hash": file_hash(stop_words_path)},
+    }
 
 
-def process_list_queries(questions_path, stop_words_path, queries_fio):
+def dump_columns(filepath, key, columns):
+    """Save key and named columns to file aligned for memory mapping"""
+    key_bytes = json.dumps(key, sort_keys=True).encode()
+    names = sorted(columns)
+    offset = CACHE_HEADER.size + len(key_bytes) + CACHE_COLUMN.size * len(names)
+    directory = []
+    for name in names:
+        column = columns[name]
+        offset += -offset % CACHE_ALIGNMENT
+        typecode = column.typecode if isinstance(column, array) else "B"
+        length = len(column) * (column.itemsize if isinstance(column, array) else 1)
+        directory.append(CACHE_COLUMN.pack(name.encode(), typecode.encode(), offset, length))
+        offset += length
+    temporary_path = "%s.%d.tmp" % (filepath, os.getpid())
+    try:
+        with open(temporary_path, "wb") as cache_fio:
+            cache_fio.write(CACHE_HEADER.pack(CACHE_MAGIC, len(key_bytes), len(names)))
+            cache_fio.write(key_bytes)
+            cache_fio.write(b"".join(directory))
+            for name in names:
+                column = columns[name]
+                cache_fio.write(b"\0" * (-cache_fio.tell() % CACHE_ALIGNMENT))
+                if isinstance(column, array) and sys.byteorder != "little":
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                cache_fio.write(column)
+        os.replace(temporary_path, filepath)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def decode_columns(buffer, key):
+    """Return columns of cache in buffer built for key, None if the key differs or columns are out of it"""
+    magic, key_length, column_count = CACHE_HEADER.unpack_from(buffer)
+    offset = CACHE_HEADER.size
+    if magic != CACHE_MAGIC or offset + key_length > len(buffer):
+        return None
+    if json.loads(buffer[offset:offset + key_length]) != key:
+        return None
+    offset += key_length
+    columns = dict()
+    for _ in range(column_count):
+        name, typecode, column_offset, length = CACHE_COLUMN.unpack_from(buffer, offset)
+        offset += CACHE_COLUMN.size
+        if column_offset + length > len(buffer):
+            return None
+        view = memoryview(buffer)[column_offset:column_offset + length]
+        typecode = typecode.decode()
+        if typecode != "B":
+            if sys.byteorder == "little":
+                view = view.cast(typecode)
+            else:
+                view = array(typecode, view.tobytes())
+                view.byteswap()
+        columns[name.rstrip(b"\0").decode()] = view
+    return columns
+
+
+def map_columns(filepath, key):
+    """Memory-map file of columns built for key, return its columns or None if it is not such a cache
+
+    The key is compared before any column is decoded. A truncated or
+    corrupted file is reported as a stale cache instead of an error.
+    """
+    with open(filepath, "rb") as cache_fio:
+        if os.fstat(cache_fio.fileno()).st_size < CACHE_HEADER.size:
+            return None
+        buffer = mmap.mmap(cache_fio.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        columns = decode_columns(buffer, key)
+    except (struct.error, ValueError, TypeError) as error:
+        logger.warning("cache %s is corrupted: %s", filepath, error)
+        columns = None
+    if columns is None:
+        buffer.close()
+    return columns
+
+
+def load_word_scores(questions_path, stop_words_path, workers=DEFAULT_LOAD_WORKERS, cache_path=None):
+    """Load word scores from cache of preprocessed questions, or parse questions and save the cache
+
+    Cache is used only if it is built from the same questions and stop
+    words, otherwise it is rebuilt.
+    """
+    key = questions_cache_key(questions_path, stop_words_path) if cache_path else None
+    if cache_path and os.path.exists(cache_path):
+        columns = map_columns(cache_path, key)
+        if columns is not None:
+            try:
+                store = QuestionStore.from_columns(columns)
+                logger.info("load preprocessed questions from cache %s", cache_path)
+                return DailyWordScores.from_columns(columns, store.vocabulary)
+            except (KeyError, ValueError) as error:
+                logger.warning("cache %s is corrupted: %s", cache_path, error)
+        logger.info("cache %s is stale, parse questions again", cache_path)
+    store = load_question_store(questions_path, load_stop_words(stop_words_path), workers)
+    word_scores = DailyWordScores.from_store(store)
+    if cache_path:
+        columns = store.columns()
+        columns.update(word_scores.columns())
+        try:
+            dump_columns(cache_path, key, columns)
+            logger.info("save preprocessed questions to cache %s", cache_path)
+        except OSError as error:
+            logger.warning("cannot save cache %s, answer without it: %s", cache_path, error)
+    return word_scores
+
+
+def process_list_queries(questions_path, stop_words_path, queries_fio, workers=DEFAULT_LOAD_WORKERS,
+                         cache_path=None):
     """Contains using inverted index functionality for queries from comand string"""
-    questions = load_questions(questions_path)
-    stop_words = load_stop_words(stop_words_path)
+    word_scores = load_word_scores(questions_path, stop_words_path, workers, cache_path)
     logger.info("process XML dataset, ready to serve queries")
     for query in queries_fio:
         if len(query) <= 1:
             continue
         logger.debug('got query "%s"', query.rstrip())
-        query = list(map(int, query.rstrip().split(',')))
-        dict_words = count_words(questions, query, stop_words)
-        top_count = int(query[2])
+        start, end, top_count = (field.strip() for field in query.split(','))
+        dict_words = word_scores.count(start, end)
+        top_count = int(top_count)
         dict_len = len(dict_words)
         if dict_len < top_count:
-            logger.warning('not enough data to answer, found %d words out of %d for period "%d,%d"',
-                            dict_len, top_count, query[0], query[1])
+            logger.warning('not enough data to answer, found %d words out of %d for period "%s,%s"',
+                            dict_len, top_count, start, end)
             top_count = dict_len
         top_list = sorted(dict_words.items(), key=lambda x: (-x[1], x[0]))[:top_count]
         answer = dict()
-        answer["start"] = int(query[0])
-        answer["end"] = int(query[1])
+        answer["start"] = int(start) if start.isdigit() else start
+        answer["end"] = int(end) if end.isdigit() else end
         answer["top"] = top_list
         answer_json = json.dumps(answer)
         print(answer_json)
@@ -106,6 +573,20 @@ def setup_parser(parser):
         "--queries", required=True, dest='queries', type=FileType("r"),
         help="path to queries to load",
     )
+    parser.add_argument(
+        "--workers", required=False, dest='workers', type=int,
+        default=DEFAULT_LOAD_WORKERS,
+        help="number of processes to parse questions with",
+    )
+    parser.add_argument(
+        "--cache", required=False, dest='cache', default=None,
+        help="path to cache of preprocessed questions, next to questions with suffix %s by default"
+             % QUESTIONS_CACHE_SUFFIX,
+    )
+    parser.add_argument(
+        "--no-cache", required=False, dest='use_cache', action="store_false",
+        help="parse questions without reading or saving the cache",
+    )
 
 def setup_logging():
     """Sets up logging for CLI"""
@@ -124,7 +605,13 @@ def main():
     setup_parser(parser)
     arguments = parser.parse_args()
     setup_logging()
-    process_list_queries(arguments.questions, arguments.stop_words, arguments.queries)
+    cache_path = None
+    if arguments.use_cache:
+        cache_path = arguments.cache or arguments.questions + QUESTIONS_CACHE_SUFFIX
+    process_list_queries(
+        arguments.questions, arguments.stop_words, arguments.queries, arguments.workers,
+        cache_path,
+    )
 
 if __name__ == "__main__":
     main()
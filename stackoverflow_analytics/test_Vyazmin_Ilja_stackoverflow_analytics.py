@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 import pytest
 import logging
+from collections import defaultdict
+from datetime import date, timedelta
+import random
 
+import task_Vyazmin_Ilja_stackoverflow_analytics
 from task_Vyazmin_Ilja_stackoverflow_analytics import (
-	load_stop_words, load_questions, count_words, process_list_queries
+	load_stop_words, load_questions, count_words, process_list_queries,
+	DailyWordScores, split_at_rows, load_word_scores, load_question_store, QuestionStore
 )
 
 
@@ -72,4 +77,158 @@ def test_process_list_queries(tiny_stop_words_path, tiny_questions_path, tiny_qu
 		)
 	captured = capsys.readouterr()
 	assert '{"start": 2019, "end": 2019, "top": [["seo", 15], ["better", 10]]}' in captured.out
-	assert '{"start": 2019, "end": 2020, "top": [["better", 30], ["javascript", 20], ["python", 20], ["seo", 15]]}' in captured.out
\ No newline at end of file
+	assert '{"start": 2019, "end": 2020, "top": [["better", 30], ["javascript", 20], ["python", 20], ["seo", 15]]}' in captured.out
+
+def test_daily_word_scores_keep_words_with_zero_score(tiny_stop_words_path):
+	questions = [
+		{'CreationDate': "2018-01-01T00:00:00.000", 'Title': "Zero sum", 'Score': "0"},
+		{'CreationDate': "2019-01-01T00:00:00.000", 'Title': "Sum of parts", 'Score': "-3"},
+		{'CreationDate': "2021-01-01T00:00:00.000", 'Title': "Parts is parts", 'Score': "3"},
+	]
+	word_scores = DailyWordScores.from_questions(questions, load_stop_words(tiny_stop_words_path))
+	assert [date.fromordinal(day).year for day in word_scores.days] == [2018, 2019, 2021]
+	assert dict(word_scores.count(2018, 2018)) == {"zero": 0, "sum": 0}
+	assert dict(word_scores.count(2018, 2021)) == {"zero": 0, "sum": -3, "of": -3, "parts": 0}
+	assert dict(word_scores.count(2020, 2020)) == {}
+	assert dict(word_scores.count(2021, 2019)) == {}
+
+def test_load_questions_counts_malformed_rows(tmpdir, tiny_questions_path, caplog):
+	questions_path = tmpdir.join("broken_questions.txt")
+	questions_path.write(
+		'<?xml version="1.0" encoding="utf-8"?>\n<posts>\n' + QUESTIONS_TINY_STR
+		+ '<row Id="3" PostTypeId="1" CreationDate="2019-10-14" Score="1" Title="Broken\n'
+		+ '<row Id="4" PostTypeId="1" CreationDate="2019-10-14" Title="No score" />\n'
+		+ '<row Id="5" PostTypeId="2" CreationDate="2019-10-14" Score="1" Body="Broken answer\n</posts>\n'
+	)
+	with caplog.at_level(logging.WARNING):
+		questions = load_questions(questions_path)
+	assert questions == load_questions(tiny_questions_path)
+	assert "skipped 2 malformed question rows" in caplog.text
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_load_questions_by_ranges_of_rows(tiny_questions_path, workers):
+	file_size = len(QUESTIONS_TINY_STR.encode())
+	ranges = split_at_rows(tiny_questions_path, 16)
+	assert ranges[0][0] == 0 and ranges[-1][1] == file_size
+	assert all(end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+	assert all(QUESTIONS_TINY_STR.encode()[start - 1:start] == b"\n" for start, _ in ranges[1:])
+	questions = load_questions(tiny_questions_path, workers)
+	assert [question['Score'] for question in questions] == ["10", "5", "20"]
+
+def test_load_word_scores_from_cache(tmpdir, tiny_stop_words_path, tiny_questions_path, monkeypatch, caplog):
+	cache_path = str(tmpdir.join("questions.cache"))
+	word_scores = load_word_scores(tiny_questions_path, tiny_stop_words_path, cache_path=cache_path)
+	expected_scores = dict(word_scores.count(2019, 2020))
+	assert expected_scores == dict(count_words(
+		load_questions(tiny_questions_path), [2019, 2020], load_stop_words(tiny_stop_words_path),
+	))
+
+	def fail_to_parse(*args):
+		raise AssertionError("questions are parsed instead of loaded from cache")
+	with monkeypatch.context() as patch:
+		patch.setattr(task_Vyazmin_Ilja_stackoverflow_analytics, "load_question_store", fail_to_parse)
+		with caplog.at_level(logging.INFO):
+			cached_scores = load_word_scores(tiny_questions_path, tiny_stop_words_path, cache_path=cache_path)
+	assert "load preprocessed questions from cache" in caplog.text
+	assert list(cached_scores.days) == [date(2019, 10, 14).toordinal(), date(2020, 10, 14).toordinal()]
+	assert dict(cached_scores.count(2019, 2020)) == expected_scores
+	assert dict(cached_scores.count(2019, 2019)) == {"seo": 15, "better": 10, "done": 10, "with": 10, "repetition": 10, "what": 5}
+
+	tiny_stop_words_path.write("is\nthan\nbetter\n")
+	rebuilt_scores = load_word_scores(tiny_questions_path, tiny_stop_words_path, cache_path=cache_path)
+	assert "better" not in rebuilt_scores.count(2019, 2020)
+	tiny_questions_path.write(QUESTIONS_TINY_STR.replace('Score="20"', 'Score="7"'))
+	rebuilt_scores = load_word_scores(tiny_questions_path, tiny_stop_words_path, cache_path=cache_path)
+	assert rebuilt_scores.count(2020, 2020)["python"] == 7
+
+def test_truncated_cache_is_rebuilt(tmpdir, tiny_stop_words_path, tiny_questions_path, caplog):
+	cache_fio = tmpdir.join("questions.cache")
+	expected_scores = dict(load_word_scores(
+		tiny_questions_path, tiny_stop_words_path, cache_path=str(cache_fio),
+	).count(2019, 2020))
+	cache_bytes = cache_fio.read_binary()
+	for cut in (len(cache_bytes) // 2 + 1, 40, 13):
+		cache_fio.write_binary(cache_bytes[:cut])
+		with caplog.at_level(logging.INFO):
+			word_scores = load_word_scores(tiny_questions_path, tiny_stop_words_path, cache_path=str(cache_fio))
+		assert "is stale, parse questions again" in caplog.text
+		assert dict(word_scores.count(2019, 2020)) == expected_scores
+		assert cache_fio.read_binary() == cache_bytes
+		caplog.clear()
+
+def test_unwritable_cache_is_skipped(tmpdir, tiny_stop_words_path, tiny_questions_path, caplog):
+	cache_path = str(tmpdir.join("missing", "questions.cache"))
+	word_scores = load_word_scores(tiny_questions_path, tiny_stop_words_path, cache_path=cache_path)
+	assert "cannot save cache" in caplog.text
+	assert word_scores.count(2020, 2020)["python"] == 20
+	assert not tmpdir.join("missing").check()
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_load_question_store(tiny_stop_words_path, tiny_questions_path, workers):
+	stop_words = load_stop_words(tiny_stop_words_path)
+	store = load_question_store(tiny_questions_path, stop_words, workers)
+	assert len(store) == 3
+	assert (store.days.typecode, store.scores.typecode, store.word_ids.typecode) == ("I", "i", "I")
+	assert [date.fromordinal(day).year for day in store.days] == [2019, 2019, 2020]
+	assert list(store.scores) == [10, 5, 20]
+	titles = [sorted(store.vocabulary[word_id] for word_id in store.title_word_ids(number)) for number in range(3)]
+	assert titles == [["better", "done", "repetition", "seo", "with"], ["seo", "what"], ["better", "javascript", "python"]]
+	assert len(store.vocabulary) == len(set(store.vocabulary)) == 8
+	tiny_questions = load_questions(tiny_questions_path)
+	assert dict(count_words(store, [2019, 2020], stop_words)) == dict(count_words(tiny_questions, [2019, 2020], stop_words))
+
+def test_question_store_extend_translates_word_ids(tiny_stop_words_path, tiny_questions_path):
+	stop_words = load_stop_words(tiny_stop_words_path)
+	questions = load_questions(tiny_questions_path)
+	store = QuestionStore.from_questions(questions[:2], stop_words)
+	store.extend(QuestionStore.from_questions(questions[2:], stop_words))
+	expected_store = QuestionStore.from_questions(questions, stop_words)
+	assert list(store.days) == list(expected_store.days) and list(store.scores) == list(expected_store.scores)
+	for number in range(3):
+		assert sorted(store.vocabulary[word_id] for word_id in store.title_word_ids(number)) == sorted(
+			expected_store.vocabulary[word_id] for word_id in expected_store.title_word_ids(number)
+		)
+	restored_store = QuestionStore.from_columns(store.columns())
+	assert restored_store.vocabulary == store.vocabulary
+	assert list(restored_store.word_offsets) == list(store.word_offsets)
+
+def test_daily_word_scores_count_date_ranges():
+	first_day = date(2019, 1, 1)
+	questions = []
+	generator = random.Random(7)
+	for number in range(300):
+		creation_date = first_day + timedelta(days=generator.randrange(400))
+		questions.append({
+			'CreationDate': creation_date.isoformat() + "T12:00:00.000",
+			'Title': " ".join(generator.sample(["alpha", "beta", "gamma", "delta", "epsilon"], 2)),
+			'Score': str(generator.randint(-5, 5)),
+		})
+	word_scores = DailyWordScores.from_questions(questions, set())
+	for _ in range(100):
+		start = first_day + timedelta(days=generator.randrange(-10, 410))
+		end = start + timedelta(days=generator.randrange(-5, 200))
+		expected_scores = defaultdict(int)
+		for question in questions:
+			if start.isoformat() <= question['CreationDate'][:10] <= end.isoformat():
+				for word in set(question['Title'].split()):
+					expected_scores[word] += int(question['Score'])
+		assert dict(word_scores.count(start.isoformat(), end.isoformat())) == dict(expected_scores)
+	assert word_scores.count("2019-03", "2019-06") == word_scores.count("2019-03-01", "2019-06-30")
+	assert word_scores.count(2019, 2019) == word_scores.count("2019-01-01", "2019-12-31")
+
+def test_process_list_queries_by_dates(tiny_stop_words_path, tiny_questions_path, tmpdir, capsys):
+	queries_path = tmpdir.join("date_queries.txt")
+	queries_path.write("2019-10-14,2019-10-14,2\n2019-10, 2020-09 ,10\n2020-10-15,2020-12-31,3\n2019, 2020, 1\n")
+	with open(queries_path, "r") as query_fin:
+		process_list_queries(
+			questions_path=tiny_questions_path,
+			stop_words_path=tiny_stop_words_path,
+			queries_fio=query_fin
+		)
+	captured = capsys.readouterr()
+	assert captured.out.splitlines() == [
+		'{"start": "2019-10-14", "end": "2019-10-14", "top": [["seo", 15], ["better", 10]]}',
+		'{"start": "2019-10", "end": "2020-09", "top": [["seo", 15], ["better", 10], ["done", 10], ["repetition", 10], ["with", 10], ["what", 5]]}',
+		'{"start": "2020-10-15", "end": "2020-12-31", "top": []}',
+		'{"start": 2019, "end": 2020, "top": [["better", 30]]}',
+	]